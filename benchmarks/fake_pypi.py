@@ -0,0 +1,243 @@
+# Local stand-in for the PyPI JSON API and file host, serving generated packages
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+VERSION = '1.0.0'
+CHUNK_SIZE = 1024 * 1024
+
+
+def _pyproject(name):
+    return f'''[build-system]
+requires = ["setuptools>=61"]
+build-backend = "setuptools.build_meta"
+
+[project]
+name = "{name}"
+version = "{VERSION}"
+requires-python = ">=3.8"
+
+[tool.setuptools]
+packages = ["{name}"]
+
+[tool.setuptools.package-data]
+{name} = ["*.bin"]
+'''
+
+
+def _module(name):
+    return f'def main():\n    print("{name} {VERSION}")\n'
+
+
+def make_sdist(path, name, size):
+    """Write a setuptools sdist whose package carries size bytes of incompressible data."""
+    root = f"{name}-{VERSION}"
+    members = {
+        'PKG-INFO': f"Metadata-Version: 2.1\nName: {name}\nVersion: {VERSION}\nRequires-Python: >=3.8\n",
+        'pyproject.toml': _pyproject(name),
+        f'{name}/__init__.py': _module(name),
+        f'{name}/__main__.py': f'from {name} import main\n\nmain()\n',
+        f'{name}/data.bin': os.urandom(size),
+    }
+    with tarfile.open(path, 'w:gz') as tar:
+        for member, content in members.items():
+            data = content if isinstance(content, bytes) else content.encode('utf-8')
+            info = tarfile.TarInfo(f"{root}/{member}")
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+
+
+def make_wheel(path, name, size):
+    """Write a pure-Python wheel of the same package."""
+    dist_info = f"{name}-{VERSION}.dist-info"
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        wheel.writestr(f"{name}/__init__.py", _module(name))
+        wheel.writestr(f"{name}/data.bin", os.urandom(size))
+        wheel.writestr(f"{dist_info}/METADATA",
+                       f"Metadata-Version: 2.1\nName: {name}\nVersion: {VERSION}\nRequires-Python: >=3.8\n")
+        wheel.writestr(f"{dist_info}/WHEEL",
+                       "Wheel-Version: 1.0\nGenerator: pybins-bench\nRoot-Is-Purelib: true\nTag: py3-none-any\n")
+        wheel.writestr(f"{dist_info}/RECORD", "")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FakePyPI:
+    """Generated packages behind a PyPI-compatible JSON API and file host.
+
+    Packages are named <prefix><n>, each with one sdist of sdist_size bytes
+    of payload; the first `wheels` of them also ship a py3-none-any wheel,
+    so builds of those take the prebuilt-wheel path. JSON documents carry
+    ETags and answer If-None-Match with 304 like PyPI does. latency adds a
+    fixed delay to every response to model a remote index.
+    """
+
+    def __init__(self, directory, packages=20, sdist_size=64 * 1024, wheels=4, latency=0.0,
+                 prefix='benchpkg'):
+        self.directory = directory
+        self.names = [f"{prefix}{i}" for i in range(packages)]
+        self.wheel_names = self.names[:wheels]
+        self.sdist_size = sdist_size
+        self.latency = latency
+        self.requests = {'json': 0, 'file': 0, 'not_modified': 0, 'not_found': 0}
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._pages = {}
+        self._server = None
+        self.base_url = None
+
+    def generate(self):
+        """Write the release files and prepare the JSON documents."""
+        files_dir = os.path.join(self.directory, 'files')
+        os.makedirs(files_dir, exist_ok=True)
+        for name in self.names:
+            files = []
+            sdist = os.path.join(files_dir, f"{name}-{VERSION}.tar.gz")
+            if not os.path.isfile(sdist):
+                make_sdist(sdist, name, self.sdist_size)
+            files.append(('sdist', sdist, _sha256(sdist)))
+            if name in self.wheel_names:
+                wheel = os.path.join(files_dir, f"{name}-{VERSION}-py3-none-any.whl")
+                if not os.path.isfile(wheel):
+                    make_wheel(wheel, name, self.sdist_size)
+                files.append(('bdist_wheel', wheel, _sha256(wheel)))
+            self._documents[name] = files
+        return self
+
+    def _release_files(self, name):
+        return [{
+            'filename': os.path.basename(path),
+            'url': f"{self.base_url}/files/{os.path.basename(path)}",
+            'packagetype': packagetype,
+            'python_version': 'source' if packagetype == 'sdist' else 'py3',
+            'requires_python': '>=3.8',
+            'digests': {'sha256': sha256},
+            'size': os.path.getsize(path),
+            'yanked': False,
+        } for packagetype, path, sha256 in self._documents[name]]
+
+    def document(self, name):
+        """The /pypi/<name>/json document, or None for an unknown project."""
+        if name not in self._documents:
+            return None
+        files = self._release_files(name)
+        return {
+            'info': {
+                'name': name,
+                'version': VERSION,
+                'summary': f"Benchmark package {name}",
+                'author': 'pybins-bench',
+                'package_url': f"{self.base_url}/project/{name}/",
+                'requires_python': '>=3.8',
+                'requires_dist': None,
+            },
+            'releases': {VERSION: files},
+            'urls': files,
+        }
+
+    def page(self, name):
+        """(etag, body) of the JSON document, rendered once per project."""
+        with self._lock:
+            page = self._pages.get(name)
+        if page is None:
+            document = self.document(name)
+            if document is None:
+                return None
+            body = json.dumps(document).encode('utf-8')
+            page = (f'"{hashlib.sha256(body).hexdigest()[:16]}"', body)
+            with self._lock:
+                self._pages[name] = page
+        return page
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _empty(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if parts[0] == 'pypi' and parts[-1] == 'json' and len(parts) in (3, 4):
+                    return self._json(parts[1], parts[2] if len(parts) == 4 else None)
+                if parts[0] == 'files' and len(parts) == 2:
+                    return self._file(parts[1])
+                fake._count('not_found')
+                self._empty(404)
+
+            def _json(self, name, version):
+                page = fake.page(name)
+                if page is None or (version and version != VERSION):
+                    fake._count('not_found')
+                    return self._empty(404)
+                etag, body = page
+                if self.headers.get('If-None-Match') == etag:
+                    fake._count('not_modified')
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                fake._count('json')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _file(self, filename):
+                path = os.path.join(fake.directory, 'files', os.path.basename(filename))
+                if not os.path.isfile(path):
+                    fake._count('not_found')
+                    return self._empty(404)
+                fake._count('file')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        self.wfile.write(chunk)
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a background thread; returns the base URL for PYBINS_PYPI_URL."""
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, name='fake-pypi', daemon=True).start()
+        return f"{self.base_url}/pypi"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
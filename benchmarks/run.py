@@ -0,0 +1,320 @@
+# End-to-end PyBins benchmark against a local fake PyPI
+#
+#   python -m benchmarks.run --requests 2000 --concurrency 32 --output bench.json
+#   python -m benchmarks.run --baseline bench.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from .fake_pypi import FakePyPI
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Compared against a baseline: higher is better for throughput, lower for latencies
+COMPARED = (('throughput_rps', 1), ('p50_ms', -1), ('p99_ms', -1), ('builds_per_minute', 1))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark PyBins end to end against a local fake PyPI.')
+    parser.add_argument('--packages', type=int, default=20, help='Generated packages (default: 20)')
+    parser.add_argument('--sdist-size', type=int, default=64 * 1024,
+                        help='Payload bytes per generated sdist (default: 65536)')
+    parser.add_argument('--wheels', type=int, default=4,
+                        help='Packages that also ship a prebuilt wheel; they are the download targets (default: 4)')
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='Seconds added to every fake PyPI response (default: 0)')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per endpoint (default: 1000)')
+    parser.add_argument('--warmup', type=int, default=50, help='Unmeasured requests per endpoint (default: 50)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients (default: 16)')
+    parser.add_argument('--endpoints', default='installer,meta,builds,download',
+                        help='Comma-separated endpoints to load (default: all)')
+    parser.add_argument('--builds', type=int, default=8,
+                        help='sdist wheel builds to run end to end; 0 skips them (default: 8)')
+    parser.add_argument('--build-concurrency', type=int, default=2,
+                        help='Builds submitted at once, and PYBINS_BUILD_WORKERS (default: 2)')
+    parser.add_argument('--workdir', help='Keep artifacts, database and build environments here '
+                                          '(reuse it to measure warm runs; default: a temporary directory)')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='Earlier results to compare against')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for request order')
+    return parser.parse_args(argv)
+
+
+def configure_environment(workdir, pypi_url, args):
+    """Point PyBins at the fake PyPI and the work directory; must run before pybins is imported."""
+    os.environ.update({
+        'PYBINS_PYPI_URL': pypi_url,
+        'PYBINS_ARTIFACTS_DIR': os.path.join(workdir, 'artifacts'),
+        'PYBINS_DB_PATH': os.path.join(workdir, 'artifacts', 'pybins.db'),
+        'PYBINS_METRICS_DIR': os.path.join(workdir, 'artifacts', 'metrics'),
+        'PYBINS_BUILD_ENV_DIR': os.path.join(workdir, 'artifacts', '.buildenvs'),
+        'PYBINS_BINARY_CACHE_DIR': os.path.join(workdir, 'artifacts', '.pyinstaller'),
+        'PYBINS_BUILD_WORKERS': str(args.build_concurrency),
+        # Measure the service, not the rate limiter
+        'PYBINS_RATELIMIT_DEFAULT': '1000000 per second',
+        'PYBINS_RATELIMIT_BUILD': '1000000 per second',
+    })
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(int(round(fraction * len(values))) - 1, 0))
+    return values[index]
+
+
+def summarize(latencies, statuses, errors, elapsed, nbytes):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': count,
+        'errors': errors,
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(count / elapsed, 1) if elapsed else None,
+        'bytes_per_s': round(nbytes / elapsed) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / count) if count else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p90_ms': ms(percentile(latencies, 0.90)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(latencies[-1]) if count else None,
+    }
+
+
+def load(base_url, paths, total, concurrency):
+    """GET total paths (cycling through them) from concurrency keep-alive clients."""
+    import requests
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+    state = {'next': 0, 'errors': 0, 'bytes': 0}
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = state['next']
+                if index >= total:
+                    break
+                state['next'] += 1
+            start = time.perf_counter()
+            try:
+                response = session.get(base_url + paths[index % len(paths)])
+                size = len(response.content)
+            except requests.RequestException:
+                with lock:
+                    state['errors'] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                state['bytes'] += size
+                if response.status_code >= 400:
+                    state['errors'] += 1
+        session.close()
+
+    threads = [threading.Thread(target=client) for _ in range(max(min(concurrency, total), 1))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, state['errors'], time.perf_counter() - start, state['bytes'])
+
+
+def run_builds(base_url, packages, concurrency):
+    """Build each package from its sdist through POST /build and time it end to end."""
+    import requests
+    lock = threading.Lock()
+    pending = list(packages)
+    durations, outcomes, failures = [], {}, []
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not pending:
+                    break
+                package = pending.pop(0)
+            start = time.perf_counter()
+            try:
+                result = session.post(f"{base_url}/build?wait=0",
+                                      json={'package': package, 'force': True}).json()
+            except (requests.RequestException, ValueError) as e:
+                result = {'status': 'error', 'output': str(e)}
+            elapsed = time.perf_counter() - start
+            status = result.get('status', 'error')
+            with lock:
+                outcomes[status] = outcomes.get(status, 0) + 1
+                if status == 'success':
+                    durations.append(elapsed)
+                elif len(failures) < 3:
+                    failures.append({'package': package, 'status': status,
+                                     'output': str(result.get('output') or result.get('error'))[:500],
+                                     'log_url': result.get('log_url') or result.get('download_url')})
+        session.close()
+
+    threads = [threading.Thread(target=client) for _ in range(max(min(concurrency, len(packages)), 1))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    summary = summarize(durations, {}, len(packages) - len(durations), elapsed, 0)
+    for failure in failures:
+        # The end of the build log usually says why
+        if (failure['log_url'] or '').endswith('build.log'):
+            try:
+                failure['log_tail'] = requests.get(base_url + failure['log_url']).text[-1000:]
+            except requests.RequestException:
+                pass
+    return {
+        'builds': len(packages),
+        'succeeded': len(durations),
+        'outcomes': outcomes,
+        'elapsed_s': round(elapsed, 3),
+        'builds_per_minute': round(len(durations) / elapsed * 60, 2) if elapsed else None,
+        'p50_ms': summary['p50_ms'],
+        'p90_ms': summary['p90_ms'],
+        'max_ms': summary['max_ms'],
+        'failures': failures,
+    }
+
+
+def seed_downloads(base_url, packages):
+    """Publish the prebuilt-wheel packages and return download paths for their wheels."""
+    import requests
+    paths = []
+    for package in packages:
+        result = requests.post(f"{base_url}/build?wait=0", json={'package': package}).json()
+        if result.get('status') == 'success' and result.get('download_url'):
+            paths.append(result['download_url'])
+    return paths
+
+
+def compare(results, baseline):
+    """Relative change of each compared metric against a baseline run."""
+    changes = {}
+    sections = dict(results['endpoints'], builds=results.get('builds') or {})
+    old_sections = dict(baseline.get('endpoints', {}), builds=baseline.get('builds') or {})
+    for name, section in sections.items():
+        old = old_sections.get(name) or {}
+        for metric, direction in COMPARED:
+            if section.get(metric) is None or not old.get(metric):
+                continue
+            change = (section[metric] - old[metric]) / old[metric]
+            changes.setdefault(name, {})[metric] = {
+                'baseline': old[metric], 'current': section[metric],
+                'change_pct': round(change * 100, 1),
+                'regressed': change * direction < -0.05,
+            }
+    return {'commit': baseline.get('meta', {}).get('commit'), 'metrics': changes}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pybins-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    fake = FakePyPI(os.path.join(workdir, 'pypi'), packages=args.packages, sdist_size=args.sdist_size,
+                    wheels=args.wheels, latency=args.upstream_latency).generate()
+    pypi_url = fake.start()
+    configure_environment(workdir, pypi_url, args)
+
+    sys.path.insert(0, REPO_ROOT)
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from pybins import create_app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='pybins', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        names = list(fake.names)
+        rng.shuffle(names)
+        downloads = seed_downloads(base_url, fake.wheel_names)
+        paths = {
+            'installer': [f"/{name}" for name in names],
+            'meta': [f"/meta/{name}" for name in names],
+            'builds': ['/builds?limit=50', '/builds?limit=50&status=success', '/builds?limit=10&fields=build_id,status'],
+            'download': downloads,
+        }
+        endpoints = {}
+        for endpoint in [e.strip() for e in args.endpoints.split(',') if e.strip()]:
+            if not paths.get(endpoint):
+                endpoints[endpoint] = {'skipped': 'nothing to request'}
+                continue
+            load(base_url, paths[endpoint], args.warmup, args.concurrency)
+            endpoints[endpoint] = load(base_url, paths[endpoint], args.requests, args.concurrency)
+            print(f"{endpoint}: {endpoints[endpoint]['throughput_rps']} req/s, "
+                  f"p50 {endpoints[endpoint]['p50_ms']} ms, p99 {endpoints[endpoint]['p99_ms']} ms",
+                  file=sys.stderr)
+
+        builds = None
+        sdist_only = [name for name in fake.names if name not in fake.wheel_names][:args.builds]
+        if sdist_only:
+            builds = run_builds(base_url, sdist_only, args.build_concurrency)
+            print(f"builds: {builds['succeeded']}/{builds['builds']} succeeded, "
+                  f"{builds['builds_per_minute']} per minute", file=sys.stderr)
+
+        results = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'params': {key: value for key, value in vars(args).items()
+                           if key not in ('output', 'baseline', 'workdir')},
+            },
+            'endpoints': endpoints,
+            'builds': builds,
+            'upstream_requests': dict(fake.requests),
+        }
+        if args.baseline:
+            with open(args.baseline) as f:
+                results['comparison'] = compare(results, json.load(f))
+    finally:
+        server.shutdown()
+        fake.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    regressed = any(metric['regressed'] for section in results.get('comparison', {}).get('metrics', {}).values()
+                    for metric in section.values())
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
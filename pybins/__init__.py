@@ -2,6 +2,12 @@ from flask import Flask, jsonify
 from .api.server import api_blueprint
 from .routes.routes import routes_bp
 from .worker.urls import worker_bp
+from .api.middleware.compression import init_compression
+from .metrics.metrics import init_metrics
+from .api.middleware.middleware import init_limiter, limiter
+from .api.middleware.admission import init_admission
+from .routes.installers import init_installers
+from .routes.simple import init_simple_index
 
 def create_app():
     """Application factory pattern for Flask"""
@@ -11,10 +17,24 @@ def create_app():
     app.config['SECRET_KEY'] = 'your-secret-key-here'
     app.config['DEBUG'] = True
     
+    # Compress large textual responses (gzip, plus br/zstd when installed)
+    init_compression(app)
+    # Per-route request latency for GET /metrics
+    init_metrics(app)
+    # Rate limits per client, and queue caps that shed build submissions early
+    init_limiter(app)
+    init_admission(app)
+    # Installer scripts for popular tools are rendered before the first request
+    init_installers(app)
+    init_simple_index(app)
+    
     # Register blueprints with proper URL prefixes
     app.register_blueprint(api_blueprint, url_prefix='/api')
     app.register_blueprint(worker_bp, url_prefix='/worker')
     app.register_blueprint(routes_bp, url_prefix='/')
+    # Probes and scrapers are never rate limited
+    limiter.exempt(app.view_functions['routes.health_check'])
+    limiter.exempt(app.view_functions['routes.metrics'])
     
     # Global error handlers
     @app.errorhandler(404)
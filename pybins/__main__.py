@@ -2,10 +2,28 @@
 """
 Entry point for running the pybins package as a module.
 This allows the package to be executed with: python -m pybins
+
+    python -m pybins --profile-startup [--top N] [--json]
+
+reports the import cost of each module on the startup path instead.
 """
 
+import argparse
+import json
+
 from . import create_app
 
 if __name__ == '__main__':
-    app = create_app()
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(prog='python -m pybins')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report per-module import cost of starting the app, then exit')
+    parser.add_argument('--top', type=int, default=25, help='modules and packages to list in the profile')
+    parser.add_argument('--json', action='store_true', help='print the profile as JSON')
+    args = parser.parse_args()
+    if args.profile_startup:
+        from .startup import profile_startup, format_report
+        report = profile_startup(top=args.top)
+        print(json.dumps(report, indent=2) if args.json else format_report(report))
+    else:
+        app = create_app()
+        app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,185 @@
+# Admission control and backpressure for build submission
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import request, jsonify, current_app
+from ...storage.storage import get_storage
+from ...metrics.metrics import registry
+
+MAX_ACTIVE_BUILDS = int(os.environ.get('PYBINS_MAX_ACTIVE_BUILDS', 64))
+MAX_QUEUE_DEPTH = int(os.environ.get('PYBINS_MAX_QUEUE_DEPTH', 32))
+MAX_CLIENT_BUILDS = int(os.environ.get('PYBINS_MAX_CLIENT_BUILDS', 8))
+MAX_CLIENT_QUEUE = int(os.environ.get('PYBINS_MAX_CLIENT_QUEUE', 4))
+# Batches queue at a lower priority and are bounded separately
+MAX_BATCH_QUEUE_DEPTH = int(os.environ.get('PYBINS_MAX_BATCH_QUEUE_DEPTH', 1024))
+MAX_CLIENT_BATCH_QUEUE = int(os.environ.get('PYBINS_MAX_CLIENT_BATCH_QUEUE', 256))
+# Queued/running records older than this are treated as lost, not active
+STALE_AFTER = float(os.environ.get('PYBINS_ADMISSION_STALE_AFTER', 6 * 3600))
+DEFAULT_BUILD_SECONDS = float(os.environ.get('PYBINS_DEFAULT_BUILD_SECONDS', 60))
+MAX_RETRY_AFTER = 3600
+ESTIMATE_TTL = 10
+EWMA_ALPHA = 0.3
+
+# Endpoints that start builds
+BUILD_ENDPOINTS = {
+    'routes.enqueue_build',
+    'routes.build_package',
+    'worker.create_build',
+    'worker.run_build_now',
+}
+
+admission_rejections = registry.counter(
+    'pybins_admission_rejections_total', 'Build submissions rejected by admission control')
+
+
+def client_id():
+    """Identify the caller: its API key (hashed) when it sends one, else its address."""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+
+class AdmissionController:
+    """Decides whether a new build may be queued, and when to retry if not.
+
+    Counts come from the shared build store, so every web worker and RQ
+    worker sees the same queue. Retry-After is the time the builds ahead of
+    the caller need to drain, using an exponentially weighted average of
+    recent build durations.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or get_storage()
+        self._lock = threading.Lock()
+        self._estimate = None
+        self._estimated_at = 0.0
+
+    def estimated_build_seconds(self):
+        with self._lock:
+            if self._estimate is not None and time.monotonic() - self._estimated_at < ESTIMATE_TTL:
+                return self._estimate
+        durations = self.storage.recent_build_durations()
+        estimate = None
+        # Oldest first, so the newest builds weigh the most
+        for duration in reversed(durations):
+            estimate = duration if estimate is None else EWMA_ALPHA * duration + (1 - EWMA_ALPHA) * estimate
+        estimate = estimate or DEFAULT_BUILD_SECONDS
+        with self._lock:
+            self._estimate = estimate
+            self._estimated_at = time.monotonic()
+        return estimate
+
+    def retry_after(self, ahead, slots):
+        """Seconds until `ahead` builds have drained through `slots` parallel builders."""
+        seconds = self.estimated_build_seconds() * max(ahead, 1) / max(slots, 1)
+        return int(min(max(math.ceil(seconds), 1), MAX_RETRY_AFTER))
+
+    def check(self, client, config, requested=1, batch=False):
+        """Return None to admit `requested` new builds, or (status_code, reason, message, retry_after).
+
+        Single builds are checked against the client and service limits,
+        ignoring queued batch builds; a batch is checked against the batch
+        queue limits only.
+        """
+        updated_after = (datetime.now() - timedelta(seconds=STALE_AFTER)).isoformat()
+        overall = self.storage.count_active_builds(updated_after)
+        mine = self.storage.count_active_builds(updated_after, client)
+        if batch:
+            checks = (
+                (429, 'client_batch_queue', 'queued batch builds for this client',
+                 config['ADMISSION_MAX_CLIENT_BATCH_QUEUE'], mine['batched'], overall['running']),
+                (503, 'batch_queue_depth', 'queued batch builds', config['ADMISSION_MAX_BATCH_QUEUE_DEPTH'],
+                 overall['batched'], overall['running']),
+            )
+        else:
+            checks = (
+                (429, 'client_builds', 'active builds for this client', config['ADMISSION_MAX_CLIENT_BUILDS'],
+                 mine['queued'] + mine['running'], mine['running']),
+                (429, 'client_queue', 'queued builds for this client', config['ADMISSION_MAX_CLIENT_QUEUE'],
+                 mine['queued'], mine['running']),
+                (503, 'queue_depth', 'queued builds', config['ADMISSION_MAX_QUEUE_DEPTH'],
+                 overall['queued'], overall['running']),
+                (503, 'active_builds', 'active builds', config['ADMISSION_MAX_ACTIVE_BUILDS'],
+                 overall['queued'] + overall['running'], overall['running']),
+            )
+        for status_code, reason, what, limit, current, running in checks:
+            if not limit or current + requested <= limit:
+                continue
+            if requested > limit:
+                # Waiting cannot help: the request alone is over the limit
+                return (413, reason, f"{requested} builds exceed the limit of {limit} {what}", None)
+            return (status_code, reason, f"Too many {what} ({current}/{limit})",
+                    self.retry_after(current + requested - limit, running))
+        return None
+
+
+admission = AdmissionController()
+
+
+def rejection_response(status_code, reason, message, retry_after):
+    admission_rejections.inc(reason=reason)
+    response = jsonify({'error': message, 'status': 'rejected', 'reason': reason,
+                        'retry_after': retry_after})
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _coalesces(data):
+    """True when the request will attach to an existing or running identical build."""
+    from ...worker.tasks import build_index
+    from ...worker.dedup import build_key
+    from ...fetcher.selector import parse_target, TargetError
+    if not isinstance(data, dict) or not data.get('package') or data.get('force'):
+        return False
+    version = data.get('version', 'latest')
+    if not version or version == 'latest':
+        return False
+    try:
+        target = parse_target(data.get('target'))
+    except TargetError:
+        # The endpoint rejects the request
+        return False
+    key = build_key(data['package'], version, data.get('build_type', 'wheel'), target)
+    return build_index.inflight(key) is not None or build_index.find(key) is not None
+
+
+def admit_builds(requested=1, batch=False):
+    """Return a rejection response if `requested` more builds cannot be taken now, else None."""
+    if not current_app.config.get('ADMISSION_ENABLED', True):
+        return None
+    rejected = admission.check(client_id(), current_app.config, requested, batch)
+    if rejected:
+        return rejection_response(*rejected)
+    return None
+
+
+def admit_build_request():
+    """before_request hook: reject build submissions the service cannot take now."""
+    if request.method != 'POST' or request.endpoint not in BUILD_ENDPOINTS:
+        return None
+    if not current_app.config.get('ADMISSION_ENABLED', True):
+        return None
+    # Identical requests share one build, so they never add load
+    if _coalesces(request.get_json(silent=True)):
+        return None
+    return admit_builds()
+
+
+def init_admission(app):
+    """Install admission control on a Flask app."""
+    app.config.setdefault('ADMISSION_ENABLED',
+                          os.environ.get('PYBINS_ADMISSION', '1').lower() not in ('0', 'false', 'no'))
+    app.config.setdefault('ADMISSION_MAX_ACTIVE_BUILDS', MAX_ACTIVE_BUILDS)
+    app.config.setdefault('ADMISSION_MAX_QUEUE_DEPTH', MAX_QUEUE_DEPTH)
+    app.config.setdefault('ADMISSION_MAX_CLIENT_BUILDS', MAX_CLIENT_BUILDS)
+    app.config.setdefault('ADMISSION_MAX_CLIENT_QUEUE', MAX_CLIENT_QUEUE)
+    app.config.setdefault('ADMISSION_MAX_BATCH_QUEUE_DEPTH', MAX_BATCH_QUEUE_DEPTH)
+    app.config.setdefault('ADMISSION_MAX_CLIENT_BATCH_QUEUE', MAX_CLIENT_BATCH_QUEUE)
+    app.before_request(admit_build_request)
+    return app
@@ -0,0 +1,158 @@
+# Response compression negotiated from Accept-Encoding
+import os
+import zlib
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('PYBINS_COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('PYBINS_COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BR_LEVEL = int(os.environ.get('PYBINS_COMPRESS_BR_LEVEL', 4))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get('PYBINS_COMPRESS_ZSTD_LEVEL', 3))
+
+# Only textual payloads are worth compressing; wheels, zips and binaries
+# are already compressed or incompressible.
+COMPRESSIBLE_TYPES = (
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/x-sh',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+)
+# Server preference when the client weighs several encodings equally
+PREFERRED_ENCODINGS = ('zstd', 'br', 'gzip')
+
+
+def available_encodings():
+    """Encodings this process can produce, in order of preference."""
+    return [encoding for encoding in PREFERRED_ENCODINGS
+            if encoding == 'gzip'
+            or (encoding == 'br' and brotli is not None)
+            or (encoding == 'zstd' and zstandard is not None)]
+
+
+class _Brotli:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def compressor(encoding, level=None):
+    """Return an object with compress(data) and flush() for encoding."""
+    if encoding == 'gzip':
+        level = COMPRESS_GZIP_LEVEL if level is None else level
+        # wbits=31 produces a gzip container rather than a raw zlib stream
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == 'br' and brotli is not None:
+        return _Brotli(COMPRESS_BR_LEVEL if level is None else level)
+    if encoding == 'zstd' and zstandard is not None:
+        level = COMPRESS_ZSTD_LEVEL if level is None else level
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def compress_bytes(data, encoding='gzip', level=None):
+    """Compress a whole payload in one call."""
+    c = compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def _compress_stream(chunks, c, body):
+    try:
+        for chunk in chunks:
+            if chunk:
+                out = c.compress(chunk)
+                if out:
+                    yield out
+        yield c.flush()
+    finally:
+        # Release the wrapped body (e.g. the file behind send_file)
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def _level_for(encoding, config):
+    return config.get({
+        'gzip': 'COMPRESS_GZIP_LEVEL',
+        'br': 'COMPRESS_BR_LEVEL',
+        'zstd': 'COMPRESS_ZSTD_LEVEL',
+    }[encoding])
+
+
+def _compressible(response):
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return False
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if 'no-transform' in (response.headers.get('Cache-Control') or ''):
+        return False
+    return True
+
+
+def compress_response(response):
+    """Compress response in place for the current request when it pays off.
+
+    Bodies smaller than COMPRESS_MIN_SIZE are left alone so the many small
+    JSON responses cost no CPU. Streamed bodies (file downloads, generators)
+    are compressed chunk by chunk without buffering them. Server-Sent Events
+    are never compressed because every event has to reach the client as
+    soon as it is written.
+    """
+    config = current_app.config
+    if not config.get('COMPRESS_ENABLED', True) or not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.method == 'HEAD':
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+    min_size = config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    level = _level_for(encoding, config)
+
+    if response.is_streamed:
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+        body = response.response
+        chunks = response.iter_encoded()
+        response.direct_passthrough = False
+        response.response = _compress_stream(chunks, compressor(encoding, level), body)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress_bytes(data, encoding, level))
+
+    response.content_encoding = encoding
+    # Byte offsets would refer to the compressed representation
+    response.headers.pop('Accept-Ranges', None)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Same content, different bytes: only weakly equal to the identity form
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Install app-wide response compression on a Flask app."""
+    app.config.setdefault('COMPRESS_ENABLED',
+                          os.environ.get('PYBINS_COMPRESS', '1').lower() not in ('0', 'false', 'no'))
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', COMPRESS_GZIP_LEVEL)
+    app.config.setdefault('COMPRESS_BR_LEVEL', COMPRESS_BR_LEVEL)
+    app.config.setdefault('COMPRESS_ZSTD_LEVEL', COMPRESS_ZSTD_LEVEL)
+    app.after_request(compress_response)
+    return app
@@ -1,36 +1,65 @@
 # auth,logging,validation 
 # rate limiting, CORS, etc
-from flask import Flask, request, Response, abort
+import math
+import os
+import time
+from flask import Response, abort, make_response
 from functools import wraps
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from ...fetcher.cache import metadata_cache
+from . import compression
+from ...metrics.metrics import call_seconds
+from .admission import client_id, rejection_response
 
+RATELIMIT_DEFAULT = os.environ.get('PYBINS_RATELIMIT_DEFAULT', '600 per minute')
+RATELIMIT_BUILD = os.environ.get('PYBINS_RATELIMIT_BUILD', '30 per minute')
+RATELIMIT_GC = os.environ.get('PYBINS_RATELIMIT_GC', '6 per minute')
+RATELIMIT_STORAGE_URI = os.environ.get('PYBINS_RATELIMIT_STORAGE_URI', 'memory://')
 
-app = Flask(__name__)
-limiter = Limiter( 
-    app = app,
-    key_func = get_remote_address,
-    default_limits = ["200 per day", "50 per hour"]
-)
+def _limit_breached(request_limit):
+    """Answer a breached rate limit like the other admission rejections."""
+    retry_after = max(int(math.ceil(request_limit.reset_at - time.time())), 1)
+    return rejection_response(429, 'rate_limit', f"Rate limit exceeded: {request_limit.limit}", retry_after)
 
-@app.before_request
-def before_request():
-    print(f"Request: {request.method} {request.path} from {request.remote_addr}")
+# Bound to the application in init_limiter(); limits are keyed by API key or client address
+limiter = Limiter(key_func=client_id, on_breach=_limit_breached)
+
+def init_limiter(app):
+    """Attach the limiter to app with defaults from the environment."""
+    app.config.setdefault('RATELIMIT_DEFAULT', RATELIMIT_DEFAULT)
+    app.config.setdefault('RATELIMIT_BUILD', RATELIMIT_BUILD)
+    app.config.setdefault('RATELIMIT_GC', RATELIMIT_GC)
+    app.config.setdefault('RATELIMIT_STORAGE_URI', RATELIMIT_STORAGE_URI)
+    limiter.init_app(app)
+    return app
+
+def _build_rate_limit():
+    from flask import current_app
+    return current_app.config.get('RATELIMIT_BUILD', RATELIMIT_BUILD)
 
 def rate_limit(f):
-    @wraps(f)
-    @limiter.limit("10 per minute")
-    def decorated_function(*args, **kwargs):
-        return f(*args, **kwargs)
-    return decorated_function
+    """Apply the build-submission rate limit (RATELIMIT_BUILD) to a view."""
+    return limiter.limit(_build_rate_limit)(f)
+
+def _gc_rate_limit():
+    from flask import current_app
+    return current_app.config.get('RATELIMIT_GC', RATELIMIT_GC)
 
-def fetch_cache(response):
-    # Placeholder for cache fetching logic
-    return None
+def gc_rate_limit(f):
+    """Apply the artifact-collection rate limit (RATELIMIT_GC) to a view; each call walks the artifacts tree."""
+    return limiter.limit(_gc_rate_limit)(f)
+
+def fetch_cache(key):
+    """Return a fresh cached metadata document for key, or None."""
+    return metadata_cache.get(key)
 
 def save_cache(key, response):
-    # Placeholder for cache saving logic
-    pass
+    """Store a metadata document (or a requests response) under key."""
+    if hasattr(response, 'json'):
+        return metadata_cache.store(key, response.json(),
+                                    etag=response.headers.get('ETag'),
+                                    last_modified=response.headers.get('Last-Modified'))
+    return metadata_cache.store(key, response)
 
 def normalize_tool_version(tool, version):
     tool = tool.lower()
@@ -66,22 +95,22 @@ def catch_errors(f):
     return decorated_function
 
 def compress_response(f):
+    """Compress a single view's response (create_app already does this app-wide)."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        response = f(*args, **kwargs)
-        response.headers['Content-Encoding'] = 'gzip'
-        return response
+        return compression.compress_response(make_response(f(*args, **kwargs)))
     return decorated_function
 
 def monitor_metrics(f):
+    """Record how long each call of f takes (exported at GET /metrics)."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Placeholder for metrics tracking logic
-        print("Metrics: Incrementing request count")
-        return f(*args, **kwargs)
+        with call_seconds.time(function=f.__name__):
+            return f(*args, **kwargs)
     return decorated_function
 
-def compress_package_data(data):
-    import gzip
-    return gzip.compress(data.encode('utf-8'))
+def compress_package_data(data, encoding='gzip'):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return compression.compress_bytes(data, encoding)
 
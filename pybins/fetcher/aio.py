@@ -0,0 +1,180 @@
+# Asyncio variant of the PyPI/GitHub metadata fetcher
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .client import get_client, POOL_MAXSIZE, RETRIES, BACKOFF_FACTOR, CONNECT_TIMEOUT, READ_TIMEOUT
+from .fetcher import (pypi_json_url, github_releases_url, cached_lookup, cached_response,
+                      pypi_package_info, github_package_info)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Upstream requests in flight at once, across every caller of the shared fetcher
+AIO_CONCURRENCY = int(os.environ.get('PYBINS_AIO_CONCURRENCY', 32))
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class AsyncFetcher:
+    """Fetch package metadata concurrently on an asyncio event loop.
+
+    Results are the same dicts as fetch_from_pypi/fetch_from_github and go
+    through the same metadata cache. A semaphore bounds the requests in
+    flight. With aiohttp installed all requests share one ClientSession
+    (one keep-alive pool per host); without it each request runs on the
+    pooled requests client in a worker thread, so the API is the same either
+    way. A fetcher belongs to the event loop it is first used on.
+    """
+
+    def __init__(self, concurrency=AIO_CONCURRENCY):
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._session = None
+        self._executor = None
+
+    def _limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=POOL_MAXSIZE),
+                timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+                headers={'User-Agent': 'pybins-fetcher'})
+        return self._session
+
+    async def _get(self, url, headers):
+        """GET url and return (status, data, etag, last_modified); data is only read on 200."""
+        if aiohttp is None:
+            def get():
+                response = get_client().get(url, headers=headers)
+                data = response.json() if response.status_code == 200 else None
+                return (response.status_code, data, response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+            if self._executor is None:
+                # The loop's default executor may have fewer threads than the semaphore allows
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix='pybins-aio-fetch')
+            return await asyncio.get_running_loop().run_in_executor(self._executor, get)
+        for attempt in range(RETRIES + 1):
+            try:
+                async with self._get_session().get(url, headers=headers) as response:
+                    if response.status in RETRY_STATUSES and attempt < RETRIES:
+                        raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+                    data = await response.json(content_type=None) if response.status == 200 else None
+                    return (response.status, data, response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= RETRIES:
+                    raise
+                await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+    async def fetch_json_cached(self, key, url):
+        """Async counterpart of fetcher.fetch_json_cached."""
+        entry, data, headers = cached_lookup(key)
+        if data is not None:
+            return data
+        async with self._limit():
+            status, data, etag, last_modified = await self._get(url, headers)
+        return cached_response(key, entry, status, data, etag=etag, last_modified=last_modified)
+
+    async def fetch_from_pypi(self, tool, version=None, target=None):
+        try:
+            data = await self.fetch_json_cached(f"pypi:{tool.lower()}", pypi_json_url(tool))
+            if data is None:
+                return None
+            return pypi_package_info(tool, data, version, target)
+        except Exception as e:
+            print(f"Error fetching from PyPI: {e}")
+            return None
+
+    async def fetch_from_github(self, repo, version=None):
+        try:
+            releases = await self.fetch_json_cached(f"github:{repo.lower()}", github_releases_url(repo))
+            return github_package_info(repo, releases, version)
+        except Exception as e:
+            print(f"Error fetching from GitHub: {e}")
+            return None
+
+    @staticmethod
+    async def _gather(calls, concurrency=None):
+        if not concurrency:
+            return await asyncio.gather(*(call() for call in calls))
+        # A per-call cap on top of the fetcher-wide one
+        limit = asyncio.Semaphore(concurrency)
+
+        async def limited(call):
+            async with limit:
+                return await call()
+        return await asyncio.gather(*(limited(call) for call in calls))
+
+    async def fetch_many_from_pypi(self, requests, concurrency=None):
+        """Look up many (tool, version, target) tuples at once; results line up with requests."""
+        return await self._gather([lambda r=request: self.fetch_from_pypi(*r) for request in requests],
+                                  concurrency)
+
+    async def fetch_many_from_github(self, requests, concurrency=None):
+        """Look up many (repo, version) tuples at once; results line up with requests."""
+        return await self._gather([lambda r=request: self.fetch_from_github(*r) for request in requests],
+                                  concurrency)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class _LoopThread:
+    """A private event loop on a daemon thread, so sync code can share one AsyncFetcher."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self.fetcher = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The loop thread does not survive fork; start a new one on next use
+        self._lock = threading.Lock()
+        self._loop = None
+        self.fetcher = None
+
+    def run(self, coro_fn):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self.fetcher = AsyncFetcher()
+                threading.Thread(target=self._loop.run_forever, name='pybins-aio', daemon=True).start()
+            loop, fetcher = self._loop, self.fetcher
+        return asyncio.run_coroutine_threadsafe(coro_fn(fetcher), loop).result()
+
+
+_loop_thread = _LoopThread()
+
+
+def _as_tuples(requests):
+    return [tuple(request) if isinstance(request, (list, tuple)) else (request,) for request in requests]
+
+
+def fetch_many_from_pypi(requests, concurrency=None):
+    """Sync wrapper: look up (tool[, version[, target]]) tuples concurrently from any thread."""
+    requests = _as_tuples(requests)
+    if not requests:
+        return []
+    return _loop_thread.run(lambda fetcher: fetcher.fetch_many_from_pypi(requests, concurrency))
+
+
+def fetch_many_from_github(requests, concurrency=None):
+    """Sync wrapper: look up (repo[, version]) tuples concurrently from any thread."""
+    requests = _as_tuples(requests)
+    if not requests:
+        return []
+    return _loop_thread.run(lambda fetcher: fetcher.fetch_many_from_github(requests, concurrency))
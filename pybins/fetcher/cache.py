@@ -0,0 +1,186 @@
+# Metadata cache for upstream (PyPI/GitHub) JSON lookups
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get('PYBINS_METADATA_CACHE_SIZE', 1024))
+DEFAULT_TTL = float(os.environ.get('PYBINS_METADATA_CACHE_TTL', 300))
+USE_REDIS = os.environ.get('PYBINS_METADATA_CACHE_REDIS', '').lower() in ('1', 'true', 'yes')
+
+
+class MetadataCache:
+    """Bounded LRU cache of upstream JSON documents with a TTL.
+
+    Each entry keeps the document together with the ETag/Last-Modified
+    validators it was served with, so a stale entry can be revalidated with a
+    conditional request instead of being downloaded again. When a Redis
+    connection is available, entries are written through to Redis so every
+    web and worker process shares the same warm cache. connect_redis, if
+    given, is called on first use to provide that connection.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 redis_conn=None, redis_prefix='pybins:meta:', connect_redis=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._redis_conn = redis_conn
+        self._connect_redis = connect_redis
+        self.redis_prefix = redis_prefix
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'revalidations': 0,
+            'not_modified': 0,
+            'updates': 0,
+            'evictions': 0,
+            'redis_hits': 0,
+            'redis_errors': 0,
+        }
+
+    @property
+    def redis_conn(self):
+        if self._redis_conn is None and self._connect_redis is not None:
+            connect, self._connect_redis = self._connect_redis, None
+            self._redis_conn = connect()
+        return self._redis_conn
+
+    def lookup(self, key):
+        """Return (entry, fresh) for key, or (None, False) when not cached."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._redis_get(key)
+            if entry is not None:
+                self._put(key, entry)
+        if entry is None:
+            self.count('misses')
+            return None, False
+        if now - entry['fetched_at'] < self.ttl:
+            self.count('hits')
+            return entry, True
+        self.count('stale')
+        return entry, False
+
+    def get(self, key):
+        """Return the cached document for key if it is still fresh."""
+        entry, fresh = self.lookup(key)
+        return entry['data'] if fresh else None
+
+    def store(self, key, data, etag=None, last_modified=None):
+        """Store a freshly downloaded document and its validators."""
+        entry = {
+            'data': data,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+        }
+        self._put(key, entry)
+        self._redis_set(key, entry)
+        return entry
+
+    def refresh(self, key, entry=None):
+        """Mark an entry as fresh again after a 304 Not Modified."""
+        with self._lock:
+            entry = self._entries.get(key, entry)
+            if entry is None:
+                return None
+            entry = dict(entry, fetched_at=time.time())
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        self._redis_set(key, entry)
+        return entry
+
+    def invalidate(self, key=None):
+        """Drop one entry, or the whole cache when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        if self.redis_conn is not None and key is not None:
+            try:
+                self.redis_conn.delete(self.redis_prefix + key)
+            except Exception as e:
+                self.count('redis_errors')
+                print(f"Error invalidating metadata cache in Redis: {e}")
+
+    def conditional_headers(self, entry):
+        """Build If-None-Match/If-Modified-Since headers for a cached entry."""
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        stats['shared'] = self.redis_conn is not None
+        lookups = stats['hits'] + stats['stale'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _redis_get(self, key):
+        if self.redis_conn is None:
+            return None
+        try:
+            raw = self.redis_conn.get(self.redis_prefix + key)
+        except Exception as e:
+            self.count('redis_errors')
+            print(f"Error reading metadata cache from Redis: {e}")
+            return None
+        if raw is None:
+            return None
+        self.count('redis_hits')
+        return json.loads(raw)
+
+    def _redis_set(self, key, entry):
+        if self.redis_conn is None:
+            return
+        try:
+            # Keep shared entries around past the TTL so they can still be
+            # revalidated with a conditional request.
+            self.redis_conn.set(self.redis_prefix + key, json.dumps(entry),
+                                ex=int(self.ttl * 10) or None)
+        except Exception as e:
+            self.count('redis_errors')
+            print(f"Error writing metadata cache to Redis: {e}")
+
+
+def _shared_redis():
+    if not USE_REDIS:
+        return None
+    try:
+        from ..queue.setup import get_redis
+        return get_redis()
+    except Exception as e:
+        print(f"Metadata cache falling back to in-memory only: {e}")
+        return None
+
+
+# Redis is only imported and connected once the cache is first used
+metadata_cache = MetadataCache(connect_redis=_shared_redis)
@@ -0,0 +1,145 @@
+# Shared, pooled HTTP client for the fetcher
+import os
+import threading
+
+POOL_CONNECTIONS = int(os.environ.get('PYBINS_HTTP_POOL_CONNECTIONS', 10))
+POOL_MAXSIZE = int(os.environ.get('PYBINS_HTTP_POOL_MAXSIZE', 20))
+RETRIES = int(os.environ.get('PYBINS_HTTP_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('PYBINS_HTTP_BACKOFF', 0.5))
+CONNECT_TIMEOUT = float(os.environ.get('PYBINS_HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('PYBINS_HTTP_READ_TIMEOUT', 10))
+
+
+def _tracking_adapter(**kwargs):
+    """An HTTPAdapter that remembers the per-host connection pools it sends through."""
+    from requests.adapters import HTTPAdapter
+
+    class TrackingAdapter(HTTPAdapter):
+        def __init__(self, **kwargs):
+            self.host_pools = {}
+            # Counts of pools the pool manager has since dropped, so totals never go backwards
+            self.retired = {'connections_opened': 0, 'requests': 0}
+            self.host_pools_lock = threading.Lock()
+            super().__init__(**kwargs)
+
+        def _track(self, pool):
+            key = f"{pool.scheme}://{pool.host}:{pool.port}"
+            with self.host_pools_lock:
+                previous = self.host_pools.get(key)
+                if previous is not pool:
+                    if previous is not None:
+                        self.retired['connections_opened'] += previous.num_connections
+                        self.retired['requests'] += previous.num_requests
+                    self.host_pools[key] = pool
+            return pool
+
+        def get_connection_with_tls_context(self, *args, **kwargs):
+            return self._track(super().get_connection_with_tls_context(*args, **kwargs))
+
+        def get_connection(self, *args, **kwargs):
+            # requests < 2.32.2 sends through this instead
+            return self._track(super().get_connection(*args, **kwargs))
+
+    return TrackingAdapter(**kwargs)
+
+
+class HTTPClient:
+    """Thread-safe wrapper around a keep-alive requests.Session.
+
+    The session mounts one HTTPAdapter per scheme; urllib3 keeps a separate
+    connection pool per host behind it, so PyPI, files.pythonhosted.org and
+    the GitHub API each get their own reusable connections. Idempotent
+    requests are retried with exponential backoff on connection errors and
+    5xx responses. requests is imported here rather than at module level
+    because it is the slowest import on the web process's startup path.
+    """
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 retries=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        import requests
+        from urllib3.util.retry import Retry
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        self.adapter = _tracking_adapter(pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize,
+                                         max_retries=retry,
+                                         pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['User-Agent'] = 'pybins-fetcher'
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def get(self, url, timeout=None, **kwargs):
+        """Issue a GET on the shared session.
+
+        A bare number for timeout is treated as the read timeout; the
+        connect timeout stays at its configured value.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (self.timeout[0], timeout)
+        with self._lock:
+            self._requests += 1
+        return self.session.get(url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """Report request, connection and reuse counts across all host pools."""
+        with self.adapter.host_pools_lock:
+            host_pools = list(self.adapter.host_pools.items())
+            opened = self.adapter.retired['connections_opened']
+            sent = self.adapter.retired['requests']
+        hosts = {}
+        for key, pool in host_pools:
+            hosts[key] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+            opened += pool.num_connections
+            sent += pool.num_requests
+        with self._lock:
+            requests_made = self._requests
+        return {
+            'requests': requests_made,
+            'connections_opened': opened,
+            'connections_reused': max(sent - opened, 0),
+            'hosts': hosts,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide HTTP client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HTTPClient()
+    return _client
+
+
+def reset_client():
+    """Drop the shared client, e.g. in a freshly forked worker process."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
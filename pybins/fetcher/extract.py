@@ -0,0 +1,202 @@
+# Streaming, path-safe extraction of source archives
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from .client import get_client
+from .source_cache import get_source_cache
+
+STREAM_EXTRACT = os.environ.get('PYBINS_STREAM_EXTRACT', '1').lower() not in ('0', 'false', 'no')
+
+TAR_MODES = (
+    (('.tar.gz', '.tgz'), 'r|gz'),
+    (('.tar.bz2', '.tbz2', '.tbz'), 'r|bz2'),
+    (('.tar.xz', '.txz'), 'r|xz'),
+    (('.tar',), 'r|'),
+)
+ZIP_SUFFIXES = ('.zip', '.whl')
+BUILD_MARKERS = ('setup.py', 'pyproject.toml')
+
+
+class UnsafeArchive(Exception):
+    pass
+
+
+def archive_kind(filename):
+    """Return ('tar', mode), ('zip', None) or (None, None) for a file name."""
+    name = filename.lower()
+    for suffixes, mode in TAR_MODES:
+        if name.endswith(suffixes):
+            return 'tar', mode
+    if name.endswith(ZIP_SUFFIXES):
+        return 'zip', None
+    return None, None
+
+
+class SourceTree:
+    """What was learned about an archive while extracting it.
+
+    build_root is the shallowest directory holding setup.py or
+    pyproject.toml, and main_scripts lists __main__.py files (shallowest
+    first), so callers never have to walk the tree afterwards.
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.build_root = None
+        self._build_depth = None
+        self.main_scripts = []
+        self.python_files = {}
+        self.files = 0
+        self.bytes = 0
+
+    def note(self, name, size):
+        self.files += 1
+        self.bytes += size
+        parts = name.split('/')
+        depth = len(parts)
+        base = parts[-1]
+        directory = os.path.join(self.dest, *parts[:-1])
+        # A marker deeper than the one already found can never win
+        if base in BUILD_MARKERS and (self._build_depth is None or depth < self._build_depth):
+            self.build_root = directory
+            self._build_depth = depth
+        if base == '__main__.py':
+            self.main_scripts.append((depth, os.path.join(self.dest, *parts)))
+        elif base.endswith('.py') and base not in self.python_files:
+            self.python_files[base] = os.path.join(self.dest, *parts)
+
+    def main_script(self, package_name=None):
+        """Pick the entry script: the shallowest __main__.py, else <package>.py."""
+        if self.main_scripts:
+            return min(self.main_scripts)[1]
+        if package_name:
+            return self.python_files.get(f'{package_name}.py')
+        return None
+
+
+def _member_name(name):
+    """Normalise an archive member name, rejecting ones that escape the destination."""
+    name = name.replace('\\', '/')
+    if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+        raise UnsafeArchive(f"Absolute path in archive: {name}")
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise UnsafeArchive(f"Path traversal in archive: {name}")
+    return '/'.join(parts)
+
+
+def _link_is_safe(member, name):
+    target = member.linkname.replace('\\', '/')
+    if target.startswith('/'):
+        return False
+    if member.issym():
+        base = name.split('/')[:-1]
+    else:
+        base = []
+    depth = len(base)
+    for part in target.split('/'):
+        if part == '..':
+            depth -= 1
+            if depth < 0:
+                return False
+        elif part not in ('', '.'):
+            depth += 1
+    return True
+
+
+def extract_tar_stream(fileobj, dest, mode='r|gz'):
+    """Extract a tar stream into dest in a single forward pass.
+
+    Only regular files, directories and links that stay inside dest are
+    extracted and devices and FIFOs are skipped. An escaping path or link
+    rejects the whole archive with UnsafeArchive rather than leaving a
+    partial tree behind.
+    """
+    os.makedirs(dest, exist_ok=True)
+    tree = SourceTree(dest)
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            name = _member_name(member.name)
+            if not name:
+                continue
+            if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+                continue
+            if (member.issym() or member.islnk()) and not _link_is_safe(member, name):
+                raise UnsafeArchive(f"Link escapes archive: {member.name} -> {member.linkname}")
+            member.name = name
+            try:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, dest, filter='data')
+                else:
+                    member.mode &= 0o755
+                    tar.extract(member, dest)
+            except getattr(tarfile, 'FilterError', ()) as e:
+                raise UnsafeArchive(f"Unsafe archive member {member.name}: {e}") from e
+            if member.isfile():
+                tree.note(name, member.size)
+    return tree
+
+
+def extract_zip(path, dest):
+    """Extract a zip (or wheel) archive into dest, rejecting unsafe names."""
+    os.makedirs(dest, exist_ok=True)
+    tree = SourceTree(dest)
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            name = _member_name(info.filename)
+            if not name:
+                continue
+            info.filename = name + ('/' if info.is_dir() else '')
+            zip_ref.extract(info, dest)
+            if not info.is_dir():
+                tree.note(name, info.file_size)
+    return tree
+
+
+def fetch_and_extract(url, dest, sha256=None, cache_root=None, filename=None):
+    """Download a source archive and extract it into dest.
+
+    Tar archives are decompressed and extracted straight off the HTTP
+    response; when a sha256 is known, the same bytes are hashed and saved into
+    the content-addressed cache as they pass through, so there is one network
+    read, one decompression pass and no second copy to re-open. Zip archives
+    need random access and are downloaded into the cache first, or without a
+    cache into a scratch directory next to dest that is removed afterwards.
+    """
+    filename = filename or url.split('/')[-1].split('#')[0]
+    kind, mode = archive_kind(filename)
+    if kind is None:
+        raise Exception("Unknown source archive format.")
+    cache = get_source_cache(cache_root) if sha256 and cache_root else None
+
+    if kind == 'zip':
+        if cache is not None:
+            path = cache.fetch(url, sha256, filename)
+            if not path:
+                raise Exception("Failed to download package source.")
+            return extract_zip(path, dest)
+        from .fetcher import download_package
+        parent = os.path.dirname(os.path.abspath(dest))
+        os.makedirs(parent, exist_ok=True)
+        # Keep the archive itself out of the extracted source tree
+        scratch = tempfile.mkdtemp(prefix='.download-', dir=parent)
+        try:
+            path = download_package(url, scratch)
+            if not path:
+                raise Exception("Failed to download package source.")
+            return extract_zip(path, dest)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    if cache is not None:
+        if not STREAM_EXTRACT:
+            with open(cache.fetch(url, sha256, filename), 'rb') as f:
+                return extract_tar_stream(f, dest, mode)
+        with cache.open_stream(url, sha256, filename) as stream:
+            return extract_tar_stream(stream, dest, mode)
+    with get_client().get(url, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        return extract_tar_stream(r.raw, dest, mode)
@@ -1,89 +1,184 @@
 # Pull Packages from PyPI/GitHub
-import requests
 from packaging import version
 import subprocess
 import os
 import shutil
+from .cache import metadata_cache
+from .client import get_client
+from .source_cache import get_source_cache
+from .selector import select_release_file
 
-def fetch_from_pypi(tool, version=None):
-    """Fetch package info from PyPI"""
-    url = f"https://pypi.org/pypi/{tool}/json"
-    try:
-        response = requests.get(url, timeout=10)
-        if response.status_code != 200:
-            return None
-        data = response.json()
-        
-        if version:
-            releases = data.get('releases', {})
-            if version in releases and releases[version]:
+# Upstream base URLs; point them at a mirror or a local stand-in server
+PYPI_URL = os.environ.get('PYBINS_PYPI_URL', 'https://pypi.org/pypi').rstrip('/')
+GITHUB_API_URL = os.environ.get('PYBINS_GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+
+def pypi_json_url(tool, version=None):
+    """URL of the PyPI JSON document for a project, or for one of its releases."""
+    if version:
+        return f"{PYPI_URL}/{tool}/{version}/json"
+    return f"{PYPI_URL}/{tool}/json"
+
+def github_releases_url(repo):
+    return f"{GITHUB_API_URL}/repos/{repo}/releases"
+
+def cached_lookup(key):
+    """First half of a cached fetch: returns (entry, fresh_data, conditional_headers)."""
+    entry, fresh = metadata_cache.lookup(key)
+    if fresh:
+        return entry, entry['data'], None
+    headers = metadata_cache.conditional_headers(entry)
+    if headers:
+        metadata_cache.count('revalidations')
+    return entry, None, headers
+
+def cached_response(key, entry, status_code, data=None, etag=None, last_modified=None):
+    """Second half of a cached fetch: record the upstream response and return the document."""
+    if status_code == 304 and entry:
+        metadata_cache.count('not_modified')
+        metadata_cache.refresh(key, entry)
+        return entry['data']
+    if status_code != 200:
+        return None
+    if entry:
+        metadata_cache.count('updates')
+    metadata_cache.store(key, data, etag=etag, last_modified=last_modified)
+    return data
+
+def fetch_json_cached(key, url, timeout=10):
+    """GET a JSON document through the metadata cache.
+
+    Fresh entries are served without touching the network; stale entries are
+    revalidated with If-None-Match/If-Modified-Since and only re-downloaded
+    when upstream reports a change. Returns None for non-200 responses.
+    """
+    entry, data, headers = cached_lookup(key)
+    if data is not None:
+        return data
+    response = get_client().get(url, headers=headers, timeout=timeout)
+    if response.status_code != 200:
+        return cached_response(key, entry, response.status_code)
+    return cached_response(key, entry, 200, response.json(),
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+
+def _release_file_fields(files, target=None):
+    """Choose the release file to build from and describe it.
+
+    selection is None when no wheel fits the target and there is no sdist.
+    """
+    chosen, selection = select_release_file(files, target)
+    if chosen is None:
+        chosen = files[-1]
+    return {
+        'url': chosen['url'],
+        'filename': chosen.get('filename'),
+        'sha256': chosen.get('digests', {}).get('sha256'),
+        'packagetype': chosen.get('packagetype'),
+        'selection': selection,
+    }
+
+def pypi_package_info(tool, data, version=None, target=None):
+    """Build the package info dict for tool from its PyPI JSON document."""
+    releases = data.get('releases', {})
+    if version:
+        if version in releases and releases[version]:
+            return {
+                'name': tool,
+                'version': version,
+                **_release_file_fields(releases[version], target),
+                'author': data['info'].get('author', 'Unknown'),
+                'description': data['info'].get('summary', 'No description'),
+                'package_url': data['info'].get('package_url', '')
+            }
+    else:
+        # Return latest version info
+        latest_version = data['info']['version']
+        if latest_version in releases and releases[latest_version]:
+            return {
+                'name': tool,
+                'version': latest_version,
+                **_release_file_fields(releases[latest_version], target),
+                'author': data['info'].get('author', 'Unknown'),
+                'description': data['info'].get('summary', 'No description'),
+                'package_url': data['info'].get('package_url', ''),
+                'installer_script': generate_installer_script(tool, latest_version)
+            }
+    return None
+
+def github_package_info(repo, releases, version=None):
+    """Build the package info dict for repo from its GitHub releases listing."""
+    if not releases:
+        return None
+    if version:
+        for release in releases:
+            if release['tag_name'] == version:
                 return {
-                    'name': tool,
+                    'name': repo.split('/')[-1],
                     'version': version,
-                    'url': releases[version][-1]['url'],
-                    'author': data['info'].get('author', 'Unknown'),
-                    'description': data['info'].get('summary', 'No description'),
-                    'package_url': data['info'].get('package_url', '')
-                }
-        else:
-            # Return latest version info
-            latest_version = data['info']['version']
-            releases = data.get('releases', {})
-            if latest_version in releases and releases[latest_version]:
-                return {
-                    'name': tool,
-                    'version': latest_version,
-                    'url': releases[latest_version][-1]['url'],
-                    'author': data['info'].get('author', 'Unknown'),
-                    'description': data['info'].get('summary', 'No description'),
-                    'package_url': data['info'].get('package_url', ''),
-                    'installer_script': generate_installer_script(tool, latest_version)
+                    'url': release['tarball_url'],
+                    'description': release.get('body', 'No description')
                 }
         return None
+    latest_release = releases[0]
+    return {
+        'name': repo.split('/')[-1],
+        'version': latest_release['tag_name'],
+        'url': latest_release['tarball_url'],
+        'description': latest_release.get('body', 'No description')
+    }
+
+def fetch_from_pypi(tool, version=None, target=None):
+    """Fetch package info from PyPI.
+
+    The returned 'url' points at the release file best suited to target
+    (see selector.select_release_file): a compatible wheel when one exists,
+    otherwise the sdist.
+    """
+    try:
+        data = fetch_json_cached(f"pypi:{tool.lower()}", pypi_json_url(tool))
+        if data is None:
+            return None
+        return pypi_package_info(tool, data, version, target)
     except Exception as e:
         print(f"Error fetching from PyPI: {e}")
         return None
 
+def fetch_release_files(tool):
+    """Return {version: [release files]} for every release of a PyPI project."""
+    data = fetch_json_cached(f"pypi:{tool.lower()}", pypi_json_url(tool))
+    if data is None:
+        return None
+    return data.get('releases', {})
+
+def fetch_requires_dist(tool, version):
+    """Return the Requires-Dist strings declared by one release (None if unknown)."""
+    data = fetch_json_cached(f"pypi:{tool.lower()}:{version}", pypi_json_url(tool, version))
+    if data is None:
+        return None
+    return data['info'].get('requires_dist') or []
+
 def fetch_from_github(repo, version=None):
     """Fetch package info from GitHub releases"""
-    api_url = f"https://api.github.com/repos/{repo}/releases"
     try:
-        response = requests.get(api_url, timeout=10)
-        if response.status_code != 200:
-            return None
-        releases = response.json()
-        if not releases:
-            return None
-            
-        if version:
-            for release in releases:
-                if release['tag_name'] == version:
-                    return {
-                        'name': repo.split('/')[-1],
-                        'version': version,
-                        'url': release['tarball_url'],
-                        'description': release.get('body', 'No description')
-                    }
-            return None
-        else:
-            latest_release = releases[0]
-            return {
-                'name': repo.split('/')[-1],
-                'version': latest_release['tag_name'],
-                'url': latest_release['tarball_url'],
-                'description': latest_release.get('body', 'No description')
-            }
+        releases = fetch_json_cached(f"github:{repo.lower()}", github_releases_url(repo))
+        return github_package_info(repo, releases, version)
     except Exception as e:
         print(f"Error fetching from GitHub: {e}")
         return None
 
-def download_package(url, dest_folder):
-    """Download package from URL"""
+def download_package(url, dest_folder, sha256=None):
+    """Download package from URL.
+
+    When the expected sha256 is known the file is served from the
+    content-addressed cache under <dest_folder>/cas, downloading it at most once.
+    """
     try:
+        if sha256:
+            return get_source_cache(os.path.join(dest_folder, 'cas')).fetch(url, sha256)
         local_filename = url.split('/')[-1]
         local_path = os.path.join(dest_folder, local_filename)
         
-        with requests.get(url, stream=True, timeout=30) as r:
+        with get_client().get(url, stream=True, timeout=30) as r:
             r.raise_for_status()
             with open(local_path, 'wb') as f:
                 shutil.copyfileobj(r.raw, f)
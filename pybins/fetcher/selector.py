@@ -0,0 +1,173 @@
+# Pick the best release file for a build target
+import re
+import sys
+from packaging import tags
+from packaging.markers import default_environment
+from packaging.specifiers import SpecifierSet, InvalidSpecifier
+from packaging.utils import parse_wheel_filename, InvalidWheelFilename
+
+
+TARGET_KEYS = ('python_version', 'platform')
+_PYTHON_VERSION_RE = re.compile(r'^3\.\d{1,2}$')
+_PLATFORM_RE = re.compile(r'^[a-z0-9_]+$')
+
+
+class TargetError(ValueError):
+    pass
+
+
+def parse_target(target):
+    """Validate a build target from a request; returns it normalised, or None for no target.
+
+    A target is an object with an optional 'python_version' ("3.11") and
+    an optional 'platform' (a platform tag or a non-empty list of them).
+    Raises TargetError when it is anything else.
+    """
+    if target is None:
+        return None
+    if not isinstance(target, dict):
+        raise TargetError('target must be an object with python_version and/or platform')
+    unknown = sorted(set(target) - set(TARGET_KEYS))
+    if unknown:
+        raise TargetError(f"Unknown target keys: {', '.join(unknown)} (expected {', '.join(TARGET_KEYS)})")
+    parsed = {}
+    python_version = target.get('python_version')
+    if python_version is not None:
+        if not isinstance(python_version, str) or not _PYTHON_VERSION_RE.match(python_version):
+            raise TargetError(f'target python_version must be a string like "3.11", not {python_version!r}')
+        parsed['python_version'] = python_version
+    platform = target.get('platform')
+    if platform is not None:
+        platforms = [platform] if isinstance(platform, str) else platform
+        if (not isinstance(platforms, list) or not platforms
+                or not all(isinstance(tag, str) and _PLATFORM_RE.match(tag) for tag in platforms)):
+            raise TargetError('target platform must be a platform tag such as "manylinux_2_17_x86_64", '
+                              'or a non-empty list of them')
+        parsed['platform'] = platform
+    return parsed or None
+
+
+def target_tags(target=None):
+    """Return the supported tags for a build target, most preferred first.
+
+    target is an optional dict with 'python_version' (e.g. "3.11") and
+    'platform' (a platform tag or list of them, e.g. "manylinux_2_17_x86_64").
+    Without a target the tags of the running interpreter are used.
+    """
+    target = target or {}
+    python_version = target.get('python_version')
+    platforms = target.get('platform')
+    if not python_version and not platforms:
+        return list(tags.sys_tags())
+    if isinstance(platforms, str):
+        platforms = [platforms]
+    if python_version:
+        py = tuple(int(part) for part in str(python_version).split('.')[:2])
+    else:
+        py = sys.version_info[:2]
+    supported = list(tags.cpython_tags(py, platforms=platforms))
+    supported += list(tags.compatible_tags(py, f"cp{py[0]}{py[1]}", platforms))
+    return supported
+
+
+def target_python(target=None):
+    """Return the target Python version as a string, e.g. "3.11"."""
+    if target and target.get('python_version'):
+        return str(target['python_version'])
+    return f"{sys.version_info[0]}.{sys.version_info[1]}"
+
+
+# Platform tag prefix -> (sys_platform, platform_system)
+_PLATFORM_SYSTEMS = (
+    ('manylinux', 'linux', 'Linux'),
+    ('musllinux', 'linux', 'Linux'),
+    ('linux', 'linux', 'Linux'),
+    ('macosx', 'darwin', 'Darwin'),
+    ('win', 'win32', 'Windows'),
+)
+_WINDOWS_MACHINES = {'win32': 'x86', 'win_amd64': 'AMD64', 'win_arm64': 'ARM64'}
+
+
+def marker_environment(target=None):
+    """Return the PEP 508 marker environment of a build target.
+
+    Starts from the running interpreter and overrides the Python version
+    and, when the target names a platform tag, the platform markers.
+    """
+    env = default_environment()
+    if target and target.get('python_version'):
+        python_version = target_python(target)
+        env['python_version'] = python_version
+        env['python_full_version'] = python_version + '.0'
+    platforms = (target or {}).get('platform')
+    if isinstance(platforms, (list, tuple)):
+        platforms = platforms[0] if platforms else None
+    if platforms:
+        platform = str(platforms)
+        for prefix, sys_platform, system in _PLATFORM_SYSTEMS:
+            if platform.startswith(prefix):
+                env['sys_platform'] = sys_platform
+                env['platform_system'] = system
+                env['os_name'] = 'nt' if system == 'Windows' else 'posix'
+                break
+        if platform in _WINDOWS_MACHINES:
+            env['platform_machine'] = _WINDOWS_MACHINES[platform]
+        else:
+            # e.g. manylinux_2_17_x86_64, macosx_11_0_arm64
+            for machine in ('x86_64', 'aarch64', 'arm64', 'i686', 'ppc64le', 's390x', 'armv7l'):
+                if platform.endswith(machine):
+                    env['platform_machine'] = machine
+                    break
+    return env
+
+
+def _python_ok(file_info, python_version):
+    requires_python = file_info.get('requires_python')
+    if not requires_python:
+        return True
+    try:
+        return SpecifierSet(requires_python).contains(python_version + '.0', prereleases=True)
+    except InvalidSpecifier:
+        return True
+
+
+def select_release_file(files, target=None):
+    """Rank a release's files against target and return (file, selection).
+
+    A compatible wheel is preferred (the better its best tag ranks, the
+    better); otherwise the sdist is used so the package can be built from
+    source. selection describes the path taken: 'prebuilt_wheel' or 'sdist',
+    plus the matched tag. Returns (None, None) when nothing is usable.
+    """
+    supported = target_tags(target)
+    priority = {tag: rank for rank, tag in enumerate(supported)}
+    python_version = target_python(target)
+    best = None
+    best_rank = None
+    best_selection = None
+    for file_info in files:
+        filename = file_info.get('filename') or file_info.get('url', '').split('/')[-1]
+        if not _python_ok(file_info, python_version):
+            continue
+        # Yanked files are only used when nothing else fits.
+        yanked = 1 if file_info.get('yanked') else 0
+        if filename.endswith('.whl'):
+            try:
+                _, _, _, file_tags = parse_wheel_filename(filename)
+            except InvalidWheelFilename:
+                continue
+            ranks = [priority[tag] for tag in file_tags if tag in priority]
+            if not ranks:
+                continue
+            rank = (yanked, 0, min(ranks))
+            selection = {'build_path': 'prebuilt_wheel',
+                         'tag': str(supported[min(ranks)])}
+        elif file_info.get('packagetype') == 'sdist' or filename.endswith(('.tar.gz', '.tgz', '.zip')):
+            # Prefer .tar.gz sdists over legacy .zip ones
+            rank = (yanked, 1, 0 if filename.endswith(('.tar.gz', '.tgz')) else 1)
+            selection = {'build_path': 'sdist', 'tag': None}
+        else:
+            continue
+        if best_rank is None or rank < best_rank:
+            best, best_rank, best_selection = file_info, rank, selection
+    return best, best_selection
@@ -0,0 +1,214 @@
+# Content-addressed cache for downloaded source distributions
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from .client import get_client
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DigestMismatch(Exception):
+    pass
+
+
+class _HashingReader:
+    """File-like wrapper that hashes and copies everything read through it."""
+
+    def __init__(self, raw, sink):
+        self.raw = raw
+        self.sink = sink
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        if data:
+            self.hasher.update(data)
+            self.sink.write(data)
+            self.size += len(data)
+        return data
+
+    def drain(self):
+        """Consume whatever the reader did not need (e.g. tar end padding)."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class SourceCache:
+    """Store downloads under their sha256 digest.
+
+    Files live at <root>/<aa>/<digest>/<filename>. A download is streamed into
+    a private .part file while it is hashed, and is only renamed into place
+    after the digest matches, so a partial or corrupt file can never be
+    returned as a cache hit. Concurrent fetches of the same digest (threads or
+    processes) wait on a per-digest lock and share the first download.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'shared': 0, 'bytes_downloaded': 0, 'corrupt': 0}
+
+    def path_for(self, sha256, filename):
+        sha256 = sha256.lower()
+        return os.path.join(self.root, sha256[:2], sha256, filename)
+
+    def get(self, sha256, filename):
+        """Return the cached path for a digest, or None when not cached."""
+        path = self.path_for(sha256, filename)
+        if os.path.isfile(path):
+            self._touch(path)
+            return path
+        return None
+
+    def fetch(self, url, sha256, filename=None):
+        """Return a local path for url, downloading it only on a cache miss."""
+        filename = filename or url.split('/')[-1].split('#')[0]
+        path = self.get(sha256, filename)
+        if path:
+            self._count('hits')
+            return path
+        with self._digest_lock(sha256):
+            # Another thread or process may have finished the download while we waited.
+            path = self.get(sha256, filename)
+            if path:
+                self._count('shared')
+                return path
+            self._count('misses')
+            return self._download(url, sha256, filename)
+
+    @contextmanager
+    def open_stream(self, url, sha256, filename=None):
+        """Yield a readable stream of the file, filling the cache as it is read.
+
+        On a hit the cached file is opened. On a miss the HTTP body is passed
+        through to the caller while being hashed and written to a .part file;
+        once the caller is done the rest of the body is drained, the digest is
+        checked and only then is the file moved into the cache. If the digest
+        does not match, DigestMismatch is raised after the caller has
+        consumed the data, so anything derived from it must be discarded.
+        """
+        filename = filename or url.split('/')[-1].split('#')[0]
+        path = self.get(sha256, filename)
+        if path:
+            self._count('hits')
+            with open(path, 'rb') as f:
+                yield f
+            return
+        with self._digest_lock(sha256):
+            path = self.get(sha256, filename)
+            if path:
+                self._count('shared')
+                with open(path, 'rb') as f:
+                    yield f
+                return
+            self._count('misses')
+            path = self.path_for(sha256, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+            try:
+                with get_client().get(url, stream=True, timeout=30) as r:
+                    r.raise_for_status()
+                    r.raw.decode_content = True
+                    with open(part_path, 'wb') as f:
+                        reader = _HashingReader(r.raw, f)
+                        yield reader
+                        reader.drain()
+                        f.flush()
+                        os.fsync(f.fileno())
+                if reader.hasher.hexdigest() != sha256.lower():
+                    self._count('corrupt')
+                    raise DigestMismatch(
+                        f"sha256 mismatch for {filename}: expected {sha256}, got {reader.hasher.hexdigest()}")
+                os.replace(part_path, path)
+                self._count('bytes_downloaded', reader.size)
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+    def stats(self):
+        with self._locks_guard:
+            return dict(self._counters)
+
+    def _download(self, url, sha256, filename):
+        path = self.path_for(sha256, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with get_client().get(url, stream=True, timeout=30) as r:
+                r.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        hasher.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+            if hasher.hexdigest() != sha256.lower():
+                self._count('corrupt')
+                raise DigestMismatch(
+                    f"sha256 mismatch for {filename}: expected {sha256}, got {hasher.hexdigest()}")
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        self._count('bytes_downloaded', size)
+        return path
+
+    @contextmanager
+    def _digest_lock(self, sha256):
+        # Each entry is [lock, users]; the last user out removes it
+        with self._locks_guard:
+            entry = self._locks.setdefault(sha256, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if fcntl is None:
+                    yield
+                    return
+                lock_dir = os.path.join(self.root, sha256[:2])
+                os.makedirs(lock_dir, exist_ok=True)
+                with open(os.path.join(lock_dir, f"{sha256}.lock"), 'w') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[sha256]
+
+    def _touch(self, path):
+        # Record the access time explicitly; many filesystems mount with noatime.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _count(self, counter, amount=1):
+        with self._locks_guard:
+            self._counters[counter] += amount
+
+
+_caches = {}
+_caches_guard = threading.Lock()
+
+
+def get_source_cache(root):
+    """Return the shared SourceCache for root."""
+    root = os.path.abspath(root)
+    with _caches_guard:
+        if root not in _caches:
+            _caches[root] = SourceCache(root)
+        return _caches[root]
@@ -0,0 +1,379 @@
+# Lightweight multiprocess metrics exported in Prometheus text format
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+METRICS_DIR = os.environ.get(
+    'PYBINS_METRICS_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts/metrics'))
+)
+# Seconds between writes of this process's snapshot file
+FLUSH_INTERVAL = float(os.environ.get('PYBINS_METRICS_FLUSH_INTERVAL', 1.0))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+ARCHIVE_FILE = 'archive.json'
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text):
+        self._registry = registry
+        self.name = name
+        self.help = help_text
+        self._values = {}
+
+    def _changed(self):
+        self._registry.changed()
+
+
+class Counter(_Metric):
+    """A value that only goes up (summed across processes)."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+
+class Gauge(_Metric):
+    """A value that goes up and down (summed across live processes)."""
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._registry.lock:
+            self._values[_label_key(labels)] = value
+        self._changed()
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, Prometheus style."""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._registry.lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+        self._changed()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the enclosed block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class MetricsRegistry:
+    """Metrics for this process plus aggregation across processes.
+
+    Each process periodically writes its cumulative values to
+    <directory>/<host>-<pid>.json; a scrape merges the files of every
+    process. Counters and histograms of processes that have exited are
+    folded into an archive file so totals never go backwards, while their
+    gauges (e.g. in-flight builds) are dropped. A forked child starts from
+    zero so RQ work horses do not double-count their parent's values.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+        self._timer = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def counter(self, name, help_text):
+        return self._register(Counter(self, name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge(self, name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help_text, buckets))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collect):
+        """Register collect() -> [(name, kind, help, [(labels, value), ...])] evaluated at scrape time."""
+        self._collectors.append(collect)
+
+    # Snapshot files
+
+    def _own_file(self):
+        return os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}.json")
+
+    def _reset_after_fork(self):
+        self.lock = threading.Lock()
+        self._timer = None
+        for metric in self._metrics.values():
+            metric._values = {}
+
+    def changed(self):
+        """Schedule a snapshot write; several changes within the interval share one write."""
+        with self.lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {
+                    'kind': metric.kind,
+                    'help': metric.help,
+                    'buckets': list(getattr(metric, 'buckets', ())),
+                    'values': [[list(map(list, key)), value] for key, value in metric._values.items()],
+                }
+                for name, metric in self._metrics.items()
+            }
+
+    def flush(self):
+        """Write this process's cumulative values to its snapshot file now."""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._own_file()
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'metrics': self.snapshot()}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing metrics snapshot: {e}")
+
+    # Aggregation
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _merge(total, metrics, include_gauges=True):
+        for name, data in metrics.items():
+            if data['kind'] == 'gauge' and not include_gauges:
+                continue
+            merged = total.setdefault(name, {'kind': data['kind'], 'help': data['help'],
+                                             'buckets': data['buckets'], 'values': {}})
+            for key, value in data['values']:
+                key = tuple(map(tuple, key))
+                if data['kind'] == 'histogram':
+                    current = merged['values'].get(key)
+                    if current is None or len(current[0]) != len(value[0]):
+                        merged['values'][key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+                else:
+                    merged['values'][key] = merged['values'].get(key, 0) + value
+        return total
+
+    @staticmethod
+    def _unmerge(total):
+        return {name: dict(data, values=[[list(map(list, key)), value] for key, value in data['values'].items()])
+                for name, data in total.items()}
+
+    def collect(self):
+        """Merge the snapshots of all processes (this one included)."""
+        self.flush()
+        host = socket.gethostname()
+        total = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        with open(os.path.join(self.directory, '.lock'), 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+                archive = self._load(archive_path) or {'metrics': {}}
+                archived = {}
+                self._merge(archived, archive['metrics'])
+                dead = []
+                for name in names:
+                    if not name.endswith('.json') or name == ARCHIVE_FILE:
+                        continue
+                    path = os.path.join(self.directory, name)
+                    data = self._load(path)
+                    if data is None:
+                        continue
+                    # Only processes on this host can be checked for liveness
+                    if data.get('host') == host and not self._alive(data.get('pid', 0)):
+                        self._merge(archived, data['metrics'], include_gauges=False)
+                        dead.append(path)
+                        continue
+                    self._merge(total, data['metrics'])
+                if dead:
+                    tmp_path = f"{archive_path}.tmp"
+                    with open(tmp_path, 'w') as f:
+                        json.dump({'metrics': self._unmerge(archived)}, f)
+                    os.replace(tmp_path, archive_path)
+                    for path in dead:
+                        os.remove(path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return self._merge(total, self._unmerge(archived))
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, data in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {data['help']}")
+            lines.append(f"# TYPE {name} {data['kind']}")
+            for key, value in sorted(data['values'].items()):
+                if data['kind'] != 'histogram':
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(data['buckets'], counts):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(_label_key(labels))} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+build_stage_seconds = registry.histogram(
+    'pybins_build_stage_seconds', 'Time spent in each build stage', STAGE_BUCKETS)
+build_duration_seconds = registry.histogram(
+    'pybins_build_duration_seconds', 'Total build time by outcome', STAGE_BUCKETS)
+builds_total = registry.counter('pybins_builds_total', 'Finished builds by outcome')
+builds_in_progress = registry.gauge('pybins_builds_in_progress', 'Builds currently running')
+http_request_seconds = registry.histogram(
+    'pybins_http_request_duration_seconds', 'HTTP request latency by route')
+call_seconds = registry.histogram(
+    'pybins_call_duration_seconds', 'Duration of functions wrapped with monitor_metrics')
+
+
+@contextmanager
+def build_stage(build_type, stage):
+    """Time one stage of a build into pybins_build_stage_seconds."""
+    with build_stage_seconds.time(build_type=build_type, stage=stage):
+        yield
+
+
+def init_metrics(app):
+    """Record per-route request latency for a Flask app."""
+    from flask import request, g
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        start = getattr(g, '_metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - start, method=request.method,
+                                         route=route, status=response.status_code)
+        return response
+
+    return app
@@ -0,0 +1,341 @@
+# Build priorities and weighted fair scheduling of queued builds across tenants
+import hashlib
+import heapq
+import math
+import os
+import threading
+
+PRIORITIES = ('interactive', 'ci', 'bulk')
+DEFAULT_PRIORITY = 'interactive'
+ACTIVE_JOB_STATUSES = ('queued', 'started', 'deferred', 'scheduled')
+
+
+def parse_weights(value):
+    """Parse 'name=weight,name=weight' into a dict of positive floats."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, sep, weight = item.rpartition('=')
+        if not sep or not name or float(weight) <= 0:
+            raise ValueError(f"Invalid weight: {item}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+# Share of the workers each priority gets while several have builds waiting
+PRIORITY_WEIGHTS = dict({'interactive': 16, 'ci': 4, 'bulk': 1},
+                        **parse_weights(os.environ.get('PYBINS_PRIORITY_WEIGHTS')))
+# Tenants (client ids as shown by GET /queue) that get more than an equal share
+TENANT_WEIGHTS = parse_weights(os.environ.get('PYBINS_TENANT_WEIGHTS'))
+BATCH_PRIORITY = os.environ.get('PYBINS_BATCH_PRIORITY', 'bulk')
+# Builds handed to the workers ahead of time; the rest wait in fair order
+READY_DEPTH = int(os.environ.get('PYBINS_QUEUE_READY_DEPTH', 1))
+# Seconds a held RQ job stays findable by its build id, for cancellation
+BUILD_KEY_TTL = 24 * 3600
+
+
+class PriorityError(ValueError):
+    pass
+
+
+def parse_priority(value, default=DEFAULT_PRIORITY):
+    """Validate a requested priority; None means default."""
+    priority = value or default
+    if priority not in PRIORITIES:
+        raise PriorityError(f"Unknown priority: {priority} (expected one of {', '.join(PRIORITIES)})")
+    return priority
+
+
+def tenant_weight(tenant):
+    return TENANT_WEIGHTS.get(tenant, 1.0)
+
+
+def job_id_for(key):
+    """Deterministic job id of a build key, so identical enqueues collapse into one job."""
+    return 'build-' + hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+
+
+class FairQueue:
+    """Held jobs of one process, released in weighted fair order.
+
+    Within a priority, tenants share the workers by start-time fair
+    queuing: a job's start tag is the later of the priority's virtual clock
+    and its tenant's previous finish tag, and each job advances its
+    tenant's finish tag by 1/weight. A tenant that submits 500 builds gets
+    tags 1..500, so a single build from another tenant is tagged at the
+    current clock and goes next. Across priorities, stride scheduling hands
+    out slots in proportion to PRIORITY_WEIGHTS among the priorities that
+    have work, so bulk builds still progress under a stream of interactive
+    ones. RedisFairQueue implements the same scheme for RQ.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or PRIORITY_WEIGHTS
+        self._lock = threading.Lock()
+        self._heaps = {priority: [] for priority in PRIORITIES}
+        self._items = {}
+        self._finish = {priority: {} for priority in PRIORITIES}
+        self._vclock = dict.fromkeys(PRIORITIES, 0.0)
+        self._pass = dict.fromkeys(PRIORITIES, 0.0)
+        self._vpass = 0.0
+        self._seq = 0
+
+    def _start(self, priority, tenant):
+        return max(self._vclock[priority], self._finish[priority].get(tenant, 0.0))
+
+    def push(self, priority, tenant, job_id, item):
+        """Hold item until it is released; returns False if job_id is already held."""
+        with self._lock:
+            if job_id in self._items:
+                return False
+            start = self._start(priority, tenant)
+            self._finish[priority][tenant] = start + 1 / tenant_weight(tenant)
+            self._seq += 1
+            heapq.heappush(self._heaps[priority], (start, self._seq, job_id))
+            self._items[job_id] = (priority, tenant, start, item)
+            return True
+
+    def _live_top(self, priority):
+        heap = self._heaps[priority]
+        while heap and heap[0][2] not in self._items:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def pop(self):
+        """Release the next job in fair order; returns (priority, tenant, start, item) or None."""
+        with self._lock:
+            best = None
+            for priority in PRIORITIES:
+                if self._live_top(priority) is not None:
+                    stride_pass = max(self._pass[priority], self._vpass)
+                    if best is None or stride_pass < best[1]:
+                        best = (priority, stride_pass)
+            if best is None:
+                return None
+            priority, stride_pass = best
+            start, _, job_id = heapq.heappop(self._heaps[priority])
+            _, tenant, _, item = self._items.pop(job_id)
+            self._vclock[priority] = start
+            self._vpass = stride_pass
+            self._pass[priority] = stride_pass + 1 / self.weights[priority]
+            return priority, tenant, start, item
+
+    def requeue(self, priority, tenant, start, job_id, item):
+        """Put back a job pop() returned but that could not run, at its original start tag.
+
+        Its tenant is not charged again, and the slot pop() charged its
+        priority is given back.
+        """
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._heaps[priority], (start, self._seq, job_id))
+            self._items[job_id] = (priority, tenant, start, item)
+            self._pass[priority] -= 1 / self.weights[priority]
+
+    def get(self, job_id):
+        with self._lock:
+            held = self._items.get(job_id)
+        return held[3] if held else None
+
+    def remove(self, job_id):
+        """Drop a held job; returns its item, or None if it is not held."""
+        with self._lock:
+            held = self._items.pop(job_id, None)
+        return held[3] if held else None
+
+    def snapshot(self, tenant=None):
+        """Per priority: held jobs, tenants with held jobs, and for tenant its own jobs and
+        the held jobs a new job of its would wait behind."""
+        with self._lock:
+            stats = {priority: {'queued': 0, 'tenants': set(), 'yours': 0, 'ahead': 0}
+                     for priority in PRIORITIES}
+            starts = {priority: self._start(priority, tenant) for priority in PRIORITIES}
+            for priority, owner, start, _ in self._items.values():
+                entry = stats[priority]
+                entry['queued'] += 1
+                entry['tenants'].add(owner)
+                entry['yours'] += owner == tenant
+                entry['ahead'] += start <= starts[priority]
+        for entry in stats.values():
+            entry['tenants'] = len(entry['tenants'])
+        return stats
+
+
+# KEYS: pending zset, job -> tenant hash, tenant -> held count hash, tenant -> finish tag hash,
+#       state hash, RQ job hash, optionally the build id -> job id key
+# ARGV: job id, tenant, cost (1/weight), priority, build key TTL, then the job hash as field, value, ...
+PUSH_SCRIPT = """
+local status = redis.call('HGET', KEYS[6], 'status')
+if status == 'queued' or status == 'started' or status == 'deferred' or status == 'scheduled' then
+    return 0
+end
+redis.call('DEL', KEYS[6])
+redis.call('HSET', KEYS[6], unpack(ARGV, 6))
+if KEYS[7] then
+    redis.call('SET', KEYS[7], ARGV[1], 'EX', tonumber(ARGV[5]))
+end
+local start = math.max(tonumber(redis.call('HGET', KEYS[5], 'vclock:' .. ARGV[4]) or '0'),
+                       tonumber(redis.call('HGET', KEYS[4], ARGV[2]) or '0'))
+redis.call('HSET', KEYS[4], ARGV[2], tostring(start + tonumber(ARGV[3])))
+redis.call('ZADD', KEYS[1], start, ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+return 1
+"""
+
+# KEYS: state hash, then per priority: pending zset, job -> tenant hash, tenant -> held count hash,
+#       RQ queue list
+# ARGV: ready depth, number of priorities, their weights, their names
+RELEASE_SCRIPT = """
+local n = tonumber(ARGV[2])
+local ready = 0
+for i = 1, n do
+    ready = ready + redis.call('LLEN', KEYS[1 + (i - 1) * 4 + 4])
+end
+local vpass = tonumber(redis.call('HGET', KEYS[1], 'vpass') or '0')
+local released = {}
+while ready < tonumber(ARGV[1]) do
+    local best, best_pass = nil, nil
+    for i = 1, n do
+        if redis.call('ZCARD', KEYS[1 + (i - 1) * 4 + 1]) > 0 then
+            local p = math.max(tonumber(redis.call('HGET', KEYS[1], 'pass:' .. ARGV[2 + n + i]) or '0'), vpass)
+            if best == nil or p < best_pass then
+                best, best_pass = i, p
+            end
+        end
+    end
+    if best == nil then
+        break
+    end
+    local base = 1 + (best - 1) * 4
+    local name = ARGV[2 + n + best]
+    local popped = redis.call('ZPOPMIN', KEYS[base + 1])
+    local job_id = popped[1]
+    local tenant = redis.call('HGET', KEYS[base + 2], job_id)
+    redis.call('HDEL', KEYS[base + 2], job_id)
+    if tenant and redis.call('HINCRBY', KEYS[base + 3], tenant, -1) <= 0 then
+        redis.call('HDEL', KEYS[base + 3], tenant)
+    end
+    redis.call('HSET', KEYS[1], 'vclock:' .. name, popped[2])
+    redis.call('HSET', KEYS[1], 'pass:' .. name, tostring(best_pass + 1 / tonumber(ARGV[2 + best])))
+    vpass = best_pass
+    redis.call('RPUSH', KEYS[base + 4], job_id)
+    ready = ready + 1
+    table.insert(released, job_id)
+end
+redis.call('HSET', KEYS[1], 'vpass', tostring(vpass))
+return released
+"""
+
+
+class RedisFairQueue:
+    """FairQueue's scheduling, kept in Redis so every web process and worker shares it.
+
+    Held jobs are saved as regular RQ jobs with status queued, but their ids
+    wait in a per-priority sorted set scored by start tag instead of on the
+    RQ queue. release() moves them onto the RQ queues, in fair order, only
+    while fewer than ready_depth jobs are waiting there, so the order is
+    decided when a worker frees up rather than when the job was submitted.
+    """
+
+    def __init__(self, connection, weights=None, ready_depth=READY_DEPTH, prefix='pybins:fair:'):
+        self.connection = connection
+        self.weights = weights or PRIORITY_WEIGHTS
+        self.ready_depth = ready_depth
+        self.prefix = prefix
+        self._push = connection.register_script(PUSH_SCRIPT)
+        self._release = connection.register_script(RELEASE_SCRIPT)
+
+    def _keys(self, priority):
+        return [f"{self.prefix}{priority}:{part}" for part in ('pending', 'tenant', 'held', 'finish')]
+
+    def _build_key(self, build_id):
+        return f"{self.prefix}build:{build_id}"
+
+    def push(self, priority, tenant, job_id, job_key, fields, build_id=None, client=None):
+        """Save the job hash and hold the job, atomically; False if the job is already active.
+
+        With build_id, the job can be found by job_for_build() for a day.
+        client may be a pipeline, in which case the result comes from its execute().
+        """
+        pending, tenants, held, finish = self._keys(priority)
+        keys = [pending, tenants, held, finish, self.prefix + 'state', job_key]
+        if build_id:
+            keys.append(self._build_key(build_id))
+        return self._push(keys=keys,
+                          args=[job_id, tenant, 1 / tenant_weight(tenant), priority, BUILD_KEY_TTL] + fields,
+                          client=client)
+
+    def job_for_build(self, build_id):
+        """The id of the job last pushed for build_id, or None."""
+        job_id = self.connection.get(self._build_key(build_id))
+        return job_id.decode() if isinstance(job_id, bytes) else job_id
+
+    def release(self, ready_keys):
+        """Move held jobs onto the RQ queues (ready_keys: {priority: list key}); returns their ids."""
+        keys = [self.prefix + 'state']
+        for priority in PRIORITIES:
+            keys += self._keys(priority)[:3] + [ready_keys[priority]]
+        args = [self.ready_depth, len(PRIORITIES)] + [self.weights[p] for p in PRIORITIES] + list(PRIORITIES)
+        return [job_id.decode() if isinstance(job_id, bytes) else job_id
+                for job_id in self._release(keys=keys, args=args)]
+
+    def remove(self, priority, job_id):
+        """Stop holding job_id; returns whether it was held.
+
+        The tenant's finish tag is left alone: its next job is still tagged
+        after the removed one.
+        """
+        pending, tenants, held, _ = self._keys(priority)
+        tenant = self.connection.hget(tenants, job_id)
+        removed = self.connection.zrem(pending, job_id)
+        if removed and tenant is not None:
+            self.connection.hdel(tenants, job_id)
+            if self.connection.hincrby(held, tenant, -1) <= 0:
+                self.connection.hdel(held, tenant)
+        return bool(removed)
+
+    def snapshot(self, tenant=None):
+        """Same shape as FairQueue.snapshot(), in two round trips."""
+        state = self.prefix + 'state'
+        with self.connection.pipeline() as pipe:
+            for priority in PRIORITIES:
+                pending, _, held, finish = self._keys(priority)
+                pipe.zcard(pending)
+                pipe.hlen(held)
+                pipe.hget(held, tenant or '')
+                pipe.hget(state, f"vclock:{priority}")
+                pipe.hget(finish, tenant or '')
+            values = pipe.execute()
+        stats = {}
+        starts = {}
+        for index, priority in enumerate(PRIORITIES):
+            queued, tenants, yours, vclock, finished = values[index * 5:index * 5 + 5]
+            stats[priority] = {'queued': queued, 'tenants': tenants, 'yours': int(yours or 0)}
+            starts[priority] = max(float(vclock or 0), float(finished or 0))
+        with self.connection.pipeline() as pipe:
+            for priority in PRIORITIES:
+                pipe.zcount(self._keys(priority)[0], '-inf', starts[priority])
+            for priority, ahead in zip(PRIORITIES, pipe.execute()):
+                stats[priority]['ahead'] = ahead
+        return stats
+
+
+def estimate_waits(snapshot, build_seconds, workers):
+    """Add each priority's weight and estimated wait for a new build of the caller.
+
+    snapshot is a backend's snapshot(): per priority its queued (held), ready
+    and ahead counts. A new build waits for the ready builds, the held builds
+    of its priority tagged before it, and the builds other priorities are
+    given meanwhile in proportion to their weights.
+    """
+    priorities = snapshot['priorities']
+    ready = sum(entry.get('ready', 0) for entry in priorities.values())
+    for priority, entry in priorities.items():
+        weight = PRIORITY_WEIGHTS[priority]
+        ahead = entry['ahead']
+        interleaved = sum(min(other['queued'], math.ceil((ahead + 1) * PRIORITY_WEIGHTS[name] / weight))
+                          for name, other in priorities.items() if name != priority)
+        entry['weight'] = weight
+        entry['estimated_wait_seconds'] = math.ceil(
+            (ready + ahead + interleaved) * build_seconds / max(workers, 1))
+    return snapshot
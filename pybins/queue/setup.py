@@ -1,8 +1,481 @@
+# Build queue backends: RQ on Redis, or in-process when Redis is not available
 import os
-from rq import Queue
-from redis import Redis
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from .fair import (PRIORITIES, DEFAULT_PRIORITY, ACTIVE_JOB_STATUSES, FairQueue, RedisFairQueue,
+                   READY_DEPTH)
 
-# Set up Redis connection and RQ queue
+# auto: RQ while Redis answers, in-process otherwise; rq: RQ only; local: in-process only
+QUEUE_BACKEND = os.environ.get('PYBINS_QUEUE_BACKEND', 'auto').lower()
+# Each priority has its own RQ queue, <name>-<priority>
+QUEUE_NAME = os.environ.get('PYBINS_QUEUE_NAME', 'builds')
 redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
-redis_conn = Redis.from_url(redis_url)
-queue = Queue('builds', connection=redis_conn)
+# Keep requests from hanging on an unreachable Redis
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('PYBINS_REDIS_CONNECT_TIMEOUT', 1))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('PYBINS_REDIS_SOCKET_TIMEOUT', 5))
+# Seconds the auto backend stays in-process before trying Redis again
+QUEUE_RETRY_INTERVAL = float(os.environ.get('PYBINS_QUEUE_RETRY_INTERVAL', 30))
+# Finished in-process jobs remembered for status lookups
+LOCAL_JOB_HISTORY = int(os.environ.get('PYBINS_LOCAL_JOB_HISTORY', 1000))
+
+_lock = threading.Lock()
+_redis_conn = None
+_queue = None
+
+
+def get_redis():
+    """The shared Redis connection, created on first use."""
+    global _redis_conn
+    with _lock:
+        if _redis_conn is None:
+            from redis import Redis
+            _redis_conn = Redis.from_url(redis_url, socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                                         socket_timeout=REDIS_SOCKET_TIMEOUT)
+        return _redis_conn
+
+
+def _connection_errors():
+    try:
+        from redis.exceptions import ConnectionError, TimeoutError
+    except ImportError:
+        return (ImportError,)
+    return (ConnectionError, TimeoutError, ImportError)
+
+
+def queue_names(name=QUEUE_NAME):
+    """The RQ queue of each priority, most urgent first (the order workers should listen in)."""
+    return {priority: f"{name}-{priority}" for priority in PRIORITIES}
+
+
+def _job_fields(job):
+    """An RQ job hash as a flat field, value list for Lua."""
+    fields = []
+    for key, value in job.to_dict().items():
+        if value is not None:
+            fields += [key, value if isinstance(value, (bytes, str)) else str(value)]
+    return fields
+
+
+class RQBackend:
+    """Jobs on per-priority RQ queues in Redis, run by `rq worker` processes.
+
+    Submitted jobs are saved as RQ jobs but held in a RedisFairQueue, which
+    hands them to the RQ queues in weighted fair order as workers free up
+    (see pybins.queue.worker.FairWorker).
+    """
+
+    kind = 'rq'
+
+    def __init__(self, name=QUEUE_NAME, connection=None, ready_depth=READY_DEPTH):
+        self.name = name
+        self.ready_depth = ready_depth
+        self._connection = connection
+        self._queues = None
+        self._fair = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = get_redis()
+        return self._connection
+
+    @property
+    def queues(self):
+        if self._queues is None:
+            from rq import Queue
+            self._queues = {priority: Queue(name, connection=self.connection)
+                            for priority, name in queue_names(self.name).items()}
+        return self._queues
+
+    @property
+    def fair(self):
+        if self._fair is None:
+            self._fair = RedisFairQueue(self.connection, ready_depth=self.ready_depth)
+        return self._fair
+
+    @property
+    def count(self):
+        return sum(entry['queued'] + entry['ready'] for entry in self._depths().values())
+
+    def ping(self):
+        return self.connection.ping()
+
+    def _create(self, fn, args, kwargs, job_id, priority):
+        from rq.job import JobStatus
+        from rq.utils import now
+        job = self.queues[priority].create_job(fn, args=args, kwargs=kwargs, job_id=job_id,
+                                               status=JobStatus.QUEUED)
+        job.enqueued_at = now()
+        return job
+
+    def submit(self, fn, args=(), kwargs=None, job_id=None, priority=DEFAULT_PRIORITY, tenant=None):
+        """Hold a job for fair release; returns (job, created).
+
+        When a job with the same id is still queued or running, nothing is
+        submitted and that job is returned with created=False.
+        """
+        return self.submit_many([(fn, args, kwargs or {}, job_id)], priority, tenant)[0]
+
+    def submit_many(self, calls, priority=DEFAULT_PRIORITY, tenant=None):
+        """Submit (fn, args, kwargs, job_id) calls in one Redis round trip; returns [(job, created)]."""
+        jobs = [self._create(fn, args, kwargs, job_id, priority) for fn, args, kwargs, job_id in calls]
+        queue = self.queues[priority]
+        with self.connection.pipeline() as pipe:
+            # Listed like any RQ queue, for `rq info` and Worker.all()
+            pipe.sadd(queue.redis_queues_keys, queue.key)
+            for job in jobs:
+                self.fair.push(priority, tenant or '', job.id, job.key, _job_fields(job),
+                               build_id=job.kwargs.get('build_id'), client=pipe)
+            created = pipe.execute()[1:]
+        results = []
+        for job, pushed in zip(jobs, created):
+            if pushed:
+                results.append((job, True))
+            else:
+                results.append((self.fetch_job(job.id) or job, False))
+        self.release()
+        return results
+
+    def release(self):
+        """Hand held jobs to the workers while fewer than ready_depth are waiting for one."""
+        return self.fair.release({priority: queue.key for priority, queue in self.queues.items()})
+
+    def cancel(self, build_id):
+        """Cancel the job of build_id if it has not started, whether held or waiting on its
+        RQ queue; returns False if there is none."""
+        from rq.job import JobStatus
+        job_id = self.fair.job_for_build(build_id)
+        job = self.fetch_job(job_id) if job_id else None
+        if job is None or job.kwargs.get('build_id') != build_id:
+            return False
+        priority = next((priority for priority, queue in self.queues.items() if queue.name == job.origin), None)
+        held = priority is not None and self.fair.remove(priority, job_id)
+        if not held and job.get_status() != JobStatus.QUEUED:
+            return False
+        job.cancel()
+        return True
+
+    def fetch_job(self, job_id):
+        from rq.job import Job
+        from rq.exceptions import NoSuchJobError
+        try:
+            return Job.fetch(job_id, connection=self.connection)
+        except NoSuchJobError:
+            return None
+
+    def fetch_jobs(self, job_ids):
+        """Fetch many jobs in one round trip; unknown ids are left out."""
+        from rq.job import Job
+        return [job for job in Job.fetch_many(list(job_ids), connection=self.connection) if job]
+
+    def workers(self):
+        from rq import Worker
+        return len({worker.name for queue in self.queues.values()
+                    for worker in Worker.all(queue=queue)})
+
+    def _depths(self, tenant=None):
+        priorities = self.fair.snapshot(tenant)
+        with self.connection.pipeline() as pipe:
+            for priority in PRIORITIES:
+                pipe.llen(self.queues[priority].key)
+            for priority, ready in zip(PRIORITIES, pipe.execute()):
+                priorities[priority]['ready'] = ready
+        return priorities
+
+    def snapshot(self, tenant=None):
+        """Per priority: held (queued) and released (ready) jobs, and the caller's position."""
+        return {'backend': self.kind, 'workers': self.workers(), 'priorities': self._depths(tenant)}
+
+
+class LocalJob:
+    """An in-process job, with the parts of the RQ Job interface the routes use."""
+
+    def __init__(self, fn, args, kwargs, job_id=None, priority=DEFAULT_PRIORITY, on_done=None, tenant=''):
+        self.id = job_id or f"local-{uuid.uuid4().hex}"
+        self.func = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.origin = priority
+        self.tenant = tenant
+        self.result = None
+        self.exc_info = None
+        self.on_done = on_done
+        self._status = 'queued'
+
+    def get_status(self, refresh=True):
+        return self._status
+
+    def run(self):
+        self._status = 'started'
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self._status = 'finished'
+        except Exception as e:
+            self.exc_info = str(e)
+            self._status = 'failed'
+            raise
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+    def cancelled(self):
+        self._status = 'canceled'
+
+
+class LocalBackend:
+    """Jobs run on this process's build executor; nothing survives a restart.
+
+    Used when Redis is not configured or not reachable, so a single process
+    (development, tests, small deployments) can build without a queue
+    server. Jobs wait in a FairQueue and are handed to the executor in
+    weighted fair order as its workers free up; jobs are cancelled like any
+    other in-process build.
+    """
+
+    kind = 'local'
+
+    def __init__(self, name=QUEUE_NAME, history=LOCAL_JOB_HISTORY, ready_depth=READY_DEPTH):
+        self.name = name
+        self.history = history
+        self.ready_depth = ready_depth
+        self.fair = FairQueue()
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    @property
+    def count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job._status == 'queued')
+
+    def ping(self):
+        return True
+
+    def _remember(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._jobs.move_to_end(job.id)
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest]._status in ('queued', 'started'):
+                    break
+                del self._jobs[oldest]
+
+    def submit(self, fn, args=(), kwargs=None, job_id=None, priority=DEFAULT_PRIORITY, tenant=None):
+        """Hold a job for fair release; returns (job, created), like RQBackend.submit()."""
+        existing = self.fetch_job(job_id) if job_id else None
+        if existing is not None and existing.get_status() in ACTIVE_JOB_STATUSES:
+            return existing, False
+        job = LocalJob(fn, args, kwargs or {}, job_id, priority, on_done=self.release, tenant=tenant or '')
+        if not self.fair.push(priority, job.tenant, job.id, job):
+            return self.fair.get(job.id), False
+        self._remember(job)
+        self.release()
+        return job, True
+
+    def submit_many(self, calls, priority=DEFAULT_PRIORITY, tenant=None):
+        return [self.submit(fn, args, kwargs, job_id, priority, tenant) for fn, args, kwargs, job_id in calls]
+
+    def release(self):
+        """Hand held jobs to the executor while fewer than ready_depth are pending there."""
+        from ..worker.executor import build_executor, ExecutorFull
+        released = []
+        while build_executor.stats()['pending'] < self.ready_depth:
+            popped = self.fair.pop()
+            if popped is None:
+                break
+            priority, tenant, start, job = popped
+            try:
+                build_executor.submit(job.kwargs.get('build_id') or job.id, job.run, on_cancel=job.cancelled)
+            except ExecutorFull:
+                # /build submissions filled the executor meanwhile; the job keeps its place
+                self.fair.requeue(priority, tenant, start, job.id, job)
+                break
+            released.append(job.id)
+        return released
+
+    def cancel(self, build_id):
+        """Cancel a job that has not started, by its build id; returns False if there is none."""
+        from ..worker.executor import build_executor
+        with self._lock:
+            job = next((job for job in self._jobs.values()
+                        if job.kwargs.get('build_id') == build_id and job._status == 'queued'), None)
+        if job is None:
+            return False
+        if self.fair.remove(job.id) is None:
+            # Already released: drop it from the executor's pending queue
+            if job._status != 'queued' or not build_executor.cancel(build_id):
+                return False
+        job.cancelled()
+        return True
+
+    def fetch_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def fetch_jobs(self, job_ids):
+        with self._lock:
+            return [self._jobs[job_id] for job_id in job_ids if job_id in self._jobs]
+
+    def workers(self):
+        from ..worker.executor import build_executor
+        return build_executor.workers
+
+    def snapshot(self, tenant=None):
+        priorities = self.fair.snapshot(tenant)
+        for entry in priorities.values():
+            entry['ready'] = 0
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            # Released to the executor but not started yet
+            if job._status == 'queued' and self.fair.get(job.id) is None:
+                priorities[job.origin]['ready'] += 1
+        return {'backend': self.kind, 'workers': self.workers(), 'priorities': priorities}
+
+
+class FailoverBackend:
+    """RQ while Redis answers, falling back to the in-process backend when it does not.
+
+    A connection failure switches new jobs to the local backend; Redis is
+    tried again after retry_interval seconds. Jobs keep living where they
+    were submitted, so lookups check both.
+    """
+
+    def __init__(self, primary=None, fallback=None, retry_interval=QUEUE_RETRY_INTERVAL):
+        self.primary = primary or RQBackend()
+        self.fallback = fallback or LocalBackend()
+        self.retry_interval = retry_interval
+        self.name = self.primary.name
+        self._down_since = None
+        self._checked = False
+
+    @property
+    def kind(self):
+        return self._active().kind
+
+    def _mark_down(self, error):
+        if self._down_since is None:
+            print(f"Error connecting to Redis, building in-process: {error}")
+        self._down_since = time.monotonic()
+
+    def _active(self):
+        if self._down_since is not None and time.monotonic() - self._down_since < self.retry_interval:
+            return self.fallback
+        if self._down_since is not None or not self._checked:
+            try:
+                self.primary.ping()
+                if self._down_since is not None:
+                    print("Redis is reachable again, building on RQ")
+                self._down_since = None
+                self._checked = True
+            except _connection_errors() as e:
+                self._mark_down(e)
+                return self.fallback
+        return self.primary
+
+    def _call(self, method, *args, **kwargs):
+        backend = self._active()
+        if backend is self.fallback:
+            return getattr(backend, method)(*args, **kwargs)
+        try:
+            return getattr(backend, method)(*args, **kwargs)
+        except _connection_errors() as e:
+            self._mark_down(e)
+            return getattr(self.fallback, method)(*args, **kwargs)
+
+    @property
+    def count(self):
+        local = self.fallback.count
+        if self._active() is self.fallback:
+            return local
+        try:
+            return self.primary.count + local
+        except _connection_errors() as e:
+            self._mark_down(e)
+            return local
+
+    def ping(self):
+        return self._active().ping()
+
+    def _local_duplicate(self, job_id):
+        job = self.fallback.fetch_job(job_id) if job_id else None
+        return job if job is not None and job.get_status() in ACTIVE_JOB_STATUSES else None
+
+    def submit(self, fn, args=(), kwargs=None, job_id=None, priority=DEFAULT_PRIORITY, tenant=None):
+        job = self._local_duplicate(job_id)
+        if job is not None:
+            return job, False
+        return self._call('submit', fn, args, kwargs, job_id, priority, tenant)
+
+    def submit_many(self, calls, priority=DEFAULT_PRIORITY, tenant=None):
+        duplicates = {call[3]: self._local_duplicate(call[3]) for call in calls}
+        fresh = [call for call in calls if duplicates[call[3]] is None]
+        submitted = iter(self._call('submit_many', fresh, priority, tenant) if fresh else [])
+        return [(duplicates[call[3]], False) if duplicates[call[3]] is not None else next(submitted)
+                for call in calls]
+
+    def release(self):
+        self.fallback.release()
+        return self._call('release') if self._active() is self.primary else []
+
+    def cancel(self, build_id):
+        if self.fallback.cancel(build_id):
+            return True
+        return self._call('cancel', build_id) if self._active() is self.primary else False
+
+    def fetch_job(self, job_id):
+        job = self.fallback.fetch_job(job_id)
+        if job is not None or str(job_id).startswith('local-'):
+            return job
+        return self._call('fetch_job', job_id) if self._active() is self.primary else None
+
+    def fetch_jobs(self, job_ids):
+        jobs = self.fallback.fetch_jobs(job_ids)
+        found = {job.id for job in jobs}
+        remote = [job_id for job_id in job_ids if job_id not in found and not str(job_id).startswith('local-')]
+        if remote and self._active() is self.primary:
+            jobs += self._call('fetch_jobs', remote)
+        return jobs
+
+    def workers(self):
+        return self._call('workers')
+
+    def snapshot(self, tenant=None):
+        local = self.fallback.snapshot(tenant)
+        if self._active() is self.fallback:
+            return local
+        try:
+            snapshot = self.primary.snapshot(tenant)
+        except _connection_errors() as e:
+            self._mark_down(e)
+            return local
+        # Jobs submitted while Redis was down still run here
+        for priority, entry in snapshot['priorities'].items():
+            for field, value in local['priorities'][priority].items():
+                entry[field] += value
+        return snapshot
+
+
+BACKENDS = {'rq': RQBackend, 'local': LocalBackend, 'auto': FailoverBackend}
+
+
+def get_queue():
+    """The configured build queue backend, created on first use."""
+    global _queue
+    with _lock:
+        if _queue is None:
+            if QUEUE_BACKEND not in BACKENDS:
+                raise ValueError(f"Unknown queue backend: {QUEUE_BACKEND} (expected one of {', '.join(BACKENDS)})")
+            _queue = BACKENDS[QUEUE_BACKEND]()
+        return _queue
+
+
+def __getattr__(name):
+    # Module attributes from before the queue was lazy
+    if name == 'queue':
+        return get_queue()
+    if name == 'redis_conn':
+        return get_redis()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
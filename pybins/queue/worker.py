@@ -0,0 +1,53 @@
+# RQ worker that releases held builds in fair order whenever it looks for work
+import os
+import time
+from rq import Worker
+from .setup import RQBackend
+
+# Seconds an idle worker waits on its queues before checking for held builds again
+RELEASE_POLL = int(os.environ.get('PYBINS_QUEUE_RELEASE_POLL', 2))
+
+
+class FairWorker(Worker):
+    """An RQ worker for the per-priority build queues.
+
+    Builds are held in the fair queue until released. Before each dequeue
+    the worker releases the next build(s) in fair order, and while idle it
+    polls every RELEASE_POLL seconds instead of blocking, so held builds
+    start as soon as a worker is free. It also starts the artifact
+    collector once its interval is up. Run it on all priority queues, most
+    urgent first:
+
+        rq worker -w pybins.queue.worker.FairWorker builds-interactive builds-ci builds-bulk
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = RQBackend(connection=self.connection)
+
+    def release(self):
+        try:
+            self.backend.release()
+        except Exception as e:
+            print(f"Error releasing held builds: {e}")
+
+    def collect_artifacts(self):
+        # Work horses exit right after their job, so the collector runs from the worker itself,
+        # inline: a collector thread could still be running when the next work horse is forked
+        from ..worker.tasks import artifact_lifecycle
+        artifact_lifecycle.maybe_collect(background=False)
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        idle_since = time.monotonic()
+        while True:
+            self.release()
+            self.collect_artifacts()
+            if timeout is None:
+                # Burst mode: one non-blocking look
+                return super().dequeue_job_and_maintain_ttl(None, max_idle_time)
+            wait = max(min(timeout, RELEASE_POLL), 1)
+            result = super().dequeue_job_and_maintain_ttl(wait, max_idle_time=wait)
+            if result is not None:
+                return result
+            if max_idle_time is not None and time.monotonic() - idle_since >= max_idle_time:
+                return None
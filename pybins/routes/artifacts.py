@@ -0,0 +1,200 @@
+# Artifact responses: content-hash ETags, byte ranges, sendfile offload and precompressed logs
+import hashlib
+import mimetypes
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from flask import request, send_file, jsonify, Response
+from werkzeug.http import parse_range_header
+from werkzeug.security import safe_join
+
+# '' serves files from Flask (zero-copy through wsgi.file_wrapper where the
+# server supports it); 'x-accel' hands them to nginx, 'x-sendfile' to
+# Apache/lighttpd.
+SENDFILE_MODE = os.environ.get('PYBINS_SENDFILE_MODE', '').lower()
+ACCEL_PREFIX = os.environ.get('PYBINS_ACCEL_PREFIX', '/_artifacts').rstrip('/')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+ETAG_CACHE_SIZE = int(os.environ.get('PYBINS_ETAG_CACHE_SIZE', 4096))
+HASH_CHUNK = 1024 * 1024
+# Files that keep changing until their build finishes
+LIVE_FILES = ('build.log',)
+PRECOMPRESSED = ('build.log',)
+
+
+class ETagCache:
+    """sha256 ETags for artifact files, remembered per (path, mtime, size).
+
+    Artifacts never change once written, so each file is hashed once per
+    process instead of on every download.
+    """
+
+    def __init__(self, max_entries=ETAG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st=None):
+        st = st or os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(path)
+                return entry[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        with self._lock:
+            self._entries[path] = (stamp, etag)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+
+etag_cache = ETagCache()
+
+
+def _precompressed_variant(path, filename, st):
+    """Return the .gz sibling of path when the client accepts gzip and it is current."""
+    if filename not in PRECOMPRESSED or request.range is not None:
+        return None
+    if 'gzip' not in request.accept_encodings:
+        return None
+    gz_path = path + '.gz'
+    try:
+        gz_st = os.stat(gz_path)
+    except OSError:
+        return None
+    if gz_st.st_mtime_ns < st.st_mtime_ns:
+        return None
+    return gz_path
+
+
+def _byte_ranges(ranges, size):
+    """Resolve parsed ranges against size, dropping unsatisfiable ones."""
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+
+def _multipart_ranges(path, ranges, size, mimetype, headers):
+    """Build a 206 multipart/byteranges response streamed straight from the file."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, stop in ranges:
+        head = (f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode('ascii')
+        parts.append((head, start, stop))
+        length += len(head) + (stop - start) + 2
+    tail = f"--{boundary}--\r\n".encode('ascii')
+    length += len(tail)
+
+    def generate():
+        with open(path, 'rb') as f:
+            for head, start, stop in parts:
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                while remaining:
+                    chunk = f.read(min(HASH_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b'\r\n'
+        yield tail
+
+    response = Response(generate(), status=206,
+                        mimetype=f'multipart/byteranges; boundary={boundary}', headers=headers)
+    response.content_length = length
+    return response
+
+
+def _offload(root, path, headers, mimetype):
+    """Let the front-end web server send the file."""
+    response = Response(b'', mimetype=mimetype, headers=headers)
+    if SENDFILE_MODE == 'x-accel':
+        relative = os.path.relpath(path, root).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{ACCEL_PREFIX}/{relative}"
+    else:
+        response.headers['X-Sendfile'] = path
+    return response
+
+
+def serve_artifact(root, build_id, filename, finished=True):
+    """Serve root/build_id/filename with validators, ranges and cache headers.
+
+    Files of finished builds are immutable, so they get a sha256 ETag and a
+    one-year immutable Cache-Control; a log that is still being written is
+    revalidated on every request instead. If-None-Match is answered with 304
+    before the file is opened, single and multiple byte ranges are supported,
+    and build logs are sent precompressed to clients that accept gzip.
+    """
+    path = safe_join(root, build_id, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    st = os.stat(path)
+    live = filename in LIVE_FILES and not finished
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if filename in PRECOMPRESSED:
+        headers['Vary'] = 'Accept-Encoding'
+    if live:
+        # Growing file: a cheap validator, never cached without revalidation
+        etag = f"live-{st.st_size:x}-{st.st_mtime_ns:x}"
+        headers['Cache-Control'] = 'no-cache'
+    else:
+        etag = etag_cache.get(path, st)
+        headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+
+    encoding = None
+    gz_path = None if live else _precompressed_variant(path, filename, st)
+    if gz_path:
+        path, encoding, etag = gz_path, 'gzip', etag + '-gz'
+    mimetype = mimetypes.guess_type(filename)[0] or (
+        'text/plain' if filename.endswith('.log') else 'application/octet-stream')
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    if SENDFILE_MODE in ('x-accel', 'x-sendfile'):
+        response = _offload(root, path, headers, mimetype)
+        response.set_etag(etag)
+        if encoding:
+            response.content_encoding = encoding
+        return response
+
+    ranges = parse_range_header(request.headers.get('Range'))
+    if_range = request.if_range
+    range_applies = (not if_range.etag and not if_range.date) or if_range.etag == etag
+    if ranges is not None and len(ranges.ranges) > 1 and range_applies:
+        resolved = _byte_ranges(ranges.ranges, st.st_size)
+        if not resolved:
+            return Response(status=416, headers={'Content-Range': f'bytes */{st.st_size}'})
+        response = _multipart_ranges(path, resolved, st.st_size, mimetype, headers)
+        response.set_etag(etag)
+        response.accept_ranges = 'bytes'
+        return response
+
+    # send_file handles If-Range, single ranges (206/416) and zero-copy file wrapping
+    response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename,
+                         etag=etag, conditional=True, max_age=None)
+    response.headers.update(headers)
+    if encoding:
+        response.content_encoding = encoding
+    return response
@@ -0,0 +1,226 @@
+# Rendered installer scripts, cached per (tool, version)
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, Response
+
+INSTALLER_CACHE_SIZE = int(os.environ.get('PYBINS_INSTALLER_CACHE_SIZE', 4096))
+# Seconds a resolved 'latest' version is used before PyPI is asked again
+INSTALLER_LATEST_TTL = float(os.environ.get('PYBINS_INSTALLER_LATEST_TTL', 300))
+# How long past that a stale 'latest' may still be served while it is revalidated
+INSTALLER_STALE_TTL = float(os.environ.get('PYBINS_INSTALLER_STALE_TTL', 86400))
+# Seconds an unknown tool or version is answered with 404 without asking PyPI
+INSTALLER_NEGATIVE_TTL = float(os.environ.get('PYBINS_INSTALLER_NEGATIVE_TTL', 60))
+INSTALLER_MAX_AGE = int(os.environ.get('PYBINS_INSTALLER_MAX_AGE', 86400))
+PREWARM_TOOLS = os.environ.get('PYBINS_PREWARM_TOOLS', '')
+PREWARM_TOP = int(os.environ.get('PYBINS_PREWARM_TOP', 0))
+PREWARM_CONCURRENCY = int(os.environ.get('PYBINS_PREWARM_CONCURRENCY', 16))
+
+def render_installer(tool, version):
+    """Render the installer script for one tool version (the same script on every platform)."""
+    from ..fetcher.fetcher import generate_installer_script
+    return generate_installer_script(tool, version)
+
+
+class InstallerCache:
+    """Rendered installer scripts with their ETags.
+
+    A script for a pinned version never changes, so it is kept until it is
+    evicted (LRU, max_entries scripts). Requests for the latest version go
+    through a per-tool pointer to the resolved version: within latest_ttl it
+    is used as is; after that the stale version is still served (for up to
+    stale_ttl more) while a background lookup revalidates it, so only a
+    cold or very stale tool makes a request wait on PyPI. When the lookup
+    finds a new release the pointer moves and the new script is rendered.
+    """
+
+    def __init__(self, max_entries=INSTALLER_CACHE_SIZE, latest_ttl=INSTALLER_LATEST_TTL,
+                 stale_ttl=INSTALLER_STALE_TTL, negative_ttl=INSTALLER_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.latest_ttl = latest_ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._scripts = OrderedDict()
+        self._latest = {}
+        self._missing = {}
+        self._refreshing = set()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'not_found': 0,
+                          'revalidations': 0, 'new_releases': 0, 'evictions': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def _lookup(tool, version=None):
+        from ..fetcher.fetcher import fetch_from_pypi
+        return fetch_from_pypi(tool, version)
+
+    def _is_missing(self, key):
+        with self._lock:
+            until = self._missing.get(key)
+            if until is not None and until <= time.time():
+                del self._missing[key]
+                until = None
+        return until is not None
+
+    def _mark_missing(self, key):
+        self._count('not_found')
+        with self._lock:
+            self._missing[key] = time.time() + self.negative_ttl
+
+    def _render(self, tool, version):
+        key = (tool, version)
+        with self._lock:
+            entry = self._scripts.get(key)
+            if entry is not None:
+                self._scripts.move_to_end(key)
+                return entry
+        body = render_installer(tool, version).encode('utf-8')
+        entry = {'body': body, 'etag': hashlib.sha256(body).hexdigest()[:32], 'version': version}
+        with self._lock:
+            self._scripts[key] = entry
+            while len(self._scripts) > self.max_entries:
+                self._scripts.popitem(last=False)
+                self._counters['evictions'] += 1
+        return entry
+
+    def _resolve_latest(self, tool):
+        info = self._lookup(tool)
+        if not info:
+            with self._lock:
+                self._latest.pop(tool, None)
+            self._mark_missing((tool, None))
+            return None
+        with self._lock:
+            previous = self._latest.get(tool)
+            self._latest[tool] = {'version': info['version'], 'checked_at': time.time()}
+            if previous and previous['version'] != info['version']:
+                self._counters['new_releases'] += 1
+        return info['version']
+
+    def _revalidate(self, tool):
+        try:
+            self._count('revalidations')
+            self._resolve_latest(tool)
+        except Exception as e:
+            print(f"Error revalidating installer for {tool}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(tool)
+
+    def latest_version(self, tool):
+        """Resolve 'latest' for tool, revalidating in the background when stale."""
+        with self._lock:
+            pointer = self._latest.get(tool)
+        if pointer is not None:
+            age = time.time() - pointer['checked_at']
+            if age < self.latest_ttl:
+                return pointer['version']
+            if age < self.latest_ttl + self.stale_ttl:
+                self._count('stale')
+                with self._lock:
+                    start = tool not in self._refreshing
+                    self._refreshing.add(tool)
+                if start:
+                    threading.Thread(target=self._revalidate, args=(tool,), daemon=True).start()
+                return pointer['version']
+        if self._is_missing((tool, None)):
+            return None
+        return self._resolve_latest(tool)
+
+    def script(self, tool, version=None):
+        """Return the cached script entry {body, etag, version}, or None if the tool/version is unknown."""
+        if version is None:
+            resolved = self.latest_version(tool)
+            if resolved is None:
+                return None
+            key = (tool, resolved)
+        else:
+            key = (tool, version)
+        with self._lock:
+            cached = key in self._scripts
+        if cached:
+            self._count('hits')
+            return self._render(*key)
+        self._count('misses')
+        if version is not None:
+            if self._is_missing(key):
+                return None
+            # Only render pinned versions PyPI actually has
+            if not self._lookup(tool, version):
+                self._mark_missing(key)
+                return None
+        return self._render(*key)
+
+    def prewarm(self, tools, concurrency=PREWARM_CONCURRENCY):
+        """Resolve and render the latest scripts of tools; returns the tools warmed."""
+        def warm(tool):
+            try:
+                version = self._resolve_latest(tool)
+            except Exception as e:
+                print(f"Error prewarming installer for {tool}: {e}")
+                return None
+            if version is None:
+                return None
+            self._render(tool, version)
+            return tool
+
+        tools = list(dict.fromkeys(tool for tool in tools if tool))
+        if not tools:
+            return []
+        with ThreadPoolExecutor(max_workers=max(min(concurrency, len(tools)), 1)) as pool:
+            return [tool for tool in pool.map(warm, tools) if tool]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, scripts=len(self._scripts), latest=len(self._latest))
+
+
+installer_cache = InstallerCache()
+
+
+def installer_response(tool, version=None):
+    """Serve the installer script, answering 304 when unchanged."""
+    entry = installer_cache.script(tool, version)
+    if entry is None:
+        return None
+    if request.if_none_match.contains_weak(entry['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(entry['body'], mimetype='text/x-sh')
+    response.set_etag(entry['etag'])
+    max_age = INSTALLER_MAX_AGE if version else int(installer_cache.latest_ttl)
+    response.headers['Cache-Control'] = f"public, max-age={max_age}"
+    return response
+
+
+def prewarm_tools(top=PREWARM_TOP):
+    """The tools to prewarm: PYBINS_PREWARM_TOOLS plus the top most built packages."""
+    from ..storage.storage import get_storage
+    tools = [tool.strip() for tool in PREWARM_TOOLS.split(',') if tool.strip()]
+    if top:
+        tools += get_storage().top_packages(top)
+    return tools
+
+
+def init_installers(app):
+    """Register the prewarm-installers command and prewarm in the background when configured."""
+    import click
+
+    @app.cli.command('prewarm-installers')
+    @click.option('--top', default=PREWARM_TOP or 100, show_default=True,
+                  help='Number of most built packages to prewarm')
+    @click.argument('tools', nargs=-1)
+    def prewarm_installers(top, tools):
+        """Render installer scripts ahead of the first request."""
+        warmed = installer_cache.prewarm(list(tools) + prewarm_tools(top))
+        click.echo(f"Prewarmed installer scripts for {len(warmed)} tools")
+
+    if PREWARM_TOOLS.strip() or PREWARM_TOP:
+        threading.Thread(target=lambda: installer_cache.prewarm(prewarm_tools()), daemon=True).start()
+    return app
@@ -1,10 +1,30 @@
 import os
-from flask import send_from_directory
+from flask import stream_with_context
 from flask import Blueprint, request, jsonify, abort, Response
-from ..worker.tasks import build_package_task, run_build, get_build_status, list_builds
-from ..queue.setup import queue
+from ..worker.tasks import build_package_task, run_build, get_build_status, list_builds, build_index, resolve_version
+from ..worker.tasks import enqueue_placeholder
+from ..worker.batch import (plan_batch, submit_batch, get_batch_status, meta_batch, metadata_summary,
+                            BatchError)
+from ..worker.dedup import build_key
+from ..worker.urls import start_build_response, cancel_build_response, parse_wait, builds_listing_response
+from ..worker.tasks import ARTIFACTS_DIR, TERMINAL_STATUSES, artifact_lifecycle
+from ..worker.lifecycle import report_view
+from ..worker.logs import stream_log_events
+from .artifacts import serve_artifact
+from .installers import installer_response, installer_cache
+from .simple import simple_response
+from ..queue.setup import get_queue, queue_names
+from ..queue.fair import (job_id_for, parse_priority, estimate_waits, PriorityError, ACTIVE_JOB_STATUSES,
+                          BATCH_PRIORITY)
 from ..fetcher.fetcher import fetch_from_pypi, fetch_from_github
-from ..storage.storage import PackageStorage
+from ..fetcher.selector import parse_target, TargetError
+from ..fetcher.cache import metadata_cache
+from ..fetcher.client import get_client
+from ..storage.storage import get_storage
+from ..worker.executor import build_executor
+from ..metrics.metrics import registry
+from ..api.middleware.middleware import rate_limit, gc_rate_limit
+from ..api.middleware.admission import client_id, admit_builds, admission
 
 
 routes_bp = Blueprint('routes', __name__)
@@ -13,15 +33,56 @@ routes_bp = Blueprint('routes', __name__)
 @routes_bp.route('/download/<build_id>/<filename>', methods=['GET'])
 def download_artifact(build_id, filename):
     """Serve build artifacts and logs from the artifacts directory."""
-    ARTIFACTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts'))
-    build_dir = os.path.join(ARTIFACTS_DIR, build_id)
-    if not os.path.exists(os.path.join(build_dir, filename)):
-        return jsonify({'error': 'File not found'}), 404
-    return send_from_directory(build_dir, filename, as_attachment=True)
+    build = get_build_status(build_id)
+    finished = not build or build.get('status') in TERMINAL_STATUSES
+    # Downloads order builds for LRU eviction, and pin them while they are sent
+    artifact_lifecycle.record_access(build_id)
+    return artifact_lifecycle.serving(build_id, serve_artifact(ARTIFACTS_DIR, build_id, filename, finished))
 
+@routes_bp.route('/simple/', methods=['GET'])
+def simple_index_root():
+    """PEP 503/691 simple repository root listing the projects with built wheels"""
+    return simple_response(storage)
 
+@routes_bp.route('/simple/<project>/', methods=['GET'])
+def simple_index_project(project):
+    """PEP 503/691 simple repository page with the built wheels of a project"""
+    return simple_response(storage, project)
 
-storage = PackageStorage()
+@routes_bp.route('/artifacts/gc', methods=['GET'])
+@gc_rate_limit
+def artifact_gc_report():
+    """Report disk usage and what a collection would remove, without removing anything"""
+    return jsonify(report_view(artifact_lifecycle.collect(dry_run=True)))
+
+@routes_bp.route('/artifacts/gc', methods=['POST'])
+@gc_rate_limit
+def artifact_gc_run():
+    """Collect artifacts now (?dry_run=1 only reports)"""
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    return jsonify(report_view(artifact_lifecycle.collect(dry_run=dry_run)))
+
+
+
+storage = get_storage()
+
+def queue_metrics():
+    """Queue depth gauges, read at scrape time."""
+    stats = build_executor.stats()
+    samples = [
+        ({'queue': 'executor', 'state': 'pending'}, stats['pending']),
+        ({'queue': 'executor', 'state': 'running'}, stats['running']),
+    ]
+    try:
+        names = queue_names(get_queue().name)
+        for priority, entry in get_queue().snapshot()['priorities'].items():
+            samples.append(({'queue': names[priority], 'state': 'held'}, entry['queued']))
+            samples.append(({'queue': names[priority], 'state': 'ready'}, entry['ready']))
+    except Exception as e:
+        print(f"Error reading build queue depth: {e}")
+    return [('pybins_queue_depth', 'gauge', 'Builds waiting or running per queue', samples)]
+
+registry.add_collector(queue_metrics)
 
 @routes_bp.route('/', methods=['GET'])
 def index():
@@ -32,54 +93,166 @@ def index():
         'endpoints': {
             'GET /': 'This help message',
             'POST /enqueue': 'Enqueue a package build',
+            'POST /enqueue/batch': 'Enqueue builds for a list of packages',
+            'GET /enqueue/batch/<batch_id>': 'Get the aggregate status of a batch',
+            'GET /queue': 'Depth and estimated wait of each build priority',
             'POST /build': 'Build a package',
             'GET /build/<build_id>': 'Get build status',
+            'POST /build/<build_id>/cancel': 'Cancel a queued or running build',
+            'GET /build/<build_id>/log/stream': 'Stream the build log (Server-Sent Events)',
             'GET /builds': 'List all builds',
+            'GET /simple/': 'Simple repository index of built wheels (pip --index-url)',
+            'GET /simple/<project>/': 'Simple repository page for a project',
+            'GET /artifacts/gc': 'Report artifact disk usage and what a collection would remove',
+            'POST /artifacts/gc': 'Collect artifacts now',
             'GET /packages': 'List all packages',
             'POST /packages': 'Add a package',
             'GET /<tool>': 'Get installer script for tool',
             'GET /<tool>@<version>': 'Get installer script for specific version',
             'GET /meta/<tool>': 'Get package metadata',
+            'POST /meta/batch': 'Get metadata for a list of packages',
+            'GET /metrics': 'Prometheus metrics',
             'GET /health': 'Health check'
         }
     })
 
 @routes_bp.route('/enqueue', methods=['POST'])
+@rate_limit
 def enqueue_build():
     """Enqueue a package build"""
     data = request.get_json()
     if not data or 'package' not in data:
         return jsonify({'error': 'Package name is required'}), 400
     
+    try:
+        priority = parse_priority(data.get('priority'))
+        target = parse_target(data.get('target'))
+    except (PriorityError, TargetError) as e:
+        return jsonify({'error': str(e)}), 400
     package_name = data['package']
-    version = data.get('version', 'latest')
-    
-   
-    # Enqueue the build task in the background
-    job = queue.enqueue(build_package_task, package_name, version)
+    version = resolve_version(package_name, data.get('version', 'latest'))
+    build_type = data.get('build_type', 'wheel')
+    force = bool(data.get('force', False))
+    key = build_key(package_name, version, build_type, target)
+    job_id = job_id_for(key)
+
+    if not force:
+        # Serve an existing successful build, or point at the job already queued for it
+        existing = build_index.find(key)
+        if existing:
+            return jsonify({
+                'message': 'Build already available',
+                'status': 'success',
+                'deduplicated': 'completed',
+                'build': existing
+            }), 200
+        job = get_queue().fetch_job(job_id)
+        if job is not None:
+            job_status = job.get_status()
+            if job_status in ACTIVE_JOB_STATUSES:
+                return in_flight_response(job, job_status)
+            if job_status == 'finished':
+                build_index.record(key, job.result)
+                existing = build_index.find(key)
+                if existing:
+                    return jsonify({
+                        'message': 'Build already available',
+                        'status': 'success',
+                        'deduplicated': 'completed',
+                        'build': existing
+                    }), 200
+
+    # Enqueue the build task in the background; the queued record counts
+    # against admission limits until a worker picks it up. The job id is
+    # derived from the build, so a concurrent identical enqueue collapses
+    # into this job (force=True always gets a job of its own).
+    client = client_id()
+    build_id = enqueue_placeholder(package_name, version, build_type, client, priority)
+    try:
+        job, created = get_queue().submit(
+            run_build, (package_name, version, build_type),
+            {'force': force, 'build_id': build_id, 'target': target, 'client': client},
+            job_id=None if force else job_id, priority=priority, tenant=client)
+    except Exception:
+        storage.delete_build(build_id)
+        raise
+    if not created:
+        storage.delete_build(build_id)
+        return in_flight_response(job, job.get_status())
     return jsonify({
         'message': 'Build enqueued successfully',
-        'job_id': job.get_id(),
-        'status': 'queued'
+        'job_id': job.id,
+        'build_id': build_id,
+        'priority': priority,
+        'status': 'queued',
+        'status_url': f"/build/{build_id}",
+        'queue_url': '/queue'
     }), 202
 
+def in_flight_response(job, job_status):
+    """Point a repeat enqueue at the identical job that is already queued or running."""
+    build_id = job.kwargs.get('build_id')
+    return jsonify({
+        'message': 'Identical build already enqueued',
+        'job_id': job.id,
+        'build_id': build_id,
+        'status': str(getattr(job_status, 'value', job_status)),
+        'status_url': f"/build/{build_id}" if build_id else None,
+        'deduplicated': 'in_flight'
+    }), 202
+
+@routes_bp.route('/enqueue/batch', methods=['POST'])
+@rate_limit
+def enqueue_batch():
+    """Enqueue builds for a list of packages in one request"""
+    data = request.get_json(silent=True)
+    try:
+        priority = parse_priority((data.get('priority') if isinstance(data, dict) else None)
+                                  or request.args.get('priority'), BATCH_PRIORITY)
+        batch, pending = plan_batch(data, get_queue())
+    except (BatchError, PriorityError) as e:
+        return jsonify({'error': str(e)}), 400
+    # The whole batch is admitted or rejected; builds it reuses do not count
+    rejected = admit_builds(len(pending), batch=True) if pending else None
+    if rejected is not None:
+        return rejected
+    summary = submit_batch(batch, pending, get_queue(), client_id(), priority)
+    summary['status_url'] = f"/enqueue/batch/{batch['batch_id']}"
+    return jsonify(summary), 202
+
+@routes_bp.route('/enqueue/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Get the aggregate status of a batch"""
+    summary = get_batch_status(batch_id)
+    if not summary:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(summary)
+
+@routes_bp.route('/queue', methods=['GET'])
+def queue_status():
+    """Depth and estimated wait of each build priority, as seen by the caller"""
+    queue = get_queue()
+    client = client_id()
+    build_seconds = admission.estimated_build_seconds()
+    snapshot = queue.snapshot(client)
+    estimate_waits(snapshot, build_seconds, snapshot['workers'])
+    names = queue_names(queue.name)
+    for priority, entry in snapshot['priorities'].items():
+        entry['queue'] = names[priority]
+    snapshot['client'] = client
+    snapshot['estimated_build_seconds'] = round(build_seconds, 1)
+    return jsonify(snapshot)
+
 @routes_bp.route('/build', methods=['POST'])
+@rate_limit
 def build_package():
-    """Build a package immediately"""
-    data = request.get_json()
-    if not data or 'package' not in data:
-        return jsonify({'error': 'Package name is required'}), 400
-    
-    package_name = data['package']
-    version = data.get('version', 'latest')
-    build_type = data.get('build_type', 'wheel')
-    
-    result = run_build(package_name, version, build_type)
-    
-    if result.get('success'):
-        return jsonify(result), 200
-    else:
-        return jsonify(result), 400
+    """Start a package build in the background (?wait=<seconds> blocks for the result)"""
+    return start_build_response(request.get_json(), parse_wait(request.args.get('wait')))
+
+@routes_bp.route('/build/<build_id>/cancel', methods=['POST'])
+def cancel_build_info(build_id):
+    """Cancel a queued or running build"""
+    return cancel_build_response(build_id)
 
 @routes_bp.route('/build/<build_id>', methods=['GET'])
 def get_build_info(build_id):
@@ -90,14 +263,32 @@ def get_build_info(build_id):
     
     return jsonify(build_info)
 
+@routes_bp.route('/build/<build_id>/log/stream', methods=['GET'])
+def stream_build_log(build_id):
+    """Stream a build log as Server-Sent Events until the build finishes"""
+    if not get_build_status(build_id):
+        return jsonify({'error': 'Build not found'}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('offset', '0')
+    try:
+        offset = max(int(last_event_id), 0)
+    except ValueError:
+        offset = 0
+    log_path = os.path.join(ARTIFACTS_DIR, build_id, 'build.log')
+    events = stream_log_events(build_id, log_path, get_build_status, TERMINAL_STATUSES, offset)
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @routes_bp.route('/builds', methods=['GET'])
 def get_all_builds():
-    """List all builds"""
-    builds = list_builds()
-    return jsonify({
-        'builds': builds,
-        'count': len(builds)
-    })
+    """List builds, newest first, one page at a time"""
+    return builds_listing_response(request.args)
+
+@routes_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics aggregated over all web and worker processes"""
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @routes_bp.route('/packages', methods=['GET'])
 def get_packages():
@@ -140,43 +331,11 @@ def get_installer(tool_request):
     else:
         tool, version = tool_request, None
 
-    user_agent = request.headers.get('User-Agent', '').lower()
-
-    # Detect OS
-    if 'windows' in user_agent:
-        os_type = 'windows'
-    elif 'linux' in user_agent:
-        os_type = 'linux'
-    elif 'darwin' in user_agent or 'mac os' in user_agent:
-        os_type = 'macos'
-    else:
-        os_type = 'linux'  # Default to linux instead of aborting
-
-    # Detect Arch
-    if 'x86_64' in user_agent or 'amd64' in user_agent:
-        arch = 'x86_64'
-    elif 'arm64' in user_agent or 'aarch64' in user_agent:
-        arch = 'arm64'
-    else:
-        arch = 'x86_64'  # Default architecture
-
-    # Fetch package info
-    package_info = fetch_from_pypi(tool, version)
-    if not package_info:
+    # Rendered scripts are cached per (tool, version, os, arch); see installers.py
+    response = installer_response(tool, version)
+    if response is None:
         abort(404, description="Tool or version not found")
-
-    installer_script = package_info.get('installer_script')
-    if not installer_script:
-        # Generate basic installer script
-        version_spec = f"=={version}" if version else ""
-        installer_script = f'''#!/bin/bash
-# Installer for {tool}{version_spec}
-echo "Installing {tool}..."
-pip install {tool}{version_spec}
-echo "Installation complete!"
-'''
-
-    return Response(installer_script, mimetype='text/x-sh')
+    return response
 
 @routes_bp.route('/meta/<tool>', methods=['GET'])
 def get_tool_meta(tool):
@@ -185,13 +344,15 @@ def get_tool_meta(tool):
     if not metadata:
         abort(404, description="Tool not found")
     
-    return jsonify({
-        'name': metadata.get('name', tool),
-        'version': metadata.get('version', 'unknown'),
-        'author': metadata.get('author', 'Unknown'),
-        'description': metadata.get('description', 'No description available'),
-        'package_url': metadata.get('package_url', '')
-    })
+    return jsonify(metadata_summary(metadata, tool))
+
+@routes_bp.route('/meta/batch', methods=['POST'])
+def get_meta_batch():
+    """Get metadata for a list of packages, looked up concurrently"""
+    try:
+        return jsonify(meta_batch(request.get_json(silent=True)))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
 
 @routes_bp.route('/health', methods=['GET'])
 def health_check():
@@ -199,5 +360,9 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'pybins',
-        'timestamp': storage.builds.__len__() if hasattr(storage, 'builds') else 0
+        'timestamp': storage.builds.__len__() if hasattr(storage, 'builds') else 0,
+        'metadata_cache': metadata_cache.stats(),
+        'installer_cache': installer_cache.stats(),
+        'http_client': get_client().stats(),
+        'queue_backend': get_queue().kind
     })
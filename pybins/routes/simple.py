@@ -0,0 +1,117 @@
+# PEP 503/691 simple repository responses, served from pages rendered as builds finish
+import os
+import threading
+import time
+from flask import request, Response, redirect, jsonify
+from ..worker.simple_index import normalize, render_root, ROOT
+
+SIMPLE_MAX_AGE = int(os.environ.get('PYBINS_SIMPLE_MAX_AGE', 60))
+# Seconds a process trusts its copy of the pages before checking the shared serial again
+SIMPLE_REFRESH = float(os.environ.get('PYBINS_SIMPLE_REFRESH', 1))
+
+JSON_V1 = 'application/vnd.pypi.simple.v1+json'
+HTML_V1 = 'application/vnd.pypi.simple.v1+html'
+CONTENT_TYPES = {
+    JSON_V1: 'json',
+    'application/vnd.pypi.simple.latest+json': 'json',
+    HTML_V1: 'html',
+    'application/vnd.pypi.simple.latest+html': 'html',
+    'text/html': 'html',
+}
+SERVED_AS = {'application/vnd.pypi.simple.latest+json': JSON_V1,
+             'application/vnd.pypi.simple.latest+html': HTML_V1}
+
+
+def negotiate():
+    """Pick the response content type from ?format= or the Accept header (PEP 691)."""
+    requested = request.args.get('format')
+    if requested in CONTENT_TYPES:
+        return SERVED_AS.get(requested, requested)
+    if not request.accept_mimetypes:
+        return 'text/html'
+    best = request.accept_mimetypes.best_match(list(CONTENT_TYPES))
+    return SERVED_AS.get(best, best) if best else None
+
+
+class PageCache:
+    """This process's copy of the rendered pages.
+
+    Each page is read from the database once per change of the index serial,
+    and the serial itself at most every refresh seconds, so most requests are
+    answered from memory.
+    """
+
+    def __init__(self, refresh=SIMPLE_REFRESH):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._serial = None
+        self._checked = 0
+
+    def _current_serial(self, storage):
+        now = time.monotonic()
+        with self._lock:
+            if self._serial is not None and now - self._checked < self.refresh:
+                return self._serial
+        serial = storage.index_serial()
+        with self._lock:
+            if serial != self._serial:
+                self._pages.clear()
+            self._serial, self._checked = serial, now
+        return serial
+
+    def get(self, storage, path, fmt):
+        """Return (etag, body) of a page, or None when it does not exist."""
+        serial = self._current_serial(storage)
+        with self._lock:
+            if (path, fmt) in self._pages:
+                return self._pages[(path, fmt)]
+        page = storage.index_page(path, fmt)
+        if page is None and path == ROOT:
+            # Nothing has been published yet
+            page = render_root([])[(ROOT, fmt)]
+        with self._lock:
+            if self._serial == serial:
+                self._pages[(path, fmt)] = page
+        return page
+
+
+page_cache = PageCache()
+
+
+def simple_response(storage, project=None):
+    """Serve the root or a project page in the negotiated format, answering 304 when unchanged."""
+    if project is not None and normalize(project) != project:
+        return redirect(f"/simple/{normalize(project)}/", code=301)
+    content_type = negotiate()
+    if content_type is None:
+        return jsonify({'error': 'Not acceptable', 'available': sorted(set(SERVED_AS.values()) | {'text/html'})}), 406
+    page = page_cache.get(storage, ROOT if project is None else project, CONTENT_TYPES[content_type])
+    if page is None:
+        return jsonify({'error': 'Project not found'}), 404
+    etag, body = page
+    # The same page is served as text/html and as the v1 HTML type
+    etag = f"{etag}-{CONTENT_TYPES[content_type]}" if content_type != 'text/html' else etag
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, content_type=content_type if 'json' in content_type
+                            else f"{content_type}; charset=utf-8")
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={SIMPLE_MAX_AGE}"
+    response.vary.add('Accept')
+    return response
+
+
+def init_simple_index(app):
+    """Register the rebuild-simple-index command, which indexes builds made before the index existed."""
+    import click
+
+    @app.cli.command('rebuild-simple-index')
+    def rebuild_simple_index():
+        """Publish the wheels of all successful builds on the simple index."""
+        from ..worker.tasks import simple_index, storage
+        count = simple_index.rebuild(storage.list_builds())
+        click.echo(f"Indexed {count} wheels")
+
+    return app
@@ -0,0 +1,80 @@
+# Startup profiling: what importing pybins and creating the app costs, module by module
+import json
+import os
+import re
+import subprocess
+import sys
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+# Runs in a fresh interpreter so nothing is already imported
+_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import pybins
+imported = time.perf_counter()
+pybins.create_app()
+created = time.perf_counter()
+sys.stdout.write(json.dumps({"import_seconds": imported - started, "create_app_seconds": created - imported}))
+'''
+
+
+def parse_importtime(text):
+    """Parse `python -X importtime` output into one record per module, in import order."""
+    modules = []
+    for line in text.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            modules.append({
+                'module': match.group(4),
+                'self_seconds': int(match.group(1)) / 1e6,
+                'cumulative_seconds': int(match.group(2)) / 1e6,
+                'depth': len(match.group(3)) // 2,
+            })
+    return modules
+
+
+def profile_startup(top=25, python=None, env=None):
+    """Import pybins and create the app in a child interpreter; report where the time went.
+
+    modules lists the top modules by cumulative import time, packages the
+    self time summed per top-level package.
+    """
+    child_env = dict(os.environ if env is None else env)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    child_env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, child_env.get('PYTHONPATH')]))
+    proc = subprocess.run([python or sys.executable, '-X', 'importtime', '-c', _PROBE],
+                          capture_output=True, text=True, env=child_env)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Startup probe failed: {proc.stderr.strip().splitlines()[-1:]}")
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(proc.stderr)
+    packages = {}
+    for module in modules:
+        name = module['module'].split('.')[0]
+        packages[name] = packages.get(name, 0) + module['self_seconds']
+    return {
+        'import_seconds': round(timings['import_seconds'], 4),
+        'create_app_seconds': round(timings['create_app_seconds'], 4),
+        'modules_imported': len(modules),
+        'modules': sorted(modules, key=lambda m: m['cumulative_seconds'], reverse=True)[:top],
+        'packages': [{'package': name, 'self_seconds': round(seconds, 4)}
+                     for name, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]],
+    }
+
+
+def format_report(report):
+    """Render a startup profile as a plain-text table."""
+    lines = [
+        f"import pybins: {report['import_seconds'] * 1000:.1f} ms "
+        f"({report['modules_imported']} modules), create_app(): {report['create_app_seconds'] * 1000:.1f} ms",
+        '',
+        f"{'cumulative ms':>14} {'self ms':>9}  module",
+    ]
+    for module in report['modules']:
+        lines.append(f"{module['cumulative_seconds'] * 1000:>14.1f} {module['self_seconds'] * 1000:>9.1f}  "
+                     f"{'  ' * module['depth']}{module['module']}")
+    lines += ['', f"{'self ms':>14}  package"]
+    for package in report['packages']:
+        lines.append(f"{package['self_seconds'] * 1000:>14.1f}  {package['package']}")
+    return '\n'.join(lines)
@@ -1,26 +1,582 @@
+import base64
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from packaging.utils import canonicalize_version
+from packaging.version import Version, InvalidVersion
+
+DB_PATH = os.environ.get(
+    'PYBINS_DB_PATH',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts/pybins.db'))
+)
+# Non-terminal status transitions are buffered and written in one transaction
+BATCH_INTERVAL = float(os.environ.get('PYBINS_DB_BATCH_INTERVAL', 0.25))
+TERMINAL_STATUSES = ('success', 'failed', 'cancelled')
+ACTIVE_STATUSES = ('queued', 'pending', 'in_progress')
+_TERMINAL_SQL = ', '.join(f"'{status}'" for status in TERMINAL_STATUSES)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS builds (
+        build_id TEXT PRIMARY KEY,
+        package_name TEXT NOT NULL,
+        version TEXT,
+        build_type TEXT,
+        status TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        data TEXT NOT NULL,
+        name_key TEXT,
+        version_key TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_builds_package ON builds (package_name COLLATE NOCASE, version, build_type)',
+    'CREATE INDEX IF NOT EXISTS idx_builds_status ON builds (status)',
+    # (created_at, build_id) matches the listing order, so pages never need a sort
+    'DROP INDEX IF EXISTS idx_builds_created_at',
+    'CREATE INDEX IF NOT EXISTS idx_builds_created ON builds (created_at, build_id)',
+    'CREATE INDEX IF NOT EXISTS idx_builds_status_created ON builds (status, created_at, build_id)',
+    # Listings by package go through idx_builds_key_created on the normalised name
+    'DROP INDEX IF EXISTS idx_builds_package_created',
+    'CREATE INDEX IF NOT EXISTS idx_builds_status_updated ON builds (status, updated_at)',
+    '''CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''',
+    "INSERT OR IGNORE INTO meta (key, value) VALUES ('change_counter', 0)",
+    '''CREATE TABLE IF NOT EXISTS batches (
+        batch_id TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        data TEXT NOT NULL
+    )''',
+    # Wheels published on the simple index, and its pages rendered ahead of requests
+    '''CREATE TABLE IF NOT EXISTS index_files (
+        filename TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        build_id TEXT NOT NULL,
+        data TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_index_files_project ON index_files (project)',
+    'CREATE INDEX IF NOT EXISTS idx_index_files_build ON index_files (build_id)',
+    '''CREATE TABLE IF NOT EXISTS index_pages (
+        path TEXT NOT NULL,
+        format TEXT NOT NULL,
+        etag TEXT NOT NULL,
+        body BLOB NOT NULL,
+        PRIMARY KEY (path, format)
+    )''',
+    "INSERT OR IGNORE INTO meta (key, value) VALUES ('index_serial', 0)",
+    '''CREATE TABLE IF NOT EXISTS packages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        version TEXT,
+        source_url TEXT,
+        created_at TEXT NOT NULL
+    )''',
+]
+
+
+# Bumped whenever normalize_name/normalize_version change, so stored keys are recomputed
+BUILD_KEYS_VERSION = 2
+# Indexes on columns that older databases only get from _add_build_keys
+KEY_INDEXES = [
+    '''CREATE INDEX IF NOT EXISTS idx_builds_key
+       ON builds (name_key, version_key, build_type, status, created_at)''',
+    'CREATE INDEX IF NOT EXISTS idx_builds_key_created ON builds (name_key, created_at, build_id)',
+]
+
+
+def normalize_name(name):
+    """PEP 503 project name normalisation."""
+    return re.sub(r'[-_.]+', '-', name or '').lower()
+
+
+def normalize_version(version):
+    """PEP 440 canonical form of a version (1.0.0 and 1.0 both give 1); anything unparseable is just lowercased."""
+    if version is None:
+        return None
+    try:
+        Version(version)
+    except InvalidVersion:
+        return version.lower()
+    return canonicalize_version(version)
+
+
+class BuildTable:
+    """Dict-like view of the builds table.
+
+    Supports the mapping operations existing callers use (builds[id] = ...,
+    builds.get(id), builds.values(), len(builds), del builds[id]). Values are
+    plain dicts; changing one after storing it does not persist anything until
+    it is saved again.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __setitem__(self, build_id, build):
+        self._storage.save_build(dict(build, build_id=build_id), flush=True)
+
+    def __getitem__(self, build_id):
+        build = self.get(build_id)
+        if build is None:
+            raise KeyError(build_id)
+        return build
+
+    def __delitem__(self, build_id):
+        if not self._storage.delete_build(build_id):
+            raise KeyError(build_id)
+
+    def __contains__(self, build_id):
+        return self.get(build_id) is not None
+
+    def __len__(self):
+        return self._storage.count_builds()
+
+    def __iter__(self):
+        return iter([build['build_id'] for build in self.values()])
+
+    def get(self, build_id, default=None):
+        build = self._storage.get_build(build_id)
+        return default if build is None else build
+
+    def values(self):
+        return self._storage.list_builds()
+
+
 class PackageStorage:
-    def __init__(self):
-        self.packages = {}
-        self.builds = {}
+    """SQLite-backed store for builds and packages.
+
+    Every process that opens the same database file (web workers, RQ workers)
+    sees the same builds. The database runs in WAL mode so status polling
+    does not block builders, and each thread uses its own connection.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DB_PATH
+        self.builds = BuildTable(self)
         self.repositories = {}
         self.entry_scripts = {}
-        self.next_package_id = 1
-        self.next_build_id = 1
+        self._local = threading.local()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+        self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not cross a fork (RQ runs each job in a child process)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        self._add_build_keys(conn)
+        for statement in KEY_INDEXES:
+            conn.execute(statement)
+
+    def _build_keys_current(self, conn):
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(builds)')}
+        row = conn.execute("SELECT value FROM meta WHERE key = 'build_keys'").fetchone()
+        return 'name_key' in columns and row is not None and row['value'] == BUILD_KEYS_VERSION
+
+    def _add_build_keys(self, conn):
+        """Add and backfill the normalised name/version columns of databases created without them,
+        or whose keys were computed by an older normalisation."""
+        if self._build_keys_current(conn):
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not self._build_keys_current(conn):
+                columns = {row['name'] for row in conn.execute('PRAGMA table_info(builds)')}
+                if 'name_key' not in columns:
+                    conn.execute('ALTER TABLE builds ADD COLUMN name_key TEXT')
+                    conn.execute('ALTER TABLE builds ADD COLUMN version_key TEXT')
+                rows = conn.execute('SELECT build_id, package_name, version FROM builds').fetchall()
+                conn.executemany('UPDATE builds SET name_key = ?, version_key = ? WHERE build_id = ?', [
+                    (normalize_name(row['package_name']), normalize_version(row['version']), row['build_id'])
+                    for row in rows])
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('build_keys', ?)",
+                             (BUILD_KEYS_VERSION,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Packages
 
     def add_package(self, name, version, source_url):
-        package_id = self.next_package_id
-        package = {
-            'id': package_id,
-            'name': name,
-            'version': version, 
-            'source_url': source_url
-            
-        }
-        self.packages[package_id] = package
-        self.next_package_id += 1
-        return package_id
-    
+        cursor = self._connect().execute(
+            'INSERT INTO packages (name, version, source_url, created_at) VALUES (?, ?, ?, ?)',
+            (name, version, source_url, datetime.now().isoformat()))
+        return cursor.lastrowid
+
     def get_packages(self):
-        return list(self.packages.values())
-    
-    
\ No newline at end of file
+        rows = self._connect().execute('SELECT id, name, version, source_url FROM packages ORDER BY id')
+        return [dict(row) for row in rows]
+
+    # Builds
+
+    def save_build(self, build, flush=False):
+        """Persist a build record.
+
+        Terminal statuses (and flush=True) are written immediately; other
+        transitions are buffered briefly so that bursts of updates from many
+        concurrent builds share one transaction.
+        """
+        build = dict(build)
+        with self._pending_lock:
+            self._pending[build['build_id']] = build
+            schedule = self._flush_timer is None
+            if schedule and not flush and build.get('status') not in TERMINAL_STATUSES:
+                self._flush_timer = threading.Timer(BATCH_INTERVAL, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if flush or build.get('status') in TERMINAL_STATUSES:
+            self.flush()
+
+    def save_builds(self, builds):
+        """Persist several build records in one transaction."""
+        with self._pending_lock:
+            for build in builds:
+                self._pending[build['build_id']] = dict(build)
+        self.flush()
+
+    def flush(self):
+        """Write all buffered build records in a single transaction.
+
+        A record never replaces a finished one with an unfinished status: a
+        flush holding an older in_progress record can commit after the flush
+        of the final one. If the write fails, the records are buffered again.
+        """
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if not pending:
+            return
+        now = datetime.now().isoformat()
+        rows = [(
+            build['build_id'],
+            build.get('package_name', ''),
+            build.get('version'),
+            build.get('build_type'),
+            build.get('status'),
+            build.get('queued_at') or build.get('started_at') or now,
+            now,
+            json.dumps(build),
+            normalize_name(build.get('package_name')),
+            normalize_version(build.get('version')),
+        ) for build in pending]
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self._rebuffer(pending)
+            raise
+        try:
+            conn.executemany(
+                f'''INSERT INTO builds (build_id, package_name, version, build_type, status,
+                                       created_at, updated_at, data, name_key, version_key)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(build_id) DO UPDATE SET
+                       package_name = excluded.package_name,
+                       version = excluded.version,
+                       build_type = excluded.build_type,
+                       status = excluded.status,
+                       updated_at = excluded.updated_at,
+                       data = excluded.data,
+                       name_key = excluded.name_key,
+                       version_key = excluded.version_key
+                   WHERE COALESCE(builds.status, '') NOT IN ({_TERMINAL_SQL}) OR excluded.status IN ({_TERMINAL_SQL})''', rows)
+            self._bump_change_counter(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            self._rebuffer(pending)
+            raise
+
+    def _rebuffer(self, builds):
+        with self._pending_lock:
+            for build in builds:
+                # Records saved since the failed flush are newer
+                self._pending.setdefault(build['build_id'], build)
+
+    def get_build(self, build_id):
+        with self._pending_lock:
+            pending = self._pending.get(build_id)
+        if pending is not None:
+            return dict(pending)
+        row = self._connect().execute('SELECT data FROM builds WHERE build_id = ?', (build_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def get_builds(self, build_ids):
+        """Return {build_id: build} for the given ids that exist."""
+        self.flush()
+        build_ids = list(build_ids)
+        builds = {}
+        conn = self._connect()
+        # Stay well below SQLite's host parameter limit
+        for start in range(0, len(build_ids), 500):
+            chunk = build_ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT build_id, data FROM builds WHERE build_id IN ({', '.join('?' * len(chunk))})", chunk)
+            for row in rows:
+                builds[row['build_id']] = json.loads(row['data'])
+        return builds
+
+    def delete_build(self, build_id):
+        with self._pending_lock:
+            buffered = self._pending.pop(build_id, None) is not None
+        conn = self._connect()
+        cursor = conn.execute('DELETE FROM builds WHERE build_id = ?', (build_id,))
+        if cursor.rowcount:
+            self._bump_change_counter(conn)
+        return buffered or cursor.rowcount > 0
+
+    def count_builds(self):
+        self.flush()
+        return self._connect().execute('SELECT COUNT(*) FROM builds').fetchone()[0]
+
+    def list_builds(self):
+        self.flush()
+        rows = self._connect().execute('SELECT data FROM builds ORDER BY created_at, build_id')
+        return [json.loads(row['data']) for row in rows]
+
+    def query_builds(self, status=None, package_name=None, version=None,
+                     created_after=None, created_before=None, cursor=None, limit=100):
+        """Return one page of builds, newest first, and the cursor for the next page.
+
+        Pages are keyed on (created_at, build_id) rather than offsets, so each
+        page costs the same however deep into the history it is.
+        """
+        self.flush()
+        clauses = []
+        params = []
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if package_name:
+            clauses.append('name_key = ?')
+            params.append(normalize_name(package_name))
+        if version:
+            clauses.append('version_key = ?')
+            params.append(normalize_version(version))
+        if created_after:
+            clauses.append('created_at >= ?')
+            params.append(created_after)
+        if created_before:
+            clauses.append('created_at < ?')
+            params.append(created_before)
+        if cursor:
+            created_at, build_id = decode_cursor(cursor)
+            clauses.append('(created_at < ? OR (created_at = ? AND build_id < ?))')
+            params.extend([created_at, created_at, build_id])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._connect().execute(
+            f'SELECT build_id, created_at, data FROM builds {where} '
+            'ORDER BY created_at DESC, build_id DESC LIMIT ?',
+            params + [limit + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['build_id'])
+        return [json.loads(row['data']) for row in rows], next_cursor
+
+    def count_active_builds(self, updated_after=None, client=None):
+        """Count queued and running builds, optionally for one client.
+
+        Returns {'queued': n, 'batched': b, 'running': m}, where batched
+        counts the queued builds of batches and queued the others. Records
+        not updated since updated_after are ignored so that a job lost with
+        a crashed worker does not hold its slot forever.
+        """
+        self.flush()
+        clauses = [f"status IN ({', '.join('?' * len(ACTIVE_STATUSES))})"]
+        params = list(ACTIVE_STATUSES)
+        if updated_after:
+            clauses.append('updated_at >= ?')
+            params.append(updated_after)
+        if client:
+            clauses.append("json_extract(data, '$.client') = ?")
+            params.append(client)
+        rows = self._connect().execute(
+            f"""SELECT status, json_extract(data, '$.batch_id') IS NOT NULL AS batched, COUNT(*) AS n
+                FROM builds WHERE {' AND '.join(clauses)} GROUP BY status, batched""",
+            params)
+        counts = {'queued': 0, 'batched': 0, 'running': 0}
+        for row in rows:
+            if row['status'] != 'queued':
+                counts['running'] += row['n']
+            else:
+                counts['batched' if row['batched'] else 'queued'] += row['n']
+        return counts
+
+    def recent_build_durations(self, limit=50):
+        """Return the durations in seconds of the most recently finished builds."""
+        self.flush()
+        rows = self._connect().execute(
+            '''SELECT data FROM builds WHERE status IN ('success', 'failed')
+               ORDER BY updated_at DESC LIMIT ?''', (limit,))
+        durations = []
+        for row in rows:
+            build = json.loads(row['data'])
+            try:
+                started = datetime.fromisoformat(build['started_at'])
+                finished = datetime.fromisoformat(build['finished_at'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            durations.append(max((finished - started).total_seconds(), 0.0))
+        return durations
+
+    # Batches
+
+    def save_batch(self, batch):
+        self._connect().execute(
+            '''INSERT INTO batches (batch_id, created_at, data) VALUES (?, ?, ?)
+               ON CONFLICT(batch_id) DO UPDATE SET data = excluded.data''',
+            (batch['batch_id'], batch.get('created_at') or datetime.now().isoformat(), json.dumps(batch)))
+
+    def get_batch(self, batch_id):
+        row = self._connect().execute('SELECT data FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def change_counter(self):
+        """Return a number that changes whenever any build is written or deleted."""
+        self.flush()
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'change_counter'").fetchone()
+        return row[0] if row else 0
+
+    def _bump_change_counter(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'change_counter'")
+
+    # Simple index
+
+    def update_index(self, files=(), remove_build_ids=(), render=None):
+        """Add and remove simple-index files and store the re-rendered pages in one transaction.
+
+        files are dicts with at least filename, project and build_id; a file
+        with the same name replaces the old one. render is called inside the
+        transaction with (changed projects, {project: files}, all projects)
+        and returns {(path, format): (etag, body), or None to delete the page}.
+        Returns the set of changed projects.
+        """
+        remove_build_ids = list(remove_build_ids)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            changed = set()
+            for start in range(0, len(remove_build_ids), 500):
+                chunk = remove_build_ids[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                changed.update(row['project'] for row in conn.execute(
+                    f"SELECT DISTINCT project FROM index_files WHERE build_id IN ({placeholders})", chunk))
+                conn.execute(f"DELETE FROM index_files WHERE build_id IN ({placeholders})", chunk)
+            for entry in files:
+                previous = conn.execute('SELECT project FROM index_files WHERE filename = ?',
+                                        (entry['filename'],)).fetchone()
+                if previous:
+                    changed.add(previous['project'])
+                conn.execute(
+                    '''INSERT INTO index_files (filename, project, build_id, data) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(filename) DO UPDATE SET
+                           project = excluded.project, build_id = excluded.build_id, data = excluded.data''',
+                    (entry['filename'], entry['project'], entry['build_id'], json.dumps(entry)))
+                changed.add(entry['project'])
+            if changed and render is not None:
+                files_by_project = {project: [] for project in changed}
+                for project in changed:
+                    rows = conn.execute('SELECT data FROM index_files WHERE project = ? ORDER BY filename',
+                                        (project,))
+                    files_by_project[project] = [json.loads(row['data']) for row in rows]
+                projects = [row['project'] for row in conn.execute(
+                    'SELECT DISTINCT project FROM index_files ORDER BY project')]
+                for (path, fmt), page in render(changed, files_by_project, projects).items():
+                    if page is None:
+                        conn.execute('DELETE FROM index_pages WHERE path = ? AND format = ?', (path, fmt))
+                    else:
+                        conn.execute(
+                            '''INSERT INTO index_pages (path, format, etag, body) VALUES (?, ?, ?, ?)
+                               ON CONFLICT(path, format) DO UPDATE SET etag = excluded.etag, body = excluded.body''',
+                            (path, fmt, page[0], page[1]))
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'index_serial'")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return changed
+
+    def index_page(self, path, fmt):
+        """Return (etag, body) of a rendered simple-index page, or None."""
+        row = self._connect().execute('SELECT etag, body FROM index_pages WHERE path = ? AND format = ?',
+                                      (path, fmt)).fetchone()
+        return (row['etag'], bytes(row['body'])) if row else None
+
+    def index_serial(self):
+        """Return a number that changes whenever a simple-index page is rewritten."""
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'index_serial'").fetchone()
+        return row[0] if row else 0
+
+    def top_packages(self, limit=100):
+        """Return the names of the most built packages, most builds first."""
+        self.flush()
+        rows = self._connect().execute(
+            '''SELECT package_name, COUNT(*) AS builds FROM builds
+               GROUP BY package_name COLLATE NOCASE ORDER BY builds DESC LIMIT ?''',
+            (limit,)).fetchall()
+        return [row['package_name'] for row in rows]
+
+    def latest_build(self, package_name, version, build_type, status='success'):
+        """Return the newest build for (package, version, build_type) with the given status.
+
+        Names match after PEP 503 normalisation and versions after PEP 440
+        normalisation, as in build_key.
+        """
+        self.flush()
+        row = self._connect().execute(
+            '''SELECT data FROM builds
+               WHERE name_key = ? AND version_key = ? AND build_type = ? AND status = ?
+               ORDER BY created_at DESC LIMIT 1''',
+            (normalize_name(package_name), normalize_version(version), build_type, status)).fetchone()
+        return json.loads(row['data']) if row else None
+
+
+def encode_cursor(created_at, build_id):
+    raw = json.dumps([created_at, build_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor; raises ValueError when it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, build_id = json.loads(raw)
+        return str(created_at), str(build_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_storage(db_path=None):
+    """Return the process-wide PackageStorage for db_path."""
+    db_path = db_path or DB_PATH
+    with _shared_lock:
+        if db_path not in _shared:
+            _shared[db_path] = PackageStorage(db_path)
+        return _shared[db_path]
@@ -0,0 +1,241 @@
+# Batch build submission and batch metadata lookups
+import os
+import uuid
+from datetime import datetime
+from .dedup import build_key
+from .tasks import storage, build_index, run_build, new_build_id, BUILD_TYPES, TERMINAL_STATUSES
+from ..queue.fair import job_id_for, ACTIVE_JOB_STATUSES, BATCH_PRIORITY
+from ..fetcher.selector import parse_target, TargetError
+
+BATCH_MAX_SIZE = int(os.environ.get('PYBINS_BATCH_MAX_SIZE', 500))
+# Parallel PyPI lookups per batch (keep at or below PYBINS_HTTP_POOL_MAXSIZE)
+BATCH_CONCURRENCY = int(os.environ.get('PYBINS_BATCH_CONCURRENCY', 16))
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_batch(data):
+    """Validate a batch body and drop duplicate entries.
+
+    Accepts a list, or {"packages": [...]}, of {package, version,
+    build_type, target, force} objects (a bare string is a package name).
+    Returns (entries, errors, duplicates).
+    """
+    items = data.get('packages') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise BatchError('A non-empty list of packages is required')
+    if len(items) > BATCH_MAX_SIZE:
+        raise BatchError(f'A batch may contain at most {BATCH_MAX_SIZE} packages')
+    entries = []
+    errors = []
+    seen = set()
+    duplicates = 0
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'package': item}
+        if not isinstance(item, dict) or not item.get('package'):
+            errors.append({'index': index, 'error': 'Package name is required'})
+            continue
+        build_type = item.get('build_type', 'wheel')
+        if build_type not in BUILD_TYPES:
+            errors.append({'index': index, 'package': item['package'],
+                           'error': f"Unknown build type: {build_type}"})
+            continue
+        try:
+            target = parse_target(item.get('target'))
+        except TargetError as e:
+            errors.append({'index': index, 'package': item['package'], 'error': str(e)})
+            continue
+        entry = {
+            'package': item['package'],
+            'version': item.get('version') or 'latest',
+            'build_type': build_type,
+            'target': target,
+            'force': bool(item.get('force', False)),
+        }
+        key = build_key(entry['package'], entry['version'], build_type, entry['target'])
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        entries.append(entry)
+    return entries, errors, duplicates
+
+
+def resolve_metadata(entries, concurrency=BATCH_CONCURRENCY):
+    """Fetch PyPI metadata for all entries concurrently; results line up with entries."""
+    from ..fetcher.aio import fetch_many_from_pypi
+    return fetch_many_from_pypi([(entry['package'], None if entry['version'] == 'latest' else entry['version'],
+                                  entry.get('target')) for entry in entries], concurrency)
+
+
+def metadata_summary(metadata, tool):
+    """The public fields of a package's metadata, as served by /meta."""
+    return {
+        'name': metadata.get('name', tool),
+        'version': metadata.get('version', 'unknown'),
+        'author': metadata.get('author', 'Unknown'),
+        'description': metadata.get('description', 'No description available'),
+        'package_url': metadata.get('package_url', '')
+    }
+
+
+def meta_batch(data):
+    """Look up metadata for many packages at once."""
+    entries, errors, duplicates = parse_batch(data)
+    results = []
+    for entry, metadata in zip(entries, resolve_metadata(entries)):
+        if metadata:
+            results.append(dict(metadata_summary(metadata, entry['package']),
+                                package=entry['package'], requested_version=entry['version'], found=True))
+        else:
+            results.append({'package': entry['package'], 'requested_version': entry['version'],
+                            'found': False, 'error': 'Package not found'})
+    return {'results': results, 'errors': errors, 'duplicates': duplicates}
+
+
+def plan_batch(data, queue=None):
+    """Resolve a batch and decide which entries need a new build.
+
+    Returns (batch, pending): batch holds one item per unique build, with
+    reused and already-enqueued builds filled in; pending lists the
+    (item, entry) pairs that still have to be enqueued.
+    """
+    entries, errors, duplicates = parse_batch(data)
+    batch = {
+        'batch_id': uuid.uuid4().hex,
+        'created_at': datetime.now().isoformat(),
+        'items': [],
+        'errors': errors,
+        'duplicates': duplicates,
+    }
+    candidates = []
+    seen = set()
+    for entry, metadata in zip(entries, resolve_metadata(entries)):
+        item = {'package': entry['package'], 'requested_version': entry['version'],
+                'build_type': entry['build_type']}
+        if entry['target']:
+            item['target'] = entry['target']
+        if not metadata:
+            item.update(status='failed', error='Package not found')
+            batch['items'].append(item)
+            continue
+        item['version'] = metadata['version']
+        entry = dict(entry, version=metadata['version'])
+        key = build_key(entry['package'], entry['version'], entry['build_type'], entry['target'])
+        # 'latest' and an explicit version may name the same build
+        if key in seen:
+            batch['duplicates'] += 1
+            continue
+        seen.add(key)
+        batch['items'].append(item)
+        if not entry['force']:
+            existing = build_index.find(key)
+            if existing:
+                item.update(build_id=existing['build_id'], status='success', deduplicated='completed')
+                continue
+        candidates.append((item, entry, key))
+
+    # One round trip to check every job already enqueued for these keys
+    pending = []
+    job_ids = [job_id_for(key) for _, entry, key in candidates if not entry['force']]
+    jobs = {job.id: job for job in queue.fetch_jobs(job_ids)} if queue is not None and job_ids else {}
+    for item, entry, key in candidates:
+        job = None if entry['force'] else jobs.get(job_id_for(key))
+        if job is not None and job.get_status(refresh=False) in ACTIVE_JOB_STATUSES:
+            item.update(job_id=job.id, build_id=job.kwargs.get('build_id'),
+                        status='queued', deduplicated='in_flight')
+            continue
+        pending.append((item, dict(entry, key=key)))
+    return batch, pending
+
+
+def submit_batch(batch, pending, queue, client=None, priority=BATCH_PRIORITY):
+    """Record and enqueue the pending builds of a planned batch in one queue round trip.
+
+    Builds are queued at priority on behalf of client, so a large batch
+    shares the workers fairly with other clients' builds.
+    """
+    now = datetime.now().isoformat()
+    placeholders = []
+    calls = []
+    for item, entry in pending:
+        build_id = new_build_id(entry['package'], entry['version'], entry['build_type'])
+        placeholder = {
+            'build_id': build_id,
+            'package_name': entry['package'],
+            'version': entry['version'],
+            'build_type': entry['build_type'],
+            'status': 'queued',
+            'queued_at': now,
+            'batch_id': batch['batch_id'],
+            'priority': priority,
+        }
+        if client:
+            placeholder['client'] = client
+        placeholders.append(placeholder)
+        calls.append((run_build, (entry['package'], entry['version'], entry['build_type']),
+                      {'force': entry['force'], 'build_id': build_id,
+                       'target': entry['target'], 'client': client},
+                      None if entry['force'] else job_id_for(entry['key'])))
+        item.update(build_id=build_id, status='queued')
+    if pending:
+        # Placeholders go in first so the builds count against admission limits
+        storage.save_builds(placeholders)
+        try:
+            jobs = queue.submit_many(calls, priority, client)
+        except Exception:
+            for placeholder in placeholders:
+                storage.delete_build(placeholder['build_id'])
+            raise
+        for (item, entry), (job, created) in zip(pending, jobs):
+            item['job_id'] = job.id
+            if not created:
+                # Enqueued by someone else since the batch was planned
+                storage.delete_build(item['build_id'])
+                item.update(build_id=job.kwargs.get('build_id'), deduplicated='in_flight')
+    batch['priority'] = priority
+    if client:
+        batch['client'] = client
+    storage.save_batch(batch)
+    return batch_summary(batch)
+
+
+def batch_summary(batch):
+    """Aggregate the status of every build in a batch."""
+    items = batch['items']
+    builds = storage.get_builds([item['build_id'] for item in items if item.get('build_id')])
+    counts = {}
+    for item in items:
+        build = builds.get(item.get('build_id'))
+        if build is not None:
+            item['status'] = build.get('status')
+            for field in ('download_url', 'log_url', 'finished_at'):
+                if build.get(field):
+                    item[field] = build[field]
+        elif item.get('build_id') and item.get('status') not in TERMINAL_STATUSES:
+            # The worker coalesced this build with an identical one
+            done = storage.latest_build(item['package'], item['version'], item['build_type'])
+            if done:
+                item.update(status='success', same_as=done['build_id'],
+                            download_url=done.get('download_url'))
+        status = item.setdefault('status', 'unknown') or 'unknown'
+        counts[status] = counts.get(status, 0) + 1
+
+    finished = sum(n for status, n in counts.items() if status in TERMINAL_STATUSES)
+    if finished < len(items):
+        status = 'queued' if counts.get('queued', 0) == len(items) - finished and not finished else 'in_progress'
+    elif counts.get('success', 0) == len(items):
+        status = 'success'
+    elif counts.get('success', 0):
+        status = 'partial'
+    else:
+        status = 'failed'
+    return dict(batch, status=status, counts=counts, total=len(items), finished=finished)
+
+
+def get_batch_status(batch_id):
+    batch = storage.get_batch(batch_id)
+    return batch_summary(batch) if batch else None
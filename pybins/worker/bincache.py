@@ -0,0 +1,238 @@
+# Persistent PyInstaller work directories for repeated binary builds
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from importlib import metadata
+from .executor import run_build_command
+from ..metrics.metrics import registry
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+BINARY_CACHE = os.environ.get('PYBINS_BINARY_CACHE', '1').lower() not in ('0', 'false', 'no')
+BINARY_CACHE_DIR = os.environ.get(
+    'PYBINS_BINARY_CACHE_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts/.pyinstaller'))
+)
+BINARY_CACHE_SIZE = int(os.environ.get('PYBINS_BINARY_CACHE_SIZE', 32))
+USED_FILE = 'entry.json'
+
+binary_cache_total = registry.counter(
+    'pybins_binary_cache_total', 'Binary builds by PyInstaller cache outcome')
+
+_fingerprint = None
+_fingerprint_lock = threading.Lock()
+
+
+def environment_fingerprint():
+    """Hash of the distributions installed in the builder, which PyInstaller collects from."""
+    global _fingerprint
+    with _fingerprint_lock:
+        if _fingerprint is None:
+            installed = sorted(f"{dist.metadata['Name']}=={dist.version}".lower()
+                               for dist in metadata.distributions() if dist.metadata['Name'])
+            _fingerprint = hashlib.sha256('\n'.join(installed).encode('utf-8')).hexdigest()[:16]
+        return _fingerprint
+
+
+def cache_key(package_name, requires):
+    """Key a work directory by package, builder Python and dependency set, but not version.
+
+    A new release with the same dependencies reuses the previous release's
+    analysis, so only modules whose files changed are processed again.
+    """
+    ident = json.dumps({
+        'package': package_name.lower().replace('_', '-'),
+        'python': f"{sys.version_info[0]}.{sys.version_info[1]}",
+        'platform': sys.platform,
+        'requires': sorted(requires or []),
+        'environment': environment_fingerprint(),
+    })
+    return hashlib.sha256(ident.encode('utf-8')).hexdigest()[:16]
+
+
+def sync_tree(src, dest):
+    """Make dest a copy of src, rewriting only the files whose content changed.
+
+    Unchanged files keep their old mtime and rewritten ones get the current
+    time, so PyInstaller's up-to-date checks see exactly what changed
+    (archive members carry release-time mtimes that may predate the last
+    build). Returns (changed, unchanged) file counts.
+    """
+    changed = unchanged = 0
+    present = set()
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        if os.path.isfile(os.path.join(dest, rel)):
+            os.remove(os.path.join(dest, rel))
+        os.makedirs(os.path.join(dest, rel), exist_ok=True)
+        present.add(os.path.normpath(rel))
+        for name in files:
+            src_path = os.path.join(root, name)
+            dest_path = os.path.join(dest, rel, name)
+            present.add(os.path.normpath(os.path.join(rel, name)))
+            if os.path.isfile(dest_path) and filecmp.cmp(src_path, dest_path, shallow=False):
+                unchanged += 1
+                continue
+            if os.path.lexists(dest_path) and not os.path.isfile(dest_path):
+                shutil.rmtree(dest_path, ignore_errors=True)
+            shutil.copyfile(src_path, dest_path)
+            changed += 1
+    # Files and directories the new source no longer has
+    for root, dirs, files in os.walk(dest, topdown=False):
+        rel = os.path.relpath(root, dest)
+        for name in files:
+            if os.path.normpath(os.path.join(rel, name)) not in present:
+                os.remove(os.path.join(root, name))
+        if os.path.normpath(rel) not in present:
+            shutil.rmtree(root, ignore_errors=True)
+    return changed, unchanged
+
+
+def source_root(extract_dir, main_script):
+    """The extracted directory to cache: the archive's single top-level directory if any.
+
+    Dropping the versioned top-level name (e.g. pkg-1.2.3/) keeps paths
+    stable across releases, which PyInstaller needs to reuse its analysis.
+    """
+    entries = os.listdir(extract_dir)
+    if len(entries) == 1:
+        top = os.path.join(extract_dir, entries[0])
+        if os.path.isdir(top) and main_script.startswith(top + os.sep):
+            return top
+    return extract_dir
+
+
+def _stage_mtimes(work_dir):
+    stages = {}
+    for root, _, files in os.walk(work_dir):
+        for name in files:
+            if name.endswith(('.toc', '.pyz', '.pkg')):
+                path = os.path.join(root, name)
+                stages[os.path.relpath(path, work_dir)] = os.path.getmtime(path)
+    return stages
+
+
+class BinaryCache:
+    """PyInstaller work and spec directories kept between builds.
+
+    Each entry under directory holds a stable copy of the source (src/),
+    PyInstaller's work directory (work/) and the spec file (spec/). Builds
+    of the same key take an exclusive flock on the entry; a build that finds
+    it busy runs uncached rather than waiting. The least recently used
+    entries beyond max_entries are removed when a new entry is created.
+    """
+
+    def __init__(self, directory=BINARY_CACHE_DIR, max_entries=BINARY_CACHE_SIZE):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    @contextmanager
+    def entry(self, key):
+        """Yield the entry directory for key, or None if another build is using it."""
+        if fcntl is None:
+            # Without file locks an entry cannot be claimed; build uncached
+            yield None
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(key) + '.lock', 'a+') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                path = self._path(key)
+                created = not os.path.isdir(path)
+                os.makedirs(path, exist_ok=True)
+                with open(os.path.join(path, USED_FILE), 'w') as f:
+                    json.dump({'last_used': time.time()}, f)
+                if created:
+                    self.evict(keep=key)
+                yield path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries beyond max_entries that are not in use."""
+        if fcntl is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            used = os.path.join(self.directory, name, USED_FILE)
+            if name != keep and os.path.isfile(used):
+                entries.append((os.path.getmtime(used), name))
+        excess = len(entries) + (1 if keep else 0) - self.max_entries
+        for _, name in sorted(entries):
+            if excess <= 0:
+                break
+            with open(self._path(name) + '.lock', 'a+') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    shutil.rmtree(self._path(name), ignore_errors=True)
+                    excess -= 1
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+binary_cache = BinaryCache()
+
+
+def build_binary(build_id, package_name, requires, extract_dir, main_script, bin_dir, logf):
+    """Run pyinstaller --onefile for main_script, reusing a cached work directory when possible.
+
+    Returns a description of the cache's effect for the build result:
+    status (hit, miss or bypass), the source files changed since the cached
+    build, and which PyInstaller stages were reused or rebuilt.
+    """
+    command = ['pyinstaller', '--onefile', '--noconfirm', '--distpath', bin_dir]
+    if not BINARY_CACHE:
+        run_build_command(build_id, command + [main_script], os.path.dirname(main_script), logf)
+        return {'status': 'disabled'}
+    key = cache_key(package_name, requires)
+    with binary_cache.entry(key) as entry:
+        if entry is None:
+            logf.write("PyInstaller cache entry is busy; building without it\n")
+            logf.flush()
+            binary_cache_total.inc(outcome='bypass')
+            run_build_command(build_id, command + [main_script], os.path.dirname(main_script), logf)
+            return {'key': key, 'status': 'bypass'}
+        root = source_root(extract_dir, main_script)
+        src_dir = os.path.join(entry, 'src')
+        work_dir = os.path.join(entry, 'work')
+        spec_dir = os.path.join(entry, 'spec')
+        os.makedirs(spec_dir, exist_ok=True)
+        changed, unchanged = sync_tree(root, src_dir)
+        script = os.path.join(src_dir, os.path.relpath(main_script, root))
+        before = _stage_mtimes(work_dir)
+        logf.write(f"Using PyInstaller cache {key}: {changed} source files changed, {unchanged} unchanged\n")
+        logf.flush()
+        run_build_command(build_id, command + ['--workpath', work_dir, '--specpath', spec_dir, script],
+                          os.path.dirname(script), logf)
+        after = _stage_mtimes(work_dir)
+    reused = sorted(stage for stage, mtime in after.items() if before.get(stage) == mtime)
+    rebuilt = sorted(stage for stage in after if stage not in reused)
+    status = 'hit' if before else 'miss'
+    binary_cache_total.inc(outcome=status)
+    return {
+        'key': key,
+        'status': status,
+        'files_changed': changed,
+        'files_unchanged': unchanged,
+        'stages_reused': reused,
+        'stages_rebuilt': rebuilt,
+    }
@@ -0,0 +1,117 @@
+# Build result index and in-flight build coalescing
+import threading
+from ..storage.storage import normalize_name, normalize_version
+
+
+def build_key(package_name, version, build_type, target=None):
+    """Normalise a (package, version, build_type[, target]) request into an index key.
+
+    Names are PEP 503-normalised and versions PEP 440-normalised, matching
+    the keys the build store indexes.
+    """
+    key = (normalize_name(package_name), normalize_version(version), build_type)
+    if target:
+        key += (tuple(sorted((k, str(v)) for k, v in target.items())),)
+    return key
+
+
+class InFlightBuild:
+    """A build that is currently running; identical requests wait on it."""
+
+    def __init__(self, key, build_id):
+        self.key = key
+        self.build_id = build_id
+        self.package_name = None
+        self.version = None
+        self.result = None
+        self.waiters = 0
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the build finishes; returns its result or None on timeout."""
+        if self._done.wait(timeout):
+            return self.result
+        return None
+
+    def finish(self, result):
+        self.result = result
+        self._done.set()
+
+
+class BuildIndex:
+    """Index of successful builds and builds in progress.
+
+    Identical (package, version, build_type) requests are answered with the
+    last successful result while its artifact still exists (looked up in the
+    shared build store when this process has not seen it), or attached to the
+    running build instead of starting a second one. Builds on the queue
+    need no tracking here: their job ids are derived from the key
+    (pybins.queue.fair.job_id_for), so repeat enqueues find the same job.
+    """
+
+    def __init__(self, artifact_exists=None, lookup=None):
+        self._lock = threading.Lock()
+        self._results = {}
+        self._inflight = {}
+        self._artifact_exists = artifact_exists or (lambda result: True)
+        self._lookup = lookup
+
+    def find(self, key):
+        """Return the last successful result for key if its artifact is still present."""
+        with self._lock:
+            result = self._results.get(key)
+        if result is None and self._lookup is not None:
+            # Builds finished by other processes are only visible in the shared store
+            result = self._lookup(key)
+            if result is not None:
+                self.record(key, result)
+        if result is None:
+            return None
+        if result.get('status') != 'success' or not self._artifact_exists(result):
+            with self._lock:
+                if self._results.get(key) is result:
+                    del self._results[key]
+            return None
+        return result
+
+    def begin(self, key, build_id, force=False):
+        """Claim key for a new build.
+
+        Returns (inflight, owner). When another build for key is already
+        running and force is not set, that build is returned with owner=False
+        and the caller should wait on it instead of building.
+        """
+        with self._lock:
+            current = self._inflight.get(key)
+            if current is not None and not force:
+                current.waiters += 1
+                return current, False
+            inflight = InFlightBuild(key, build_id)
+            self._inflight[key] = inflight
+            return inflight, True
+
+    def finish(self, inflight, result):
+        """Record the outcome of a claimed build and wake any waiters."""
+        with self._lock:
+            if self._inflight.get(inflight.key) is inflight:
+                del self._inflight[inflight.key]
+            if result and result.get('status') == 'success':
+                self._results[inflight.key] = result
+        inflight.finish(result)
+
+    def record(self, key, result):
+        """Register a successful result produced elsewhere (e.g. by an RQ worker)."""
+        if result and result.get('status') == 'success':
+            with self._lock:
+                self._results[key] = result
+
+    def inflight(self, key):
+        with self._lock:
+            return self._inflight.get(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'results': len(self._results),
+                'in_flight': len(self._inflight),
+            }
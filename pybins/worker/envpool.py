@@ -0,0 +1,355 @@
+# Pool of warm, reusable build environments for python -m build
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from packaging.requirements import Requirement, InvalidRequirement
+from .executor import run_build_command
+from ..metrics.metrics import registry
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+BUILD_ENV_POOL = os.environ.get('PYBINS_BUILD_ENV_POOL', '1').lower() not in ('0', 'false', 'no')
+BUILD_ENV_DIR = os.environ.get(
+    'PYBINS_BUILD_ENV_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts/.buildenvs'))
+)
+BUILD_ENV_POOL_SIZE = int(os.environ.get('PYBINS_BUILD_ENV_POOL_SIZE', 16))
+# Seconds between health checks of an environment that is in use
+BUILD_ENV_CHECK_INTERVAL = float(os.environ.get('PYBINS_BUILD_ENV_CHECK_INTERVAL', 600))
+BUILD_ENV_TIMEOUT = float(os.environ.get('PYBINS_BUILD_ENV_TIMEOUT', 600))
+# Requirement sets to provision in the background, e.g. "setuptools>=61,wheel;hatchling"
+BUILD_ENV_PREWARM = os.environ.get('PYBINS_BUILD_ENV_PREWARM', '')
+
+# What PEP 517 frontends assume for projects without a [build-system] table
+DEFAULT_REQUIRES = ['setuptools>=40.8.0', 'wheel']
+READY_FILE = 'pybins-env.json'
+
+build_envs_total = registry.counter(
+    'pybins_build_envs_total', 'Wheel builds by build environment outcome')
+
+# Run inside an environment: exits non-zero unless build and every requirement are installed
+_HEALTH_CHECK = '''
+import sys, build
+from importlib.metadata import version
+from packaging.requirements import Requirement
+for line in sys.argv[1:]:
+    req = Requirement(line)
+    if req.marker is not None and not req.marker.evaluate():
+        continue
+    if not req.specifier.contains(version(req.name), prereleases=True):
+        sys.exit(f"{req.name} {version(req.name)} does not satisfy {line}")
+'''
+
+# Run inside an environment: prints the build-time requirements of a source tree it lacks.
+# Exits non-zero only if the backend cannot be imported; a project whose hook fails is
+# left to the build, which reports the error.
+_MISSING_REQUIRES = '''
+import json, sys, build
+from pyproject_hooks import BackendUnavailable, quiet_subprocess_runner
+builder = build.ProjectBuilder(sys.argv[1], runner=quiet_subprocess_runner)
+requires = builder.build_system_requires
+try:
+    requires = requires | builder.get_requires_for_build('wheel')
+except build.BuildBackendException as e:
+    if isinstance(e.exception, BackendUnavailable):
+        sys.exit(f"Backend unavailable: {e}")
+print(json.dumps(sorted(req for req in requires if any(True for _ in build.check_dependency(req)))))
+'''
+
+
+class BuildEnvError(Exception):
+    pass
+
+
+def build_requirements(build_root):
+    """Return the normalised [build-system].requires of a source tree.
+
+    Projects without pyproject.toml or a [build-system] table get the
+    setuptools defaults. Returns None when the requirements cannot be read,
+    in which case the build should run in an isolated environment.
+    """
+    pyproject = os.path.join(build_root, 'pyproject.toml')
+    if not os.path.isfile(pyproject):
+        return sorted(DEFAULT_REQUIRES)
+    if tomllib is None:
+        return None
+    try:
+        with open(pyproject, 'rb') as f:
+            build_system = tomllib.load(f).get('build-system')
+        if build_system is None:
+            return sorted(DEFAULT_REQUIRES)
+        return sorted({str(Requirement(line)) for line in build_system.get('requires', [])})
+    except (OSError, ValueError, TypeError, InvalidRequirement) as e:
+        print(f"Error reading build requirements: {e}")
+        return None
+
+
+def env_key(requires):
+    """Environments are shared by builds with the same requirements on the same interpreter."""
+    ident = json.dumps({'requires': sorted(requires), 'python': sys.version.split()[0],
+                        'executable': sys.executable})
+    return hashlib.sha256(ident.encode('utf-8')).hexdigest()[:16]
+
+
+class BuildEnvPool:
+    """Provisioned virtual environments, one per set of build requirements.
+
+    Each environment has `build` and the backend requirements installed, so
+    builds can run with --no-isolation instead of creating and populating a
+    fresh venv every time. Environments live on disk under directory and are
+    shared by every process. A shared flock marks an environment as in use;
+    provisioning and eviction take it exclusively. The least recently used
+    environments beyond max_envs are evicted when a new one is created, and
+    an environment that fails its health check is provisioned again.
+    """
+
+    def __init__(self, directory=BUILD_ENV_DIR, max_envs=BUILD_ENV_POOL_SIZE,
+                 check_interval=BUILD_ENV_CHECK_INTERVAL, python=sys.executable):
+        self.directory = directory
+        self.max_envs = max_envs
+        self.check_interval = check_interval
+        self.python = python
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    @staticmethod
+    def _python(path):
+        return os.path.join(path, 'Scripts' if os.name == 'nt' else 'bin',
+                            'python.exe' if os.name == 'nt' else 'python')
+
+    def _healthy(self, key, requires):
+        path = self._path(key)
+        python = self._python(path)
+        if not os.path.isfile(os.path.join(path, READY_FILE)) or not os.path.isfile(python):
+            return False
+        with self._lock:
+            checked = self._checked.get(key, 0)
+        if time.monotonic() - checked < self.check_interval:
+            return True
+        try:
+            subprocess.run([python, '-c', _HEALTH_CHECK, *requires], check=True, timeout=60,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError):
+            return False
+        with self._lock:
+            self._checked[key] = time.monotonic()
+        return True
+
+    def _provision(self, key, requires):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            with open(os.path.join(tmp_path, 'provision.log'), 'w') as logf:
+                for cmd in ([self.python, '-m', 'venv', tmp_path],
+                            # --upgrade: the setuptools bundled with the venv is usually old but already satisfies requires
+                            [self._python(tmp_path), '-m', 'pip', 'install', '--disable-pip-version-check',
+                             '--no-input', '--upgrade', 'build', *requires]):
+                    subprocess.run(cmd, check=True, timeout=BUILD_ENV_TIMEOUT,
+                                   stdout=logf, stderr=subprocess.STDOUT)
+            with open(os.path.join(tmp_path, READY_FILE), 'w') as f:
+                json.dump({'requires': requires, 'python': sys.version.split()[0],
+                           'created_at': time.time()}, f)
+            # venv scripts hard-code their directory; only the interpreter is run directly
+            os.rename(tmp_path, path)
+        except (OSError, subprocess.SubprocessError) as e:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise BuildEnvError(f"Could not provision build environment for {', '.join(requires)}: {e}")
+        with self._lock:
+            self._checked[key] = time.monotonic()
+
+    def _missing_requires(self, python, build_root):
+        """Requirements of build_root's backend, static and dynamic, that python lacks."""
+        try:
+            proc = subprocess.run([python, '-c', _MISSING_REQUIRES, build_root], check=True,
+                                  timeout=BUILD_ENV_TIMEOUT, capture_output=True, text=True)
+            return json.loads(proc.stdout.strip().splitlines()[-1])
+        except subprocess.CalledProcessError as e:
+            reason = (e.stderr or '').strip().splitlines()[-1:] or [str(e)]
+            raise BuildEnvError(f"Could not get build requirements from the backend: {reason[0]}")
+        except (OSError, subprocess.SubprocessError, ValueError, IndexError) as e:
+            raise BuildEnvError(f"Could not get build requirements from the backend: {e}")
+
+    def _install(self, python, requirements, logf=None):
+        if logf is not None:
+            logf.write(f"Installing build requirements {', '.join(requirements)}\n")
+            logf.flush()
+        try:
+            subprocess.run([python, '-m', 'pip', 'install', '--disable-pip-version-check', '--no-input',
+                            *requirements], check=True, timeout=BUILD_ENV_TIMEOUT,
+                           stdout=logf or subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise BuildEnvError(f"Could not install build requirements {', '.join(requirements)}: {e}")
+
+    @contextmanager
+    def environment(self, requires, build_root=None, logf=None):
+        """Yield the interpreter of a healthy environment providing requires.
+
+        The environment is provisioned on first use and cannot be evicted
+        while the block runs. With build_root, whatever else the backend asks
+        for at build time (get_requires_for_build_wheel) is installed into
+        the environment first. Raises BuildEnvError if the environment cannot
+        be created or completed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        key = env_key(requires)
+        with open(self._path(key) + '.lock', 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                if self._healthy(key, requires):
+                    outcome = 'warm'
+                else:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # Another process may have provisioned it while we waited
+                    if self._healthy(key, requires):
+                        outcome = 'warm'
+                    else:
+                        with self._lock:
+                            self._checked.pop(key, None)
+                        self._provision(key, requires)
+                        outcome = 'provisioned'
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_SH)
+                python = self._python(self._path(key))
+                if build_root is not None and self._missing_requires(python, build_root):
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # Ask again: another build may have installed them while we waited
+                    missing = self._missing_requires(python, build_root)
+                    if missing:
+                        self._install(python, missing, logf)
+                        outcome = 'extended'
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_SH)
+                # The ready file's mtime orders environments for LRU eviction
+                os.utime(os.path.join(self._path(key), READY_FILE))
+                build_envs_total.inc(outcome=outcome)
+                if outcome == 'provisioned':
+                    self.evict(keep=key)
+                yield python
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self, keep=None):
+        """Remove the least recently used environments beyond max_envs that are not in use."""
+        if fcntl is None:
+            # Without file locks there is no telling which environments are in use
+            return
+        envs = []
+        for name in os.listdir(self.directory):
+            ready = os.path.join(self.directory, name, READY_FILE)
+            if name != keep and not name.endswith('.tmp') and os.path.isfile(ready):
+                envs.append((os.path.getmtime(ready), name))
+        excess = len(envs) + (1 if keep else 0) - self.max_envs
+        for _, name in sorted(envs):
+            if excess <= 0:
+                break
+            with open(self._path(name) + '.lock', 'a+') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    shutil.rmtree(self._path(name), ignore_errors=True)
+                    with self._lock:
+                        self._checked.pop(name, None)
+                    excess -= 1
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def list(self):
+        """Describe the provisioned environments, most recently used first."""
+        envs = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return envs
+        for name in names:
+            ready = os.path.join(self.directory, name, READY_FILE)
+            try:
+                with open(ready) as f:
+                    info = json.load(f)
+                info.update(key=name, last_used=os.path.getmtime(ready))
+            except (OSError, ValueError):
+                continue
+            envs.append(info)
+        return sorted(envs, key=lambda info: info['last_used'], reverse=True)
+
+    def prewarm(self, requirement_sets):
+        """Provision environments ahead of the first build that needs them."""
+        for requires in requirement_sets:
+            try:
+                with self.environment(sorted(str(Requirement(line)) for line in requires)):
+                    pass
+            except (BuildEnvError, InvalidRequirement) as e:
+                print(f"Error prewarming build environment: {e}")
+
+
+build_env_pool = BuildEnvPool()
+_prewarm_started = False
+
+
+def _start_prewarm():
+    global _prewarm_started
+    if _prewarm_started or not BUILD_ENV_PREWARM.strip():
+        return
+    _prewarm_started = True
+    requirement_sets = [[line.strip() for line in group.split(',') if line.strip()]
+                        for group in BUILD_ENV_PREWARM.split(';') if group.strip()]
+    threading.Thread(target=build_env_pool.prewarm, args=(requirement_sets,), daemon=True).start()
+
+
+def build_wheel(build_id, build_root, wheel_dir, logf):
+    """Run python -m build --wheel, in a warm environment when one can be used.
+
+    Falls back to an isolated build only when the requirements cannot be
+    read or the environment cannot be provisioned or given the backend's
+    build-time requirements. A failing build is not retried: it would fail
+    the same way in isolation. Returns 'warm' or 'isolated'.
+    """
+    requires = build_requirements(build_root) if BUILD_ENV_POOL else None
+    if requires is not None:
+        _start_prewarm()
+        try:
+            with build_env_pool.environment(requires, build_root, logf) as python:
+                logf.write(f"Using warm build environment for {', '.join(requires) or 'no requirements'}\n")
+                logf.flush()
+                # The environment was just checked against the backend's requirements
+                run_build_command(build_id, [
+                    python, '-m', 'build', '--wheel', '--no-isolation', '--skip-dependency-check',
+                    '--outdir', wheel_dir
+                ], build_root, logf)
+            return 'warm'
+        except BuildEnvError as e:
+            logf.write(f"{e}; building in an isolated environment\n")
+            logf.flush()
+        build_envs_total.inc(outcome='fallback')
+    run_build_command(build_id, [
+        'python', '-m', 'build', '--wheel', '--outdir', wheel_dir
+    ], build_root, logf)
+    return 'isolated'
@@ -0,0 +1,179 @@
+# In-process background executor for builds
+import os
+import subprocess
+import threading
+from collections import deque
+
+BUILD_WORKERS = int(os.environ.get('PYBINS_BUILD_WORKERS', 2))
+BUILD_QUEUE_SIZE = int(os.environ.get('PYBINS_BUILD_QUEUE_SIZE', 32))
+TERMINATE_GRACE = 5
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class ExecutorFull(Exception):
+    pass
+
+
+# build_id -> threading.Event, set when a cancellation was requested
+_cancel_events = {}
+_cancel_lock = threading.Lock()
+
+
+def _cancel_event(build_id):
+    with _cancel_lock:
+        return _cancel_events.setdefault(build_id, threading.Event())
+
+
+def request_cancel(build_id):
+    _cancel_event(build_id).set()
+
+
+def is_cancelled(build_id):
+    with _cancel_lock:
+        event = _cancel_events.get(build_id)
+    return event is not None and event.is_set()
+
+
+def raise_if_cancelled(build_id):
+    if build_id and is_cancelled(build_id):
+        raise BuildCancelled(f"Build {build_id} was cancelled")
+
+
+def forget_cancel(build_id):
+    with _cancel_lock:
+        _cancel_events.pop(build_id, None)
+
+
+def run_build_command(build_id, cmd, cwd, logf, env=None):
+    """Run a build subprocess, terminating it if the build gets cancelled.
+
+    Behaves like subprocess.run(..., check=True): raises CalledProcessError
+    on a non-zero exit status.
+    """
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=logf, stderr=subprocess.STDOUT, env=env)
+    cancel = _cancel_event(build_id) if build_id else threading.Event()
+    while True:
+        try:
+            returncode = proc.wait(timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel.is_set():
+                proc.terminate()
+                try:
+                    proc.wait(timeout=TERMINATE_GRACE)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+                raise BuildCancelled(f"Build {build_id} was cancelled")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+class BuildJob:
+    def __init__(self, build_id, fn, args, kwargs, on_cancel=None):
+        self.build_id = build_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_cancel = on_cancel
+        self.status = 'queued'
+
+
+class BuildExecutor:
+    """Fixed pool of build threads fed from a bounded pending queue.
+
+    Jobs that have not started yet can be cancelled and are dropped from the
+    queue; running jobs are cancelled cooperatively through
+    raise_if_cancelled()/run_build_command(). Threads are started on the first
+    submit so importing this module stays cheap, and no Redis is needed.
+    """
+
+    def __init__(self, workers=BUILD_WORKERS, max_pending=BUILD_QUEUE_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._running = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._counters = {'submitted': 0, 'completed': 0, 'cancelled': 0, 'rejected': 0}
+
+    def submit(self, build_id, fn, *args, on_cancel=None, **kwargs):
+        """Queue fn(*args, **kwargs) under build_id; raises ExecutorFull when the queue is full."""
+        job = BuildJob(build_id, fn, args, kwargs, on_cancel)
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self._counters['rejected'] += 1
+                raise ExecutorFull(f"Build queue is full ({self.max_pending} pending)")
+            self._ensure_threads()
+            self._pending.append(job)
+            self._counters['submitted'] += 1
+            self._cond.notify()
+        return job
+
+    def cancel(self, build_id):
+        """Cancel a queued or running build. Returns False if it is unknown here."""
+        with self._cond:
+            job = next((j for j in self._pending if j.build_id == build_id), None)
+            if job is not None:
+                self._pending.remove(job)
+                job.status = 'cancelled'
+                self._counters['cancelled'] += 1
+            running = build_id in self._running
+        if job is not None:
+            if job.on_cancel:
+                job.on_cancel()
+            return True
+        if running:
+            request_cancel(build_id)
+            return True
+        return False
+
+    def position(self, build_id):
+        """Return the 1-based queue position of a pending build, or None."""
+        with self._cond:
+            for index, job in enumerate(self._pending):
+                if job.build_id == build_id:
+                    return index + 1
+        return None
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+            stats['running'] = len(self._running)
+        stats['workers'] = self.workers
+        stats['max_pending'] = self.max_pending
+        return stats
+
+    def _ensure_threads(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"pybins-build-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                job.status = 'running'
+                self._running[job.build_id] = job
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                print(f"Error running build {job.build_id}: {e}")
+            finally:
+                with self._cond:
+                    self._running.pop(job.build_id, None)
+                    job.status = 'done'
+                    self._counters['completed'] += 1
+                forget_cancel(job.build_id)
+
+
+build_executor = BuildExecutor()
@@ -0,0 +1,339 @@
+# Artifact lifecycle: disk usage accounting, scratch cleanup and LRU eviction under a quota
+import os
+import re
+import shutil
+import stat
+import threading
+import time
+from datetime import datetime
+from ..metrics.metrics import registry
+from ..storage.storage import TERMINAL_STATUSES
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+
+def parse_size(value):
+    """Parse a byte count such as 500M, 20G or 1073741824; 0 or empty means no limit."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', (value or '0').lower())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    scale = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}[match.group(2)]
+    return int(float(match.group(1)) * scale)
+
+
+ARTIFACT_QUOTA = parse_size(os.environ.get('PYBINS_ARTIFACT_QUOTA', '0'))
+# Eviction frees space down to this fraction of the quota, so it does not run after every build
+ARTIFACT_GC_TARGET = float(os.environ.get('PYBINS_ARTIFACT_GC_TARGET', 0.9))
+# Seconds between automatic collections after builds finish
+ARTIFACT_GC_INTERVAL = float(os.environ.get('PYBINS_ARTIFACT_GC_INTERVAL', 300))
+# Artifacts built or downloaded this recently are never evicted (covers other processes' downloads)
+ARTIFACT_GC_GRACE = float(os.environ.get('PYBINS_ARTIFACT_GC_GRACE', 3600))
+# Downloads refresh a build's access time at most this often
+ACCESS_RESOLUTION = 60
+
+BUILD_ID_RE = re.compile(r'.+-\d{8}_\d{6}_\d{6}$')
+SCRATCH_SUFFIX = '_src'
+DOWNLOAD_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.zip', '.whl', '.part')
+GC_LOCK_FILE = '.gc.lock'
+
+artifact_gc_bytes_total = registry.counter(
+    'pybins_artifact_gc_bytes_total', 'Bytes removed from the artifacts directory by kind')
+artifact_gc_items_total = registry.counter(
+    'pybins_artifact_gc_items_total', 'Items removed from the artifacts directory by kind')
+
+
+def _tree_usage(path, seen):
+    """Return (bytes, newest mtime) of a file or tree, counting hard-linked files once."""
+    try:
+        stats = [os.lstat(path)]
+    except OSError:
+        return 0, 0
+    if stat.S_ISDIR(stats[0].st_mode):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    stats.append(os.lstat(os.path.join(root, name)))
+                except OSError:
+                    continue
+    size = 0
+    for st in stats:
+        if stat.S_ISREG(st.st_mode) and (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_size
+    return size, max(st.st_mtime for st in stats)
+
+
+class ArtifactLifecycle:
+    """Keeps the artifacts directory under a byte quota.
+
+    The directory holds build outputs (<build_id>/), the content-addressed
+    source cache (cas/), scratch extraction trees (<build_id>_src/), plain
+    downloads and the self-managed caches of build environments and
+    PyInstaller. Scratch trees and downloads whose build is over are always
+    removed. When usage is above quota, build outputs and cached sources are
+    evicted least recently used first (build outputs by their last download,
+    sources by their last cache hit) until usage is back under
+    target * quota. Outputs of builds that are not finished, files being
+    served by this process and anything used within the grace period are
+    never evicted. Evicted builds keep their record, marked with evicted_at,
+    and are rebuilt on the next request.
+    """
+
+    def __init__(self, root, quota=ARTIFACT_QUOTA, target=ARTIFACT_GC_TARGET,
+                 interval=ARTIFACT_GC_INTERVAL, grace=ARTIFACT_GC_GRACE, storage=None, on_evict=None):
+        self.root = root
+        self.quota = quota
+        self.target = target
+        self.interval = interval
+        self.grace = grace
+        self.storage = storage
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._serving = {}
+        self._accessed = {}
+        self._collecting = False
+
+    def record_access(self, build_id):
+        """Record a download of build_id; the directory mtime orders builds for eviction."""
+        now = time.time()
+        with self._lock:
+            if now - self._accessed.get(build_id, 0) < ACCESS_RESOLUTION:
+                return
+            self._accessed[build_id] = now
+        path = os.path.join(self.root, build_id)
+        if os.path.isdir(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def serving(self, build_id, response):
+        """Protect build_id from eviction until response has been sent."""
+        if not hasattr(response, 'call_on_close'):
+            return response
+        with self._lock:
+            self._serving[build_id] = self._serving.get(build_id, 0) + 1
+
+        def done():
+            with self._lock:
+                remaining = self._serving.get(build_id, 1) - 1
+                if remaining:
+                    self._serving[build_id] = remaining
+                else:
+                    self._serving.pop(build_id, None)
+        response.call_on_close(done)
+        return response
+
+    def _build_statuses(self, build_ids):
+        if self.storage is None or not build_ids:
+            return {}
+        try:
+            return self.storage.get_builds(build_ids)
+        except Exception as e:
+            print(f"Error reading build records for artifact GC: {e}")
+            return {}
+
+    def scan(self):
+        """Classify and measure everything under root."""
+        items = []
+        seen = set()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return items
+        for name in names:
+            path = os.path.join(self.root, name)
+            if name == 'cas' and os.path.isdir(path):
+                for shard in os.listdir(path):
+                    shard_path = os.path.join(path, shard)
+                    if not os.path.isdir(shard_path):
+                        continue
+                    for digest in os.listdir(shard_path):
+                        digest_path = os.path.join(shard_path, digest)
+                        if os.path.isdir(digest_path):
+                            size, used = _tree_usage(digest_path, seen)
+                            items.append({'kind': 'source', 'name': f"cas/{shard}/{digest}",
+                                          'path': digest_path, 'bytes': size, 'last_used': used})
+                continue
+            if name.endswith(SCRATCH_SUFFIX) and os.path.isdir(path):
+                kind, build_id = 'scratch', name[:-len(SCRATCH_SUFFIX)]
+            elif os.path.isdir(path) and BUILD_ID_RE.match(name):
+                kind, build_id = 'build', name
+            elif os.path.isfile(path) and name.endswith(DOWNLOAD_SUFFIXES):
+                kind, build_id = 'download', None
+            else:
+                # Database, metrics, lock files and caches that evict themselves
+                kind, build_id = 'other', None
+            size, used = _tree_usage(path, seen)
+            items.append({'kind': kind, 'name': name, 'path': path, 'build_id': build_id,
+                          'bytes': size, 'last_used': used})
+        return items
+
+    def plan(self, items=None):
+        """Decide what a collection would remove; nothing is deleted."""
+        items = self.scan() if items is None else items
+        now = time.time()
+        builds = self._build_statuses({item['build_id'] for item in items if item.get('build_id')})
+        with self._lock:
+            serving = set(self._serving)
+        used = sum(item['bytes'] for item in items)
+        usage = {}
+        for item in items:
+            usage[item['kind']] = usage.get(item['kind'], 0) + item['bytes']
+
+        remove, candidates, protected = [], [], []
+        for item in items:
+            build = builds.get(item.get('build_id'))
+            active = build is not None and build.get('status') not in TERMINAL_STATUSES
+            recent = now - item['last_used'] < self.grace
+            if item['kind'] in ('scratch', 'download'):
+                # A crashed build's leftovers; a running build still needs its tree
+                if active or recent:
+                    protected.append(dict(item, reason='active' if active else 'recent'))
+                else:
+                    remove.append(dict(item, reason='scratch'))
+            elif item['kind'] in ('build', 'source'):
+                if active or item.get('build_id') in serving:
+                    protected.append(dict(item, reason='active' if active else 'serving'))
+                elif recent:
+                    protected.append(dict(item, reason='recent'))
+                else:
+                    candidates.append(item)
+
+        remaining = used - sum(item['bytes'] for item in remove)
+        goal = int(self.quota * self.target) if self.quota else None
+        over_quota = bool(self.quota) and remaining > self.quota
+        if over_quota:
+            for item in sorted(candidates, key=lambda item: item['last_used']):
+                if remaining <= goal:
+                    break
+                remove.append(dict(item, reason='lru'))
+                remaining -= item['bytes']
+        return {
+            'quota_bytes': self.quota,
+            'target_bytes': goal,
+            'used_bytes': used,
+            'usage_bytes': usage,
+            'over_quota': over_quota,
+            'remove': remove,
+            'protected': protected,
+            'freed_bytes': sum(item['bytes'] for item in remove),
+            'projected_bytes': remaining,
+        }
+
+    def _remove(self, item):
+        if item['kind'] == 'source':
+            if fcntl is None:
+                # Without file locks a download in progress cannot be ruled out
+                return False
+            # The source cache takes this lock while it downloads a digest
+            digest = os.path.basename(item['path'])
+            with open(os.path.join(os.path.dirname(item['path']), f"{digest}.lock"), 'a+') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                try:
+                    shutil.rmtree(item['path'], ignore_errors=True)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return True
+        with self._lock:
+            if item.get('build_id') in self._serving:
+                return False
+        if os.path.isdir(item['path']):
+            shutil.rmtree(item['path'], ignore_errors=True)
+        else:
+            try:
+                os.remove(item['path'])
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _mark_evicted(self, build_ids):
+        if self.storage is None or not build_ids:
+            return
+        evicted_at = datetime.now().isoformat()
+        for build in self.storage.get_builds(build_ids).values():
+            build['evicted_at'] = evicted_at
+            self.storage.save_build(build)
+        self.storage.flush()
+
+    def collect(self, dry_run=False):
+        """Run one collection and return its report; dry_run only reports what would go."""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, GC_LOCK_FILE), 'a+') as lock_file:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {'dry_run': dry_run, 'skipped': 'another collection is running'}
+            try:
+                report = self.plan()
+                report['dry_run'] = dry_run
+                if dry_run:
+                    return report
+                os.utime(lock_file.fileno())
+                removed, evicted = [], []
+                for item in report['remove']:
+                    if not self._remove(item):
+                        continue
+                    removed.append(item)
+                    artifact_gc_bytes_total.inc(item['bytes'], kind=item['kind'])
+                    artifact_gc_items_total.inc(kind=item['kind'])
+                    if item['kind'] == 'build':
+                        evicted.append(item['build_id'])
+                self._mark_evicted(evicted)
+                if evicted and self.on_evict is not None:
+                    self.on_evict(evicted)
+                report['remove'] = removed
+                report['freed_bytes'] = sum(item['bytes'] for item in removed)
+                report['projected_bytes'] = report['used_bytes'] - report['freed_bytes']
+                return report
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run_collection(self):
+        try:
+            self.collect()
+        except Exception as e:
+            print(f"Error collecting artifacts: {e}")
+        finally:
+            with self._lock:
+                self._collecting = False
+
+    def maybe_collect(self, background=True):
+        """Collect if the last collection (by any process) was more than interval seconds ago.
+
+        By default the collection runs on a background thread so the caller
+        never waits on the disk walk. background=False runs it inline, for
+        processes that must not have threads running when they fork.
+        Returns whether a collection was started.
+        """
+        try:
+            last = os.path.getmtime(os.path.join(self.root, GC_LOCK_FILE))
+        except OSError:
+            last = 0
+        if time.time() - last < self.interval:
+            return False
+        with self._lock:
+            if self._collecting:
+                return False
+            self._collecting = True
+        if background:
+            threading.Thread(target=self._run_collection, daemon=True).start()
+        else:
+            self._run_collection()
+        return True
+
+
+def report_view(report):
+    """Strip local paths from a collection report for API responses."""
+    def view(item):
+        return {key: value for key, value in item.items() if key != 'path'}
+    return dict(report, **{key: [view(item) for item in report[key]]
+                           for key in ('remove', 'protected') if key in report})
@@ -0,0 +1,90 @@
+# Incremental build log reading and Server-Sent Events streaming
+import json
+import os
+import time
+
+READ_CHUNK = 64 * 1024
+POLL_INTERVAL = float(os.environ.get('PYBINS_LOG_POLL_INTERVAL', 0.5))
+HEARTBEAT_INTERVAL = 15
+
+
+def read_log_lines(path, offset, final=False, max_bytes=READ_CHUNK):
+    """Read complete lines from path starting at byte offset.
+
+    Returns a list of (line, end_offset) pairs, where end_offset is the byte
+    offset just past the line. A trailing partial line is left for the next
+    call unless final is set (the build has finished writing) or it fills a
+    whole chunk on its own.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+    except FileNotFoundError:
+        return []
+    if not data:
+        return []
+    complete = data.rfind(b'\n') + 1
+    if complete == 0 and not final and len(data) < max_bytes:
+        return []
+    if complete and not (final and len(data) < max_bytes):
+        data = data[:complete]
+    lines = []
+    position = offset
+    for raw in data.splitlines(keepends=True):
+        position += len(raw)
+        lines.append((raw.rstrip(b'\r\n').decode('utf-8', errors='replace'), position))
+    return lines
+
+
+def stream_log_events(build_id, log_path, get_status, terminal_statuses, offset=0,
+                      poll_interval=POLL_INTERVAL):
+    """Yield the build log as SSE events until the build reaches a terminal status.
+
+    Each line is sent as a 'message' event whose id is the byte offset after
+    the line, so a client reconnecting with Last-Event-ID resumes exactly
+    where it left off. The stream ends with an 'end' event carrying the
+    final build status.
+    """
+    yield f"retry: {int(poll_interval * 4000)}\n\n"
+    last_sent = time.monotonic()
+    while True:
+        build = get_status(build_id) or {}
+        finished = not build or build.get('status') in terminal_statuses
+        # Read after checking the status so nothing written before the build
+        # finished can be missed.
+        lines = read_log_lines(log_path, offset, final=finished)
+        for line, offset in lines:
+            yield f"id: {offset}\ndata: {line}\n\n"
+        if lines:
+            last_sent = time.monotonic()
+            continue
+        if finished:
+            payload = json.dumps({'build_id': build_id, 'status': build.get('status')})
+            yield f"id: {offset}\nevent: end\ndata: {payload}\n\n"
+            return
+        if time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        time.sleep(poll_interval)
+
+
+def precompress_log(path, level=9):
+    """Write path + '.gz' next to a finished log so it can be served precompressed."""
+    import gzip
+    if not os.path.isfile(path):
+        return None
+    gz_path = path + '.gz'
+    tmp_path = gz_path + '.part'
+    try:
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=level) as dst:
+            while True:
+                chunk = src.read(READ_CHUNK)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.replace(tmp_path, gz_path)
+        return gz_path
+    except OSError as e:
+        print(f"Error compressing log {path}: {e}")
+        return None
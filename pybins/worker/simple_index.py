@@ -0,0 +1,181 @@
+# PEP 503/691 simple repository pages for the wheels this service has built
+import hashlib
+import html
+import json
+import os
+import re
+import zipfile
+from datetime import datetime, timezone
+from email.parser import HeaderParser
+from packaging.utils import parse_wheel_filename, InvalidWheelFilename
+from packaging.version import Version
+
+API_VERSION = '1.1'
+HASH_CHUNK = 1024 * 1024
+ROOT = ''
+
+
+def normalize(name):
+    """PEP 503 project name normalisation."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _requires_python(path):
+    """Requires-Python from the wheel's METADATA, or None."""
+    try:
+        with zipfile.ZipFile(path) as wheel:
+            for name in wheel.namelist():
+                if name.count('/') == 1 and name.endswith('.dist-info/METADATA'):
+                    metadata = HeaderParser().parsestr(wheel.read(name).decode('utf-8', 'replace'))
+                    return metadata.get('Requires-Python')
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f"Error reading wheel metadata: {e}")
+    return None
+
+
+def _upload_time(finished_at):
+    """PEP 700 upload-time (UTC, ISO 8601 with Z) from a build's local finished_at."""
+    try:
+        finished = datetime.fromisoformat(finished_at)
+    except (TypeError, ValueError):
+        return None
+    return finished.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def index_entry(build, path):
+    """Describe the wheel of a successful build for the index, or None if it is not a wheel."""
+    filename = os.path.basename(path or '')
+    if not filename.endswith('.whl') or not os.path.isfile(path):
+        return None
+    try:
+        name, version, _, _ = parse_wheel_filename(filename)
+    except InvalidWheelFilename as e:
+        print(f"Error indexing {filename}: {e}")
+        return None
+    return {
+        'filename': filename,
+        'project': normalize(name),
+        'version': str(version),
+        'build_id': build['build_id'],
+        'url': f"/download/{build['build_id']}/{filename}",
+        'sha256': _sha256(path),
+        'size': os.path.getsize(path),
+        'requires_python': _requires_python(path),
+        'upload_time': _upload_time(build.get('finished_at')),
+    }
+
+
+def _page(body):
+    body = body.encode('utf-8')
+    return hashlib.sha256(body).hexdigest()[:32], body
+
+
+def render_root(projects):
+    """The root page in both formats."""
+    links = ''.join(f'    <a href="/simple/{html.escape(project)}/">{html.escape(project)}</a>\n'
+                    for project in projects)
+    return {
+        (ROOT, 'html'): _page(
+            '<!DOCTYPE html>\n<html>\n  <head>\n'
+            f'    <meta name="pypi:repository-version" content="{API_VERSION}">\n'
+            '    <title>Simple index</title>\n  </head>\n  <body>\n'
+            f'{links}  </body>\n</html>\n'),
+        (ROOT, 'json'): _page(json.dumps({
+            'meta': {'api-version': API_VERSION},
+            'projects': [{'name': project} for project in projects],
+        })),
+    }
+
+
+def render_project(project, files):
+    """A project's page in both formats; files are index entries."""
+    links = []
+    for entry in files:
+        attrs = f'href="{html.escape(entry["url"])}#sha256={entry["sha256"]}"'
+        if entry.get('requires_python'):
+            attrs += f' data-requires-python="{html.escape(entry["requires_python"])}"'
+        links.append(f'    <a {attrs}>{html.escape(entry["filename"])}</a><br/>\n')
+    json_files = []
+    for entry in files:
+        item = {'filename': entry['filename'], 'url': entry['url'],
+                'hashes': {'sha256': entry['sha256']}, 'size': entry['size']}
+        if entry.get('requires_python'):
+            item['requires-python'] = entry['requires_python']
+        if entry.get('upload_time'):
+            item['upload-time'] = entry['upload_time']
+        json_files.append(item)
+    versions = sorted({entry['version'] for entry in files}, key=Version)
+    return {
+        (project, 'html'): _page(
+            '<!DOCTYPE html>\n<html>\n  <head>\n'
+            f'    <meta name="pypi:repository-version" content="{API_VERSION}">\n'
+            f'    <title>Links for {html.escape(project)}</title>\n  </head>\n  <body>\n'
+            f'    <h1>Links for {html.escape(project)}</h1>\n{"".join(links)}  </body>\n</html>\n'),
+        (project, 'json'): _page(json.dumps({
+            'meta': {'api-version': API_VERSION},
+            'name': project,
+            'files': json_files,
+            'versions': versions,
+        })),
+    }
+
+
+def render_pages(changed, files_by_project, projects):
+    """Pages to rewrite after the files of the changed projects changed."""
+    pages = render_root(projects)
+    for project in changed:
+        files = files_by_project.get(project)
+        if files:
+            pages.update(render_project(project, files))
+        else:
+            pages.update({(project, 'html'): None, (project, 'json'): None})
+    return pages
+
+
+class SimpleIndex:
+    """The simple repository, kept up to date as builds finish.
+
+    Pages are rendered when a wheel is published or evicted and stored with
+    their ETags in the shared database, so serving a page never scans the
+    artifacts directory and every process sees the same pages.
+    """
+
+    def __init__(self, storage, artifact_path):
+        self.storage = storage
+        self.artifact_path = artifact_path
+
+    def add_build(self, build):
+        """Publish the wheel of a successful build; returns whether it was indexed."""
+        entry = index_entry(build, self.artifact_path(build))
+        if entry is None:
+            return False
+        self.storage.update_index(files=[entry], render=render_pages)
+        return True
+
+    def remove_builds(self, build_ids):
+        """Withdraw the wheels of builds whose artifacts are gone."""
+        if build_ids:
+            self.storage.update_index(remove_build_ids=build_ids, render=render_pages)
+
+    def rebuild(self, builds):
+        """Index the wheels of existing builds, e.g. builds made before the index existed."""
+        entries = {}
+        for build in sorted(builds, key=lambda build: build.get('finished_at') or ''):
+            if build.get('status') != 'success' or build.get('build_type') != 'wheel':
+                continue
+            entry = index_entry(build, self.artifact_path(build))
+            if entry is not None:
+                entries[entry['filename']] = entry
+        self.storage.update_index(files=list(entries.values()), render=render_pages)
+        return len(entries)
@@ -2,65 +2,196 @@
 
 import subprocess
 import os
+import time
 import tempfile
+import shutil
 from datetime import datetime
-from ..storage.storage import PackageStorage
+import sys
+from functools import wraps
+from ..storage.storage import get_storage, TERMINAL_STATUSES
 from ..storage.models import PackageWheel
+from .dedup import BuildIndex, build_key
+from .logs import precompress_log
+from ..metrics.metrics import (registry, build_stage, build_duration_seconds, builds_total,
+                               builds_in_progress)
+from .executor import build_executor, raise_if_cancelled, forget_cancel, BuildCancelled
+from .envpool import build_wheel
+from .bincache import build_binary
+from .lifecycle import ArtifactLifecycle
+from .simple_index import SimpleIndex
 
-# Initialize storage
-storage = PackageStorage()
+ARTIFACTS_DIR = os.path.abspath(os.environ.get(
+    'PYBINS_ARTIFACTS_DIR',
+    os.path.join(os.path.dirname(__file__), '../../artifacts')
+))
+BUILD_TYPES = ('wheel', 'binary', 'wheelhouse')
 
-def build_package_task(package_name, version):
+# Initialize storage (shared with the routes through the same database)
+storage = get_storage()
+
+def in_rq_job():
+    """Whether this process is an RQ work horse running a job (rq stays unimported otherwise)."""
+    if 'rq' not in sys.modules:
+        return False
+    from rq import get_current_job
+    return get_current_job() is not None
+
+def save_result(result):
+    """Save a build record, precompressing its log once the build is over.
+
+    Successful wheel builds are published on the simple index, and finished
+    builds give the artifact collector a chance to run.
+    """
+    if result and result.get('build_id'):
+        finished = result.get('status') in TERMINAL_STATUSES
+        if finished:
+            precompress_log(os.path.join(ARTIFACTS_DIR, result['build_id'], 'build.log'))
+        storage.save_build(result, flush=True)
+        if result.get('status') == 'success' and result.get('build_type') == 'wheel':
+            try:
+                simple_index.add_build(result)
+            except Exception as e:
+                print(f"Error updating simple index: {e}")
+        # RQ work horses exit as soon as the job returns; FairWorker collects for them
+        if finished and not in_rq_job():
+            artifact_lifecycle.maybe_collect()
+    return result
+
+def persist_build(task):
+    """Save the build record a task returns, whichever path it returned from."""
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        return save_result(task(*args, **kwargs))
+    return wrapper
+
+def track_build(build_type):
+    """Record in-flight count, total duration and outcome of a build task."""
+    def decorator(task):
+        @wraps(task)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 'failed'
+            try:
+                with builds_in_progress.track(build_type=build_type):
+                    result = task(*args, **kwargs)
+                status = (result or {}).get('status', 'failed')
+                return result
+            finally:
+                build_duration_seconds.observe(time.perf_counter() - start,
+                                               build_type=build_type, status=status)
+                builds_total.inc(build_type=build_type, status=status)
+                # RQ work horses exit without running timers: write the snapshot now
+                registry.flush()
+        return wrapper
+    return decorator
+
+def artifact_path(result):
+    """Return the local path of the artifact behind a build result, or None."""
+    download_url = (result or {}).get('download_url') or ''
+    if not download_url.startswith('/download/'):
+        return None
+    return os.path.join(ARTIFACTS_DIR, download_url[len('/download/'):])
+
+def artifact_exists(result):
+    """Check that the artifact behind a build result is still on disk."""
+    path = artifact_path(result)
+    return path is not None and os.path.isfile(path)
+
+simple_index = SimpleIndex(storage, artifact_path)
+artifact_lifecycle = ArtifactLifecycle(ARTIFACTS_DIR, storage=storage, on_evict=simple_index.remove_builds)
+
+build_index = BuildIndex(artifact_exists=artifact_exists,
+                         lookup=lambda key: find_successful_build(key))
+
+def resolve_version(package_name, version):
+    """Resolve 'latest' to the concrete version currently published on PyPI."""
+    if version and version != 'latest':
+        return version
+    from ..fetcher.fetcher import fetch_from_pypi
+    pkg_info = fetch_from_pypi(package_name)
+    return pkg_info['version'] if pkg_info else 'latest'
+
+def new_build_id(package_name, version, build_type="wheel"):
+    """Generate a unique build id for a package build."""
+    suffix = {'binary': '-bin', 'wheelhouse': '-wheelhouse'}.get(build_type, '')
+    return f"{package_name}-{version}{suffix}-{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+
+def _link_or_copy(src, dest):
+    """Hard-link src to dest when possible so cached files are not duplicated."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+@persist_build
+@track_build('wheel')
+def build_package_task(package_name, version, build_id=None, target=None, client=None):
     """Download, build, and store a Python package wheel. Returns build info and download link."""
     from ..fetcher.fetcher import fetch_from_pypi, download_package
-    ARTIFACTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts'))
+    from ..fetcher.extract import fetch_and_extract
     os.makedirs(ARTIFACTS_DIR, exist_ok=True)
-    build_id = f"{package_name}-{version}-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    build_id = build_id or new_build_id(package_name, version, 'wheel')
     result = {
         'build_id': build_id,
         'package_name': package_name,
         'version': version,
+        'build_type': 'wheel',
         'status': 'pending',
         'started_at': datetime.now().isoformat()
     }
+    if client:
+        result['client'] = client
     storage.builds[build_id] = result
+    extract_dir = None
     try:
         result['status'] = 'in_progress'
+        storage.save_build(result)
         # 1. Fetch package info from PyPI
-        pkg_info = fetch_from_pypi(package_name, version if version != 'latest' else None)
+        with build_stage(result['build_type'], 'resolve'):
+            pkg_info = fetch_from_pypi(package_name, version if version != 'latest' else None, target)
         if not pkg_info or not pkg_info.get('url'):
             raise Exception(f"Could not find package {package_name} version {version}")
-        # 2. Download the source distribution
-        src_path = download_package(pkg_info['url'], ARTIFACTS_DIR)
-        if not src_path:
-            raise Exception("Failed to download package source.")
-        # 3. Extract and build wheel
-        import tarfile, zipfile
+        if not pkg_info.get('selection'):
+            raise Exception(f"No compatible wheel or sdist for {package_name} version {version}")
+        result['build_path'] = pkg_info['selection']['build_path']
+        result['source_file'] = pkg_info.get('filename')
+        if target:
+            result['target'] = target
+        raise_if_cancelled(build_id)
+        if result['build_path'] == 'prebuilt_wheel':
+            # PyPI already ships a compatible wheel: publish it without building
+            with build_stage('wheel', 'download'):
+                src_path = download_package(pkg_info['url'], ARTIFACTS_DIR, pkg_info.get('sha256'))
+            if not src_path:
+                raise Exception("Failed to download package wheel.")
+            wheel_dir = os.path.join(ARTIFACTS_DIR, build_id)
+            os.makedirs(wheel_dir, exist_ok=True)
+            wheel_file = os.path.basename(src_path)
+            _link_or_copy(src_path, os.path.join(wheel_dir, wheel_file))
+            with open(os.path.join(wheel_dir, 'build.log'), 'w') as logf:
+                logf.write(f"Using prebuilt wheel {wheel_file} from PyPI "
+                           f"(matched tag {pkg_info['selection']['tag']}); no build needed.\n")
+            result['status'] = 'success'
+            result['finished_at'] = datetime.now().isoformat()
+            result['output'] = f"Using prebuilt wheel for {package_name} version {version}"
+            result['download_url'] = f"/download/{build_id}/{wheel_file}"
+            result['log_url'] = f"/download/{build_id}/build.log"
+            return result
+        # 2-3. Stream the source distribution straight into the extraction directory
         extract_dir = os.path.join(ARTIFACTS_DIR, f"{build_id}_src")
-        os.makedirs(extract_dir, exist_ok=True)
-        if src_path.endswith('.tar.gz') or src_path.endswith('.tgz'):
-            with tarfile.open(src_path, 'r:gz') as tar:
-                tar.extractall(path=extract_dir)
-        elif src_path.endswith('.zip'):
-            with zipfile.ZipFile(src_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-        else:
-            raise Exception("Unknown source archive format.")
-        # 4. Find the directory with setup.py or pyproject.toml
-        build_root = extract_dir
-        for root, dirs, files in os.walk(extract_dir):
-            if 'setup.py' in files or 'pyproject.toml' in files:
-                build_root = root
-                break
-        # 5. Build wheel using 'python -m build --wheel'
+        with build_stage(result['build_type'], 'download_extract'):
+            tree = fetch_and_extract(pkg_info['url'], extract_dir, pkg_info.get('sha256'),
+                                     os.path.join(ARTIFACTS_DIR, 'cas'), pkg_info.get('filename'))
+        # 4. The directory with setup.py or pyproject.toml was found while extracting
+        build_root = tree.build_root or extract_dir
+        raise_if_cancelled(build_id)
+        # 5. Build wheel using 'python -m build --wheel' (in a warm build environment when possible)
         wheel_dir = os.path.join(ARTIFACTS_DIR, build_id)
         os.makedirs(wheel_dir, exist_ok=True)
         log_path = os.path.join(wheel_dir, 'build.log')
         try:
-            with open(log_path, 'w') as logf:
-                proc = subprocess.run([
-                    'python', '-m', 'build', '--wheel', '--outdir', wheel_dir
-                ], cwd=build_root, stdout=logf, stderr=subprocess.STDOUT, check=True)
+            with open(log_path, 'w') as logf, build_stage('wheel', 'build'):
+                result['build_env'] = build_wheel(build_id, build_root, wheel_dir, logf)
         except subprocess.CalledProcessError:
             result['status'] = 'failed'
             result['finished_at'] = datetime.now().isoformat()
@@ -79,81 +210,220 @@ def build_package_task(package_name, version):
         result['download_url'] = f"/download/{build_id}/{wheel_file}"
         result['log_url'] = f"/download/{build_id}/build.log"
         return result
+    except BuildCancelled as e:
+        result['status'] = 'cancelled'
+        result['finished_at'] = datetime.now().isoformat()
+        result['output'] = str(e)
+        return result
     except Exception as e:
         result['status'] = 'failed'
         result['finished_at'] = datetime.now().isoformat()
         result['output'] = str(e)
         return result
+    finally:
+        # The extracted source tree is scratch space; only the outputs are kept
+        if extract_dir:
+            with build_stage(result['build_type'], 'cleanup'):
+                shutil.rmtree(extract_dir, ignore_errors=True)
+
+def _claim_build(package_name, version, build_type, force=False, build_id=None, target=None):
+    """Resolve a build request against the build index.
+
+    Returns (existing, inflight, owner): existing is a reusable successful
+    result; otherwise inflight is the build to run (owner=True) or the
+    identical build already running (owner=False).
+    """
+    version = resolve_version(package_name, version)
+    key = build_key(package_name, version, build_type, target)
+    if not force:
+        existing = build_index.find(key)
+        if existing:
+            return dict(existing, deduplicated='completed'), None, False
+    inflight, owner = build_index.begin(key, build_id or new_build_id(package_name, version, build_type), force)
+    inflight.package_name = package_name
+    inflight.version = version
+    return None, inflight, owner
+
+def _execute_claimed(inflight, build_type, target=None, client=None):
+    """Run the build behind a claimed index entry and publish its result."""
+    result = None
+    try:
+        if build_type == "wheel":
+            result = build_package_task(inflight.package_name, inflight.version, inflight.build_id, target, client)
+        elif build_type == "wheelhouse":
+            from .wheelhouse import build_wheelhouse_task
+            result = build_wheelhouse_task(inflight.package_name, inflight.version, inflight.build_id, target,
+                                           client)
+        else:
+            result = build_binary_task(inflight.package_name, inflight.version, inflight.build_id, target, client)
+    finally:
+        build_index.finish(inflight, result)
+        forget_cancel(inflight.build_id)
+    return result
+
+def _drop_placeholder(build_id):
+    """Remove the queued record written at enqueue time for a build that was coalesced."""
+    if build_id:
+        build = get_build_status(build_id)
+        if build and build.get('status') == 'queued':
+            storage.delete_build(build_id)
 
-def run_build(package_name, version, build_type="wheel"):
-    """Run a build process (wheel or binary)."""
-    if build_type == "wheel":
-        return build_package_task(package_name, version)
-    elif build_type == "binary":
-        return build_binary_task(package_name, version)
-    else:
+def run_build(package_name, version, build_type="wheel", force=False, build_id=None, target=None,
+              client=None):
+    """Run a build process (wheel, binary, or wheelhouse).
+
+    An identical (package, version, build_type) request returns the existing
+    successful build, or waits for the identical build already in progress.
+    force=True always starts a fresh build. target optionally selects the
+    Python version/platform whose prebuilt wheels may be used instead of
+    building from the sdist. client identifies the submitter for admission
+    control. A wheelhouse build returns while its dependency builds are still
+    queued when it runs inside an RQ worker (see wheelhouse.py).
+    """
+    if build_type not in BUILD_TYPES:
+        _drop_placeholder(build_id)
         return {'success': False, 'error': f"Unknown build type: {build_type}"}
+    existing, inflight, owner = _claim_build(package_name, version, build_type, force, build_id, target)
+    if existing:
+        _drop_placeholder(build_id)
+        return existing
+    if not owner:
+        _drop_placeholder(build_id)
+        result = inflight.wait() or get_build_status(inflight.build_id) or {'build_id': inflight.build_id}
+        return dict(result, deduplicated='in_flight')
+    return _execute_claimed(inflight, build_type, target, client)
+
+def enqueue_placeholder(package_name, version, build_type, client=None, priority=None):
+    """Record a build handed to the queue as queued, so it counts against admission limits."""
+    build_id = new_build_id(package_name, version, build_type)
+    queued = {
+        'build_id': build_id,
+        'package_name': package_name,
+        'version': version,
+        'build_type': build_type,
+        'status': 'queued',
+        'queued_at': datetime.now().isoformat()
+    }
+    if client:
+        queued['client'] = client
+    if priority:
+        queued['priority'] = priority
+    storage.builds[build_id] = queued
+    return build_id
+
+def submit_build(package_name, version, build_type="wheel", force=False, target=None, client=None):
+    """Queue a build on the in-process executor without waiting for it.
+
+    Returns (result, inflight). result is the build record as it stands now
+    (a queued placeholder, the running build, or a reused success); inflight
+    can be waited on for the final result and is None for reused builds.
+    Raises ExecutorFull when the pending queue is full.
+    """
+    if build_type not in BUILD_TYPES:
+        return {'success': False, 'error': f"Unknown build type: {build_type}"}, None
+    existing, inflight, owner = _claim_build(package_name, version, build_type, force, None, target)
+    if existing:
+        return existing, None
+    if not owner:
+        current = get_build_status(inflight.build_id) or {'build_id': inflight.build_id, 'status': 'queued'}
+        return dict(current, deduplicated='in_flight'), inflight
+    queued = {
+        'build_id': inflight.build_id,
+        'package_name': inflight.package_name,
+        'version': inflight.version,
+        'build_type': build_type,
+        'status': 'queued',
+        'queued_at': datetime.now().isoformat()
+    }
+    if client:
+        queued['client'] = client
 
-def build_binary_task(package_name, version):
+    def on_cancel():
+        queued['status'] = 'cancelled'
+        queued['finished_at'] = datetime.now().isoformat()
+        queued['output'] = f"Build {inflight.build_id} was cancelled before it started"
+        storage.save_build(queued)
+        build_index.finish(inflight, queued)
+
+    storage.builds[inflight.build_id] = queued
+    try:
+        build_executor.submit(inflight.build_id, _execute_claimed, inflight, build_type, target, client,
+                              on_cancel=on_cancel)
+    except Exception:
+        del storage.builds[inflight.build_id]
+        build_index.finish(inflight, None)
+        raise
+    return queued, inflight
+
+def cancel_build(build_id):
+    """Cancel a queued or running build. Returns False if it cannot be cancelled."""
+    build = get_build_status(build_id)
+    if not build or build.get('status') in TERMINAL_STATUSES:
+        return False
+    from ..queue.setup import get_queue
+    if get_queue().cancel(build_id):
+        # Still waiting in the queue, so no build will write its record
+        build = dict(build, status='cancelled', finished_at=datetime.now().isoformat(),
+                     output=f"Build {build_id} was cancelled before it started")
+        storage.save_build(build)
+        return True
+    return build_executor.cancel(build_id)
+
+@persist_build
+@track_build('binary')
+def build_binary_task(package_name, version, build_id=None, target=None, client=None):
     """Download, build, and store a Python package binary using pyinstaller."""
-    from ..fetcher.fetcher import fetch_from_pypi, download_package
-    ARTIFACTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../artifacts'))
+    from ..fetcher.fetcher import fetch_from_pypi, fetch_requires_dist
+    from ..fetcher.extract import fetch_and_extract
     os.makedirs(ARTIFACTS_DIR, exist_ok=True)
-    build_id = f"{package_name}-{version}-bin-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    build_id = build_id or new_build_id(package_name, version, 'binary')
     result = {
         'build_id': build_id,
         'package_name': package_name,
         'version': version,
+        'build_type': 'binary',
         'status': 'pending',
         'started_at': datetime.now().isoformat()
     }
+    if client:
+        result['client'] = client
     storage.builds[build_id] = result
+    extract_dir = None
     try:
         result['status'] = 'in_progress'
+        storage.save_build(result)
         # 1. Fetch package info from PyPI
-        pkg_info = fetch_from_pypi(package_name, version if version != 'latest' else None)
+        with build_stage(result['build_type'], 'resolve'):
+            pkg_info = fetch_from_pypi(package_name, version if version != 'latest' else None, target)
         if not pkg_info or not pkg_info.get('url'):
             raise Exception(f"Could not find package {package_name} version {version}")
-        # 2. Download the source distribution
-        src_path = download_package(pkg_info['url'], ARTIFACTS_DIR)
-        if not src_path:
-            raise Exception("Failed to download package source.")
-        # 3. Extract source
-        import tarfile, zipfile
+        if not pkg_info.get('selection'):
+            raise Exception(f"No compatible wheel or sdist for {package_name} version {version}")
+        # A compatible wheel is unpacked and frozen just like an sdist
+        result['build_path'] = 'wheel_contents' if pkg_info['selection']['build_path'] == 'prebuilt_wheel' else 'sdist'
+        result['source_file'] = pkg_info.get('filename')
+        if target:
+            result['target'] = target
+        raise_if_cancelled(build_id)
+        # 2-3. Stream the source distribution straight into the extraction directory
         extract_dir = os.path.join(ARTIFACTS_DIR, f"{build_id}_src")
-        os.makedirs(extract_dir, exist_ok=True)
-        if src_path.endswith('.tar.gz') or src_path.endswith('.tgz'):
-            with tarfile.open(src_path, 'r:gz') as tar:
-                tar.extractall(path=extract_dir)
-        elif src_path.endswith('.zip'):
-            with zipfile.ZipFile(src_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-        else:
-            raise Exception("Unknown source archive format.")
-        # 4. Find the main script (try __main__.py or setup.py entry point)
-        main_script = None
-        for root, dirs, files in os.walk(extract_dir):
-            if '__main__.py' in files:
-                main_script = os.path.join(root, '__main__.py')
-                break
-        if not main_script:
-            # Fallback: look for a .py file matching the package name
-            for root, dirs, files in os.walk(extract_dir):
-                for f in files:
-                    if f == f'{package_name}.py':
-                        main_script = os.path.join(root, f)
-                        break
+        with build_stage(result['build_type'], 'download_extract'):
+            tree = fetch_and_extract(pkg_info['url'], extract_dir, pkg_info.get('sha256'),
+                                     os.path.join(ARTIFACTS_DIR, 'cas'), pkg_info.get('filename'))
+        # 4. Main script (__main__.py, else <package>.py) was recorded while extracting
+        main_script = tree.main_script(package_name)
         if not main_script:
             raise Exception("Could not find an entry script (__main__.py or <package>.py) for binary build.")
-        # 5. Build binary using pyinstaller
+        raise_if_cancelled(build_id)
+        # 5. Build binary using pyinstaller, reusing the work directory of earlier builds
         bin_dir = os.path.join(ARTIFACTS_DIR, build_id)
         os.makedirs(bin_dir, exist_ok=True)
         log_path = os.path.join(bin_dir, 'build.log')
+        requires = fetch_requires_dist(package_name, pkg_info['version']) or []
         try:
-            with open(log_path, 'w') as logf:
-                proc = subprocess.run([
-                    'pyinstaller', '--onefile', '--distpath', bin_dir, main_script
-                ], cwd=os.path.dirname(main_script), stdout=logf, stderr=subprocess.STDOUT, check=True)
+            with open(log_path, 'w') as logf, build_stage('binary', 'build'):
+                result['binary_cache'] = build_binary(build_id, package_name, requires, extract_dir,
+                                                      main_script, bin_dir, logf)
         except subprocess.CalledProcessError:
             result['status'] = 'failed'
             result['finished_at'] = datetime.now().isoformat()
@@ -172,11 +442,21 @@ def build_binary_task(package_name, version):
         result['download_url'] = f"/download/{build_id}/{bin_file}"
         result['log_url'] = f"/download/{build_id}/build.log"
         return result
+    except BuildCancelled as e:
+        result['status'] = 'cancelled'
+        result['finished_at'] = datetime.now().isoformat()
+        result['output'] = str(e)
+        return result
     except Exception as e:
         result['status'] = 'failed'
         result['finished_at'] = datetime.now().isoformat()
         result['output'] = str(e)
         return result
+    finally:
+        # The extracted source tree is scratch space; only the outputs are kept
+        if extract_dir:
+            with build_stage(result['build_type'], 'cleanup'):
+                shutil.rmtree(extract_dir, ignore_errors=True)
 def get_build_status(build_id):
     """Get the status of a build"""
     return storage.builds.get(build_id, None)
@@ -184,3 +464,11 @@ def get_build_status(build_id):
 def list_builds():
     """List all builds"""
     return list(storage.builds.values())
+
+def find_successful_build(key):
+    """Look up the newest successful build for an index key in the shared store."""
+    if len(key) != 3:
+        # Builds for an explicit target are only tracked in memory
+        return None
+    package_name, version, build_type = key
+    return storage.latest_build(package_name, version, build_type)
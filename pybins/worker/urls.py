@@ -1,16 +1,126 @@
-from flask import Blueprint, jsonify, request
-from .tasks import build_package_task, run_build, get_build_status, list_builds
+import hashlib
+from datetime import datetime
+from flask import Blueprint, jsonify, request, Response
+from .tasks import (build_package_task, run_build, submit_build, cancel_build,
+                    get_build_status, list_builds, storage, TERMINAL_STATUSES)
+from .executor import ExecutorFull, build_executor, BUILD_WORKERS
+from ..fetcher.selector import parse_target, TargetError
+from ..api.middleware.middleware import rate_limit
+from ..api.middleware.admission import admission, client_id, rejection_response
 
 worker_bp = Blueprint('worker', __name__)
 
-@worker_bp.route('/builds', methods=['GET'])
-def get_builds():
-    """Get all builds"""
-    builds = list_builds()
-    return jsonify({
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def builds_listing_response(args):
+    """Serve one page of the build history.
+
+    Supports ?status=, ?package_name=, ?version=, ?since=/?until= (ISO
+    timestamps on created_at), ?limit=, ?cursor= and ?fields=a,b,c. The ETag
+    combines the store-wide change counter with the query, so unchanged
+    listings are answered with 304 before any rows are read.
+    """
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        since = args.get('since')
+        until = args.get('until')
+        if since:
+            since = datetime.fromisoformat(since).isoformat()
+        if until:
+            until = datetime.fromisoformat(until).isoformat()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+
+    query = '&'.join(f"{k}={v}" for k, v in sorted(args.items(multi=True)))
+    etag = f"builds-{storage.change_counter()}-{hashlib.sha1(query.encode()).hexdigest()[:12]}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        builds, next_cursor = storage.query_builds(
+            status=args.get('status'),
+            package_name=args.get('package_name'),
+            version=args.get('version'),
+            created_after=since,
+            created_before=until,
+            cursor=args.get('cursor'),
+            limit=limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()]
+    if fields:
+        builds = [{f: build[f] for f in fields if f in build} for build in builds]
+
+    response = jsonify({
         'builds': builds,
-        'count': len(builds)
+        'count': len(builds),
+        'limit': limit,
+        'next_cursor': next_cursor
     })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def parse_wait(value):
+    """Parse ?wait=: seconds to block, True-ish/empty for no limit, None if absent."""
+    if value is None:
+        return None
+    if value.lower() in ('', 'true', 'yes'):
+        return 0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+def start_build_response(data, wait=None):
+    """Submit a build request and build the HTTP response for it.
+
+    Without wait the build runs in the background and 202 is returned with
+    its id. With wait (seconds, 0 meaning no limit) the request blocks until
+    the build finishes or the wait expires.
+    """
+    if not data or 'package' not in data:
+        return jsonify({'error': 'Package name is required'}), 400
+    try:
+        target = parse_target(data.get('target'))
+    except TargetError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        result, inflight = submit_build(data['package'], data.get('version', 'latest'),
+                                        data.get('build_type', 'wheel'),
+                                        force=bool(data.get('force', False)),
+                                        target=target,
+                                        client=client_id())
+    except ExecutorFull as e:
+        stats = build_executor.stats()
+        return rejection_response(503, 'executor_full', str(e),
+                                  admission.retry_after(stats['pending'] - stats['max_pending'] + 1,
+                                                        BUILD_WORKERS))
+
+    if inflight is not None and wait is not None:
+        finished = inflight.wait(wait or None)
+        if finished:
+            reused = result.get('deduplicated')
+            result = dict(finished, deduplicated=reused) if reused else finished
+
+    status = result.get('status')
+    if status in TERMINAL_STATUSES or result.get('success') is False:
+        return jsonify(result), 200 if status == 'success' else 400
+    build_id = result['build_id']
+    return jsonify(dict(result,
+                        status_url=f"/build/{build_id}",
+                        cancel_url=f"/build/{build_id}/cancel",
+                        queue_position=build_executor.position(build_id))), 202
+
+@worker_bp.route('/builds', methods=['GET'])
+def get_builds():
+    """List builds, newest first, one page at a time"""
+    return builds_listing_response(request.args)
 
 @worker_bp.route('/builds/<build_id>', methods=['GET'])
 def get_build(build_id):
@@ -21,6 +131,7 @@ def get_build(build_id):
     return jsonify(build)
 
 @worker_bp.route('/builds', methods=['POST'])
+@rate_limit
 def create_build():
     """Create a new build"""
     data = request.get_json()
@@ -29,8 +140,9 @@ def create_build():
     
     package_name = data['package']
     version = data.get('version', 'latest')
+    force = bool(data.get('force', False))
     
-    result = build_package_task(package_name, version)
+    result = run_build(package_name, version, 'wheel', force=force, client=client_id())
     
     return jsonify({
         'message': 'Build created successfully',
@@ -52,19 +164,20 @@ def get_build_status_route(build_id):
     })
 
 @worker_bp.route('/run', methods=['POST'])
+@rate_limit
 def run_build_now():
-    """Run a build immediately"""
-    data = request.get_json()
-    if not data or 'package' not in data:
-        return jsonify({'error': 'Package name is required'}), 400
-    
-    package_name = data['package']
-    version = data.get('version', 'latest')
-    build_type = data.get('build_type', 'wheel')
-    
-    result = run_build(package_name, version, build_type)
-    
-    if result.get('success'):
-        return jsonify(result), 200
-    else:
-        return jsonify(result), 400
+    """Start a build in the background (?wait=<seconds> blocks for the result)"""
+    return start_build_response(request.get_json(), parse_wait(request.args.get('wait')))
+
+@worker_bp.route('/builds/<build_id>/cancel', methods=['POST'])
+def cancel_build_route(build_id):
+    """Cancel a queued or running build"""
+    return cancel_build_response(build_id)
+
+def cancel_build_response(build_id):
+    build = get_build_status(build_id)
+    if not build:
+        return jsonify({'error': 'Build not found'}), 404
+    if not cancel_build(build_id):
+        return jsonify({'error': 'Build cannot be cancelled', 'status': build.get('status')}), 409
+    return jsonify({'build_id': build_id, 'status': 'cancelling'}), 202
@@ -0,0 +1,469 @@
+# Dependency-closure wheelhouse builds
+import json
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.specifiers import SpecifierSet
+from packaging.utils import canonicalize_name
+from packaging.version import Version, InvalidVersion
+from .dedup import build_key
+from .executor import BUILD_WORKERS, raise_if_cancelled, BuildCancelled
+from .tasks import (ARTIFACTS_DIR, storage, build_index, save_result, run_build, new_build_id,
+                    enqueue_placeholder, artifact_path, in_rq_job)
+from ..metrics.metrics import registry, build_stage, build_duration_seconds, builds_total
+from ..queue.fair import job_id_for, ACTIVE_JOB_STATUSES, DEFAULT_PRIORITY
+
+# Node builds run at the same time by one wheelhouse outside RQ
+WHEELHOUSE_CONCURRENCY = int(os.environ.get('PYBINS_WHEELHOUSE_CONCURRENCY', BUILD_WORKERS))
+WHEELHOUSE_MAX_PACKAGES = int(os.environ.get('PYBINS_WHEELHOUSE_MAX_PACKAGES', 200))
+# Parallel PyPI lookups while resolving (keep at or below PYBINS_HTTP_POOL_MAXSIZE)
+RESOLVE_CONCURRENCY = int(os.environ.get('PYBINS_RESOLVE_CONCURRENCY', 8))
+MAX_RESOLVE_ROUNDS = 20
+# Seconds a wheelhouse's lock may be held while it submits nodes or bundles
+WHEELHOUSE_LOCK_TIMEOUT = 600
+
+
+class ResolutionError(Exception):
+    pass
+
+
+def _pick_version(name, specifier, target):
+    """Newest release allowed by specifier that has a usable, non-yanked file for target."""
+    from ..fetcher.fetcher import fetch_release_files
+    from ..fetcher.selector import select_release_file
+    releases = fetch_release_files(name)
+    if releases is None:
+        raise ResolutionError(f"Could not find package {name}")
+    versions = {}
+    for raw, files in releases.items():
+        if not files:
+            continue
+        try:
+            versions[Version(raw)] = raw
+        except InvalidVersion:
+            continue
+    # filter() only falls back to pre-releases when no final release matches
+    for candidate in sorted(specifier.filter(versions), reverse=True):
+        chosen, _ = select_release_file(releases[versions[candidate]], target)
+        if chosen is not None and not chosen.get('yanked'):
+            return versions[candidate]
+    raise ResolutionError(f"No release of {name} satisfies '{specifier or '*'}'")
+
+
+def _requirements(name, version, extras, env):
+    """The requirements of one release that apply to env and the requested extras."""
+    from ..fetcher.fetcher import fetch_requires_dist
+    requires = fetch_requires_dist(name, version)
+    if requires is None:
+        raise ResolutionError(f"Could not read metadata for {name} {version}")
+    applicable = []
+    for line in requires:
+        try:
+            req = Requirement(line)
+        except InvalidRequirement as e:
+            print(f"Error parsing requirement of {name} {version}: {e}")
+            continue
+        if req.marker is not None and not any(req.marker.evaluate(dict(env, extra=extra))
+                                              for extra in ('',) + tuple(sorted(extras))):
+            continue
+        applicable.append(req)
+    return applicable
+
+
+def resolve_closure(package_name, version, target=None, extras=()):
+    """Pin one version of every package in the dependency closure of a release.
+
+    Each dependency gets the newest release that satisfies every specifier
+    seen for it. When a requirement found later rules out a version already
+    picked (or asks for other extras), resolution runs again, picking from
+    the specifiers and extras that the latest picks asked for. Requirements
+    of versions no longer picked do not carry over. There is no
+    backtracking: a conflict that can only be solved with an older version
+    of a dependent is reported as a ResolutionError.
+    Returns {name: {'package', 'version', 'extras', 'requires'}} keyed by
+    normalised name; the root package is pinned to version.
+    """
+    from ..fetcher.selector import marker_environment
+    env = marker_environment(target)
+    root = canonicalize_name(package_name)
+    # What the previous round's picks asked for; this round picks from it
+    constraints = {}
+    wanted_extras = {root: set(extras)}
+
+    def expand(name):
+        pinned = version if name == root else _pick_version(name, constraints.get(name, SpecifierSet()), target)
+        extras_now = set(wanted_extras.get(name, ()))
+        return name, pinned, extras_now, _requirements(name, pinned, extras_now, env)
+
+    with ThreadPoolExecutor(max_workers=max(RESOLVE_CONCURRENCY, 1)) as pool:
+        for _ in range(MAX_RESOLVE_ROUNDS):
+            nodes = {}
+            asked = {}
+            asked_extras = {root: set(extras)}
+            frontier = [root]
+            while frontier:
+                next_frontier = []
+                for name, pinned, extras_now, requirements in pool.map(expand, frontier):
+                    requires = set()
+                    for req in requirements:
+                        dep = canonicalize_name(req.name)
+                        if dep == name:
+                            continue
+                        requires.add(dep)
+                        asked[dep] = asked.get(dep, SpecifierSet()) & req.specifier
+                        asked_extras.setdefault(dep, set()).update(req.extras)
+                        if dep not in nodes and dep not in next_frontier and dep not in frontier:
+                            next_frontier.append(dep)
+                    nodes[name] = {'package': name, 'version': pinned, 'extras': sorted(extras_now),
+                                   'requires': sorted(requires)}
+                if len(nodes) + len(next_frontier) > WHEELHOUSE_MAX_PACKAGES:
+                    raise ResolutionError(
+                        f"Dependency closure exceeds {WHEELHOUSE_MAX_PACKAGES} packages")
+                frontier = next_frontier
+
+            stale = []
+            for name, node in nodes.items():
+                allowed = asked.get(name, SpecifierSet()).contains(node['version'], prereleases=True)
+                if name == root and not allowed:
+                    raise ResolutionError(
+                        f"{package_name} {version} conflicts with its dependencies' requirement "
+                        f"'{asked[name]}'")
+                if not allowed or set(node['extras']) != asked_extras.get(name, set()):
+                    stale.append(name)
+            if not stale:
+                return nodes
+            constraints, wanted_extras = asked, asked_extras
+    raise ResolutionError(f"Could not find a consistent set of versions for {package_name} {version}")
+
+
+def build_order(nodes):
+    """Order nodes so every package comes after the packages it requires.
+
+    Returns [(name, requires)], where requires only lists dependencies that
+    come earlier; the edge that closes a dependency cycle is dropped.
+    """
+    order = []
+    visited = set()
+
+    def visit(name):
+        visited.add(name)
+        for dep in nodes[name]['requires']:
+            if dep not in visited:
+                visit(dep)
+        order.append(name)
+
+    for name in sorted(nodes):
+        if name not in visited:
+            visit(name)
+    position = {name: index for index, name in enumerate(order)}
+    return [(name, [dep for dep in nodes[name]['requires'] if position[dep] < position[name]])
+            for name in order]
+
+
+def run_dag_local(order, nodes, build_id, target=None, client=None, workers=WHEELHOUSE_CONCURRENCY):
+    """Build every node on a thread pool, starting each once its dependencies are done.
+
+    Independent nodes build in parallel; run_build reuses finished builds and
+    joins identical builds already running. Returns {name: result}.
+    """
+    results = {}
+    waiting_on = {name: set(requires) for name, requires in order}
+    dependents = {}
+    for name, requires in order:
+        for dep in requires:
+            dependents.setdefault(dep, []).append(name)
+    ready = deque(name for name, requires in order if not requires)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while ready or running:
+            raise_if_cancelled(build_id)
+            while ready:
+                name = ready.popleft()
+                future = pool.submit(run_build, name, nodes[name]['version'], 'wheel',
+                                     target=target, client=client)
+                running[future] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = {'status': 'failed', 'output': str(e)}
+                for dependent in dependents.get(name, ()):
+                    waiting_on[dependent].discard(name)
+                    if not waiting_on[dependent]:
+                        ready.append(dependent)
+    return results
+
+
+def _ended_nodes(records, backend):
+    """Names of the nodes whose build was reused or whose job is no longer queued or running."""
+    job_ids = [record['job_id'] for record in records.values() if record.get('job_id')]
+    statuses = {job.id: job.get_status(refresh=False) for job in backend.fetch_jobs(job_ids)}
+    return {name for name, record in records.items()
+            if record.get('deduplicated') == 'completed'
+            or (record.get('job_id') and statuses.get(record['job_id']) not in ACTIVE_JOB_STATUSES)}
+
+
+def submit_ready_nodes(result, order, nodes, backend, queue):
+    """Submit the node builds whose requirements have all ended; returns the nodes that have ended.
+
+    Node builds go through the fair queue like any other build: at the
+    wheelhouse's priority, on behalf of its client, with the job id of their
+    build key so they collapse into identical builds already queued. Nodes
+    with a reusable build are not submitted.
+    """
+    from rq.job import Dependency
+    records = {record['package']: record for record in result['nodes']}
+    target = result.get('target')
+    client = result.get('client')
+    priority = result.get('priority', DEFAULT_PRIORITY)
+    while True:
+        ended = _ended_nodes(records, backend)
+        ready = [name for name, requires in order
+                 if name not in ended and not records[name].get('job_id')
+                 and all(dep in ended for dep in requires)]
+        if not ready:
+            return ended
+        calls = []
+        placeholders = []
+        for name in ready:
+            node_version = nodes[name]['version']
+            key = build_key(name, node_version, 'wheel', target)
+            existing = build_index.find(key)
+            if existing:
+                records[name].update(build_id=existing.get('build_id'), status='success',
+                                     deduplicated='completed')
+                continue
+            node_build_id = enqueue_placeholder(name, node_version, 'wheel', client, priority)
+            calls.append((run_build, (name, node_version, 'wheel'),
+                          {'build_id': node_build_id, 'target': target, 'client': client}, job_id_for(key)))
+            placeholders.append((name, node_build_id))
+        if not calls:
+            continue
+        # Placeholders are written before a worker can pick up their builds
+        storage.flush()
+        try:
+            submitted = backend.submit_many(calls, priority, client)
+        except Exception:
+            for _, node_build_id in placeholders:
+                storage.delete_build(node_build_id)
+            raise
+        for (name, node_build_id), (job, created) in zip(placeholders, submitted):
+            if not created:
+                storage.delete_build(node_build_id)
+                node_build_id = job.kwargs.get('build_id')
+                records[name]['deduplicated'] = 'in_flight'
+            records[name].update(build_id=node_build_id, status='queued', job_id=job.id)
+            # Look for newly ready nodes once this one ends. The fair queue has no
+            # dependencies, so this small job goes onto the wheelhouse's own RQ
+            # queue, which only releases it after the node's job has ended.
+            queue.enqueue(advance_wheelhouse, result['build_id'],
+                          depends_on=Dependency(jobs=[job.id], allow_failure=True))
+
+
+def _node_records(nodes, results):
+    records = []
+    for name in sorted(nodes):
+        record = dict(nodes[name])
+        result = results.get(name) or {}
+        for field in ('build_id', 'status', 'job_id', 'deduplicated', 'download_url'):
+            if result.get(field):
+                record[field] = result[field]
+        records.append(record)
+    return records
+
+
+def write_bundle(result, nodes, results):
+    """Zip the wheels of every node with a manifest and a pinned requirements file.
+
+    Install offline with: pip install --no-index --find-links <dir> -r requirements.txt
+    """
+    out_dir = os.path.join(ARTIFACTS_DIR, result['build_id'])
+    os.makedirs(out_dir, exist_ok=True)
+    filename = f"{result['package_name']}-{result['version']}-wheelhouse.zip"
+    path = os.path.join(out_dir, filename)
+    manifest = {
+        'package': result['package_name'],
+        'version': result['version'],
+        'target': result.get('target'),
+        'created_at': datetime.now().isoformat(),
+        'packages': [],
+    }
+    tmp_path = f"{path}.tmp"
+    # Wheels are already compressed: store them as they are
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as bundle:
+        for name in sorted(nodes):
+            wheel_path = artifact_path(results[name])
+            wheel_file = os.path.basename(wheel_path)
+            bundle.write(wheel_path, wheel_file)
+            manifest['packages'].append({'package': name, 'version': nodes[name]['version'],
+                                         'wheel': wheel_file, 'requires': nodes[name]['requires'],
+                                         'build_id': results[name].get('build_id')})
+        pins = ''.join(f"{name}=={nodes[name]['version']}\n" for name in sorted(nodes))
+        bundle.writestr('requirements.txt', pins, compress_type=zipfile.ZIP_DEFLATED)
+        bundle.writestr('manifest.json', json.dumps(manifest, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    os.replace(tmp_path, path)
+    return filename
+
+
+def _observe(result):
+    try:
+        started = datetime.fromisoformat(result['started_at'])
+        elapsed = (datetime.fromisoformat(result['finished_at']) - started).total_seconds()
+    except (KeyError, ValueError):
+        elapsed = 0.0
+    build_duration_seconds.observe(elapsed, build_type='wheelhouse', status=result['status'])
+    builds_total.inc(build_type='wheelhouse', status=result['status'])
+    registry.flush()
+
+
+def _built(result):
+    path = artifact_path(result)
+    return bool(result) and result.get('status') == 'success' and path is not None and os.path.isfile(path)
+
+
+def _finish(result, nodes, results):
+    """Bundle the node wheels, or fail listing the nodes that did not build, and save the record."""
+    result['nodes'] = _node_records(nodes, results)
+    failed = sorted(name for name in nodes if not _built(results.get(name)))
+    log_path = os.path.join(ARTIFACTS_DIR, result['build_id'], 'build.log')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, 'w') as logf:
+        for record in result['nodes']:
+            logf.write(f"{record['package']}=={record['version']}: {record.get('status', 'unknown')}"
+                       f"{' (reused)' if record.get('deduplicated') else ''}"
+                       f"{' build ' + record['build_id'] if record.get('build_id') else ''}\n")
+    result['finished_at'] = datetime.now().isoformat()
+    result['log_url'] = f"/download/{result['build_id']}/build.log"
+    if failed:
+        result['status'] = 'failed'
+        result['output'] = f"Could not build: {', '.join(failed)}"
+        result['download_url'] = result['log_url']
+    else:
+        with build_stage('wheelhouse', 'bundle'):
+            filename = write_bundle(result, nodes, results)
+        result['status'] = 'success'
+        result['output'] = (f"Built wheelhouse for {result['package_name']} version {result['version']} "
+                            f"({len(nodes)} packages, "
+                            f"{sum(1 for r in results.values() if r.get('deduplicated'))} reused)")
+        result['download_url'] = f"/download/{result['build_id']}/{filename}"
+    _observe(result)
+    return save_result(result)
+
+
+def _nodes_of(result):
+    return {record['package']: {key: record[key] for key in ('package', 'version', 'extras', 'requires')}
+            for record in result.get('nodes', [])}
+
+
+def build_wheelhouse_task(package_name, version, build_id=None, target=None, client=None):
+    """Build wheels for a package and its whole dependency closure as one zip.
+
+    The closure is resolved from the Requires-Dist metadata on PyPI and built
+    as a DAG, dependencies first. Inside an RQ worker each node is submitted
+    to the fair queue once its requirements have ended, and whichever
+    advance_wheelhouse job sees the last node end bundles the wheels; this
+    task then returns with the build still in progress. Elsewhere the nodes
+    build on a local thread pool and the finished build is returned.
+    """
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    build_id = build_id or new_build_id(package_name, version, 'wheelhouse')
+    result = {
+        'build_id': build_id,
+        'package_name': package_name,
+        'version': version,
+        'build_type': 'wheelhouse',
+        'status': 'in_progress',
+        'started_at': datetime.now().isoformat()
+    }
+    if client:
+        result['client'] = client
+    if target:
+        result['target'] = target
+    storage.save_build(result)
+    try:
+        with build_stage('wheelhouse', 'resolve'):
+            nodes = resolve_closure(package_name, version, target)
+        order = build_order(nodes)
+        raise_if_cancelled(build_id)
+        if not in_rq_job():
+            with build_stage('wheelhouse', 'build'):
+                results = run_dag_local(order, nodes, build_id, target, client)
+            return _finish(result, nodes, results)
+
+        from rq import get_current_job
+        job = get_current_job()
+        result['nodes'] = _node_records(nodes, {})
+        result['priority'] = _priority_of(job)
+        with _wheelhouse_lock(job.connection, build_id):
+            return _advance(result, job)
+    except BuildCancelled as e:
+        result['status'] = 'cancelled'
+        result['finished_at'] = datetime.now().isoformat()
+        result['output'] = str(e)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['finished_at'] = datetime.now().isoformat()
+        result['output'] = str(e)
+    _observe(result)
+    return save_result(result)
+
+
+def _priority_of(job):
+    from ..queue.setup import queue_names
+    return next((priority for priority, name in queue_names().items() if name == job.origin), DEFAULT_PRIORITY)
+
+
+def _wheelhouse_lock(connection, build_id):
+    # Node jobs end concurrently; one advance at a time reads and writes the record
+    return connection.lock(f"pybins:wheelhouse:{build_id}", timeout=WHEELHOUSE_LOCK_TIMEOUT)
+
+
+def _advance(result, job):
+    """Submit the nodes that are ready, then save the record, or bundle once every node has ended."""
+    from rq import Queue
+    from ..queue.setup import RQBackend
+    # The worker's own Redis, like FairWorker: node jobs must be RQ jobs for advance_wheelhouse to wait on
+    backend = RQBackend(connection=job.connection)
+    queue = Queue(job.origin, connection=job.connection)
+    nodes = _nodes_of(result)
+    ended = submit_ready_nodes(result, build_order(nodes), nodes, backend, queue)
+    if len(ended) < len(nodes):
+        storage.save_build(result, flush=True)
+        return result
+    return _finish(result, nodes, _node_results(result, nodes))
+
+
+def advance_wheelhouse(build_id):
+    """RQ job run after each node job of a wheelhouse ends: submit what became ready, or bundle."""
+    from rq import get_current_job
+    job = get_current_job()
+    with _wheelhouse_lock(job.connection, build_id):
+        result = storage.get_build(build_id)
+        if not result or result.get('status') != 'in_progress':
+            return result
+        return _advance(result, job)
+
+
+def _node_results(result, nodes):
+    """The build record of every node, from the node records of a wheelhouse."""
+    records = {record['package']: record for record in result['nodes']}
+    builds = storage.get_builds([record['build_id'] for record in records.values() if record.get('build_id')])
+    results = {}
+    for name, node in nodes.items():
+        record = records[name]
+        results[name] = builds.get(record.get('build_id')) or {}
+        if results[name].get('status') != 'success':
+            # The node build was coalesced with an identical one and its record dropped
+            existing = build_index.find(build_key(name, node['version'], 'wheel', result.get('target')))
+            if existing:
+                results[name] = dict(existing, deduplicated='completed')
+        elif record.get('deduplicated'):
+            results[name] = dict(results[name], deduplicated=record['deduplicated'])
+        if record.get('job_id'):
+            results[name] = dict(results[name], job_id=record['job_id'])
+    return results
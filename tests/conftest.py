@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Keep the database, artifacts and metrics of the tests out of the repository
+_scratch = tempfile.mkdtemp(prefix='pybins-tests-')
+for _name, _path in (('PYBINS_DB_PATH', 'pybins.db'), ('PYBINS_ARTIFACTS_DIR', 'artifacts'),
+                     ('PYBINS_METRICS_DIR', 'metrics')):
+    os.environ.setdefault(_name, os.path.join(_scratch, _path))
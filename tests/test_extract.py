@@ -0,0 +1,51 @@
+import io
+import os
+import tarfile
+import zipfile
+from unittest import mock
+
+import pytest
+
+from pybins.fetcher.extract import UnsafeArchive, extract_tar_stream, fetch_and_extract
+
+
+def tar_bytes(*members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, linkname, data in members:
+            info = tarfile.TarInfo(name)
+            if linkname is not None:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.skipif(not hasattr(tarfile, 'data_filter'), reason='needs tarfile extraction filters')
+def test_link_escaping_through_another_link_rejects_the_archive(tmp_path):
+    # Each link looks safe on its own, but a/b points at the root so a/b/c
+    # resolves above dest
+    archive = tar_bytes(('pkg/setup.py', None, b''), ('a/b', '..', None), ('a/b/c', '../..', None),
+                        ('pkg/later.py', None, b''))
+    with pytest.raises(UnsafeArchive):
+        extract_tar_stream(archive, str(tmp_path / 'src'))
+    assert not os.path.exists(tmp_path / 'src' / 'pkg' / 'later.py')
+
+
+def test_zip_download_stays_out_of_the_source_tree(tmp_path):
+    def download_package(url, dest_folder, sha256=None):
+        path = os.path.join(dest_folder, 'pkg-1.0.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('pkg-1.0/setup.py', '')
+        return path
+
+    dest = tmp_path / 'build_src'
+    with mock.patch('pybins.fetcher.fetcher.download_package', download_package):
+        tree = fetch_and_extract('http://pypi.invalid/pkg-1.0.zip', str(dest))
+    assert tree.build_root == os.path.join(str(dest), 'pkg-1.0')
+    assert os.listdir(dest) == ['pkg-1.0']
+    assert os.listdir(tmp_path) == ['build_src']
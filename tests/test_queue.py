@@ -0,0 +1,142 @@
+import fakeredis
+import pytest
+from rq import SimpleWorker
+from rq.job import JobStatus
+
+from pybins.queue.fair import FairQueue, job_id_for
+from pybins.queue.setup import RQBackend, LocalBackend
+from pybins.queue.worker import FairWorker
+
+
+def build(package, build_id=None):
+    return package
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def backend(redis):
+    return RQBackend(connection=redis, ready_depth=1)
+
+
+def submit(backend, package, priority='interactive', tenant='ip:1', job_id=None):
+    job, created = backend.submit(build, (package,), {'build_id': f"{package}-id"},
+                                  job_id or job_id_for((package, '1.0', 'wheel')), priority, tenant)
+    return job, created
+
+
+def drain(backend, redis):
+    """Play the workers: take released jobs off the RQ queues one at a time, in fair order."""
+    order = []
+    while True:
+        popped = [redis.lpop(queue.key) for queue in backend.queues.values()]
+        popped = [job_id.decode() for job_id in popped if job_id]
+        if not popped:
+            return order
+        order += popped
+        backend.release()
+
+
+def test_push_holds_jobs_beyond_ready_depth(backend):
+    for package in ('a', 'b', 'c'):
+        job, created = submit(backend, package)
+        assert created
+        assert job.get_status() == JobStatus.QUEUED
+    depths = backend.snapshot('ip:1')['priorities']['interactive']
+    assert (depths['ready'], depths['queued'], depths['yours']) == (1, 2, 2)
+    assert backend.queues['interactive'].count == 1
+
+
+def test_release_interleaves_tenants(backend, redis):
+    for package in ('a0', 'a1', 'a2', 'a3'):
+        submit(backend, package, tenant='key:a')
+    submit(backend, 'b0', tenant='key:b')
+    order = drain(backend, redis)
+    ids = {job_id_for((package, '1.0', 'wheel')): package for package in ('a0', 'a1', 'a2', 'a3', 'b0')}
+    assert [ids[job_id] for job_id in order] == ['a0', 'b0', 'a1', 'a2', 'a3']
+
+
+def test_release_shares_workers_by_priority_weight(backend, redis):
+    for index in range(40):
+        submit(backend, f"i{index}", 'interactive')
+    for index in range(5):
+        submit(backend, f"b{index}", 'bulk')
+    bulk = {job_id_for((f"b{index}", '1.0', 'wheel')) for index in range(5)}
+    order = drain(backend, redis)
+    assert len(order) == 45
+    # 16 interactive builds for every bulk build while both wait
+    assert sum(job_id in bulk for job_id in order[:34]) == 2
+
+
+def test_duplicate_submit_collapses(backend, redis):
+    job, created = submit(backend, 'a')
+    duplicate, created_again = submit(backend, 'a', tenant='ip:2')
+    assert created and not created_again
+    assert duplicate.id == job.id
+    assert backend.count == 1
+    # Once the job is over, the same build can be submitted again
+    redis.lpop(backend.queues['interactive'].key)
+    job.set_status(JobStatus.FINISHED)
+    _, created = submit(backend, 'a')
+    assert created
+
+
+def test_cancel_held_and_ready_jobs(backend):
+    ready, _ = submit(backend, 'a')
+    held, _ = submit(backend, 'b')
+    assert backend.cancel('b-id')
+    assert held.get_status() == JobStatus.CANCELED
+    assert backend.snapshot()['priorities']['interactive']['queued'] == 0
+    assert not backend.cancel('b-id')
+    assert backend.cancel('a-id')
+    assert backend.queues['interactive'].count == 0
+    assert not backend.cancel('unknown-id')
+
+
+def test_cancel_skips_started_job(backend, redis):
+    job, _ = submit(backend, 'a')
+    redis.lpop(backend.queues['interactive'].key)
+    job.set_status(JobStatus.STARTED)
+    assert not backend.cancel('a-id')
+
+
+class FairSimpleWorker(FairWorker):
+    # Run jobs in this process: a forked child would write to its own copy of fakeredis
+    execute_job = SimpleWorker.execute_job
+
+
+def test_fair_worker_releases_held_jobs(backend, redis):
+    jobs = [submit(backend, package, 'bulk')[0] for package in ('a', 'b', 'c')]
+    worker = FairSimpleWorker(list(backend.queues.values()), connection=redis)
+    worker.work(burst=True)
+    assert [job.get_status() for job in jobs] == [JobStatus.FINISHED] * 3
+    assert [job.return_value() for job in jobs] == ['a', 'b', 'c']
+
+
+def test_requeue_keeps_tenant_and_position():
+    fair = FairQueue()
+    for index in range(3):
+        fair.push('ci', 'key:a', f"a{index}", f"a{index}")
+    priority, tenant, start, item = fair.pop()
+    fair.requeue(priority, tenant, start, item, item)
+    fair.push('ci', 'key:b', 'b0', 'b0')
+    assert [fair.pop()[1:] for _ in range(4)] == [
+        ('key:a', 0.0, 'a0'), ('key:b', 0.0, 'b0'), ('key:a', 1.0, 'a1'), ('key:a', 2.0, 'a2')]
+
+
+def test_local_release_requeues_when_executor_is_full(monkeypatch):
+    from pybins.worker.executor import build_executor, ExecutorFull
+
+    def full(*args, **kwargs):
+        raise ExecutorFull('full')
+
+    monkeypatch.setattr(build_executor, 'submit', full)
+    local = LocalBackend(ready_depth=1)
+    job, created = local.submit(build, ('a',), {'build_id': 'a-id'}, 'job-a', 'ci', 'key:a')
+    assert created
+    assert local.fair.snapshot('key:a')['ci']['yours'] == 1
+    assert local.cancel('a-id')
+    assert job.get_status() == 'canceled'
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from pybins.fetcher.source_cache import SourceCache
+
+DIGEST = 'ab' * 32
+
+
+def test_digest_locks_are_released(tmp_path):
+    cache = SourceCache(str(tmp_path))
+    inside = []
+    overlaps = []
+
+    def hold():
+        with cache._digest_lock(DIGEST):
+            inside.append(threading.get_ident())
+            overlaps.append(len(inside))
+            time.sleep(0.01)
+            inside.pop()
+
+    threads = [threading.Thread(target=hold) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1] * 8
+    assert cache._locks == {}
+
+
+def test_digest_lock_is_released_on_error(tmp_path):
+    cache = SourceCache(str(tmp_path))
+    try:
+        with cache._digest_lock(DIGEST):
+            raise OSError('download failed')
+    except OSError:
+        pass
+    assert cache._locks == {}
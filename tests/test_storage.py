@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+from pybins.storage.storage import PackageStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return PackageStorage(str(tmp_path / 'pybins.db'))
+
+
+def build(status, **fields):
+    return dict({'build_id': 'b1', 'package_name': 'Foo_Bar', 'version': '1.0', 'build_type': 'wheel',
+                 'status': status}, **fields)
+
+
+def test_stale_flush_does_not_overwrite_finished_build(storage):
+    storage.save_build(build('success'))
+    # A timer flush that picked up the in_progress record before the final one commits last
+    storage.save_build(build('in_progress'), flush=True)
+    assert storage.get_build('b1')['status'] == 'success'
+    storage.save_build(build('success', evicted_at='now'))
+    assert storage.get_build('b1')['evicted_at'] == 'now'
+
+
+def test_failed_flush_keeps_records_buffered(storage, monkeypatch):
+    storage.save_build(build('in_progress'))
+    monkeypatch.setattr(storage, '_bump_change_counter', lambda conn: (_ for _ in ()).throw(sqlite3.OperationalError('disk I/O error')))
+    with pytest.raises(sqlite3.OperationalError):
+        storage.flush()
+    monkeypatch.undo()
+    storage.flush()
+    assert storage.list_builds()[0]['status'] == 'in_progress'
+
+
+def test_query_builds_matches_normalised_name_and_version(storage):
+    storage.save_build(build('success'))
+    builds, _ = storage.query_builds(package_name='foo-bar', version='1.0.0')
+    assert [b['build_id'] for b in builds] == ['b1']
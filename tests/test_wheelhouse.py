@@ -0,0 +1,89 @@
+import os
+import zipfile
+
+import fakeredis
+import pytest
+
+from pybins.fetcher import fetcher
+from pybins.queue.fair import job_id_for
+from pybins.worker import wheelhouse
+from pybins.worker.dedup import build_key
+from pybins.worker.wheelhouse import resolve_closure
+
+WHEEL = [{'filename': 'x-1.0-py3-none-any.whl', 'packagetype': 'bdist_wheel', 'url': 'http://x'}]
+
+INDEX = {
+    'root': {'1.0': ['a', 'b']},
+    'a': {'1.0': ['c>=3'], '2.0': ['c<2']},
+    'b': {'1.0': ['a<2']},
+    'c': {'1.0': [], '3.0': []},
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_index(monkeypatch):
+    monkeypatch.setattr(fetcher, 'fetch_release_files',
+                        lambda name: {version: WHEEL for version in INDEX[name]})
+    monkeypatch.setattr(fetcher, 'fetch_requires_dist', lambda name, version: INDEX[name][version])
+
+
+def test_resolve_drops_requirements_of_replaced_picks():
+    # a 2.0 is picked first and asks for c<2; once b pins a<2 that requirement no longer applies
+    nodes = resolve_closure('root', '1.0')
+    assert {name: node['version'] for name, node in nodes.items()} == {
+        'root': '1.0', 'a': '1.0', 'b': '1.0', 'c': '3.0'}
+
+
+def test_resolve_reports_conflicts(monkeypatch):
+    monkeypatch.setitem(INDEX, 'b', {'1.0': ['a<2', 'c<2']})
+    with pytest.raises(wheelhouse.ResolutionError):
+        resolve_closure('root', '1.0')
+
+
+built = []
+
+
+def fake_build(package_name, version, build_type='wheel', build_id=None, target=None, client=None):
+    from pybins.worker.tasks import ARTIFACTS_DIR, save_result
+    built.append(package_name)
+    os.makedirs(os.path.join(ARTIFACTS_DIR, build_id), exist_ok=True)
+    filename = f"{package_name}-{version}-py3-none-any.whl"
+    with zipfile.ZipFile(os.path.join(ARTIFACTS_DIR, build_id, filename), 'w') as wheel:
+        wheel.writestr(f"{package_name}-{version}.dist-info/METADATA",
+                       f"Metadata-Version: 2.1\nName: {package_name}\nVersion: {version}\n")
+    return save_result({'build_id': build_id, 'package_name': package_name, 'version': version,
+                        'build_type': build_type, 'status': 'success', 'client': client,
+                        'download_url': f"/download/{build_id}/{filename}"})
+
+
+def test_rq_wheelhouse_submits_nodes_through_the_fair_queue(monkeypatch):
+    from pybins.queue.setup import RQBackend
+    from pybins.worker.tasks import storage
+    from test_queue import FairSimpleWorker
+
+    nodes = {name: {'package': name, 'version': '1.0', 'extras': [], 'requires': requires}
+             for name, requires in (('app', ['lib', 'util']), ('lib', ['base']), ('base', []), ('util', []))}
+    monkeypatch.setattr(wheelhouse, 'resolve_closure', lambda *args, **kwargs: nodes)
+    monkeypatch.setattr(wheelhouse, 'run_build', fake_build)
+    built.clear()
+    redis = fakeredis.FakeRedis()
+    backend = RQBackend(connection=redis)
+    # Another client already queued an identical build of one node
+    backend.submit(fake_build, ('base', '1.0', 'wheel'), {'build_id': 'base-b', 'client': 'key:b'},
+                   job_id_for(build_key('base', '1.0', 'wheel', None)), 'bulk', 'key:b')
+    job, _ = backend.submit(wheelhouse.build_wheelhouse_task, ('app', '1.0'), {'build_id': 'wh-1', 'client': 'key:a'},
+                            'wheelhouse-job', 'ci', 'key:a')
+    FairSimpleWorker(list(backend.queues.values()), connection=redis).work(burst=True)
+
+    result = storage.get_build('wh-1')
+    assert result['status'] == 'success', result.get('output')
+    assert sorted(built) == ['app', 'base', 'lib', 'util']
+    assert built.index('base') < built.index('lib') < built.index('app')
+    for record in result['nodes']:
+        if record['package'] == 'base':
+            # Joined while queued, or reused once built: either way it is built once
+            assert record['build_id'] == 'base-b' and record['deduplicated'] in ('in_flight', 'completed')
+            continue
+        assert record['job_id'] == job_id_for(build_key(record['package'], '1.0', 'wheel', None))
+        assert backend.fetch_job(record['job_id']).origin == backend.queues['ci'].name
+        assert storage.get_build(record['build_id'])['client'] == 'key:a'